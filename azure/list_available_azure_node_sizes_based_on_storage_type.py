@@ -59,6 +59,11 @@ absent, unreadable custom image) is not filtered on, so the order stays
 orderable. Set DEBUG_LOGGING = True to emit an "azure_image"-prefixed trace of
 every decision point (grep azure_image <logfile>) when troubleshooting.
 
+Caching: the Resource SKU list for each (handler, region) is kept in a JSON file
+under SKU_CACHE_DIR shared by all worker processes, served for SKU_CACHE_TTL and
+then refreshed in the background, with a file lock so only one process calls
+Azure at a time.
+
 External API grounding (docs cited at call sites; not extrapolated from memory):
   - Resource SKUs list + capabilities/restrictions:
     https://learn.microsoft.com/en-us/rest/api/compute/resource-skus/list
@@ -72,6 +77,16 @@ Entry point: get_options_list(field, control_value=None, control_value_dict=None
              -> {"options": [(value, label)], "override": True, ...}
 """
 
+import fcntl
+import json
+import os
+import time
+
+try:
+    from eventlet.green import threading  # CB 7.7 and up
+except ImportError:
+    import threading  # CB 7.6 and earlier
+
 from infrastructure.models import Environment
 from utilities.logger import ThreadLogger
 
@@ -423,24 +438,40 @@ def _managed_image_requirements(rh, image_id):
 # ---------------------------------------------------------------------------
 # Live Azure Resource SKU capability map for the region.
 # ---------------------------------------------------------------------------
+# The SKU map for each (handler, region) is shared by every worker process
+# through a JSON file under SKU_CACHE_DIR, and memoized per process. A map
+# older than SKU_CACHE_TTL is still served, for up to SKU_CACHE_MAX_STALE, while
+# one background thread refreshes it. Only one process at a time calls Azure
+# for a given key (file lock), the others wait for and then read its result.
+SKU_CACHE_DIR = "/var/opt/cloudbolt/proserv/azure_sku_cache"
+SKU_CACHE_TTL = 6 * 60 * 60
+SKU_CACHE_MAX_STALE = 7 * 24 * 60 * 60
+# Longest a render waits for another process to finish fetching the SKUs
+SKU_LOCK_TIMEOUT = 60
+# Compute clients are rebuilt after this long so rotated credentials apply
+COMPUTE_CLIENT_TTL = 60 * 60
+
 _SKU_CACHE = {}
+_SKU_REFRESHING = set()
+_SKU_CACHE_LOCK = threading.Lock()
 _COMPUTE_CLIENT_CACHE = {}
 
 
 def _compute_client(rh):
     """Return a cached ComputeManagementClient for the handler, or None."""
     key = getattr(rh, "id", None)
-    if key in _COMPUTE_CLIENT_CACHE:
-        return _COMPUTE_CLIENT_CACHE[key]
-    client = None
+    cached = _COMPUTE_CLIENT_CACHE.get(key)
+    if cached and time.time() - cached[1] < COMPUTE_CLIENT_TTL:
+        return cached[0]
     try:
         from azure.mgmt.compute import ComputeManagementClient
         from resourcehandlers.azure_arm.azure_wrapper import configure_arm_client
         client = configure_arm_client(rh.get_api_wrapper(), ComputeManagementClient)
     except Exception as exc:  # noqa: BLE001 -- fail open
         _log("could not build Compute client: %s", exc)
-        client = None
-    _COMPUTE_CLIENT_CACHE[key] = client
+        # Not cached, so the next render tries again
+        return None
+    _COMPUTE_CLIENT_CACHE[key] = (client, time.time())
     return client
 
 
@@ -457,12 +488,159 @@ def _parse_azure_id_segment(resource_id, key):
 def _sku_capability_map(rh, region):
     """Return {size_name: {"caps": {name: value}, "restricted": bool, "zones": set}}.
 
+    Returns None if the SKU list can't be fetched (caller then fails open).
+    """
+    entry = _sku_cache_entry(rh, region)
+    return entry["skus"] if entry else None
+
+
+def _sku_cache_entry(rh, region):
+    """Return {"fetched", "skus", "table"} for the region, see _sku_capability_map
+    for "skus" and _compile_sku_table for "table".
+
+    Served from the per-process memo or the shared cache file when fresh
+    enough, otherwise fetched from Azure (see the cache notes above).
     Returns None if the SKU list can't be fetched (caller then fails open).
     """
     key = (getattr(rh, "id", None), region)
-    if key in _SKU_CACHE:
-        return _SKU_CACHE[key]
+    entry = _SKU_CACHE.get(key)
+    if entry is None or time.time() - entry["fetched"] >= SKU_CACHE_TTL:
+        # Another worker may have refreshed the shared file in the meantime
+        entry = _read_sku_cache_file(key) or entry
+        if entry is not None:
+            _SKU_CACHE[key] = entry
+    if entry is not None:
+        age = time.time() - entry["fetched"]
+        if age < SKU_CACHE_TTL:
+            return entry
+        if age < SKU_CACHE_MAX_STALE:
+            _log("SKU map for %s is %ds old, serving it while refreshing", region, age)
+            _refresh_sku_map_in_background(rh, region, key)
+            return entry
+    return _refresh_sku_map(rh, region, key, wait=True)
+
+
+def _sku_cache_path(key, suffix="json"):
+    rh_id, region = key
+    return os.path.join(SKU_CACHE_DIR, f"sku_map_{rh_id}_{region}.{suffix}")
+
+
+def _read_sku_cache_file(key):
+    """Return the cached {"fetched", "skus"} entry for the key, or None."""
+    try:
+        with open(_sku_cache_path(key)) as f:
+            data = json.load(f)
+        skus = {
+            name: {"caps": info["caps"], "restricted": info["restricted"],
+                   "zones": set(info["zones"])}
+            for name, info in data["skus"].items()
+        }
+        return _make_sku_entry(data["fetched"], skus)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:  # noqa: BLE001 -- a bad cache file is a cache miss
+        _log("unreadable SKU cache file for %s: %s", key, exc)
+        return None
+
+
+def _write_sku_cache_file(key, entry):
+    data = {
+        "fetched": entry["fetched"],
+        "skus": {
+            name: {"caps": info["caps"], "restricted": info["restricted"],
+                   "zones": sorted(info["zones"])}
+            for name, info in entry["skus"].items()
+        },
+    }
+    path = _sku_cache_path(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(SKU_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        # Atomic, so other workers never read a partial file
+        os.replace(tmp_path, path)
+    except Exception as exc:  # noqa: BLE001 -- still usable from the memo
+        _log("could not write SKU cache file for %s: %s", key, exc)
+
+
+def _refresh_sku_map(rh, region, key, wait):
+    """Fetch the SKU map from Azure holding the key's cross-process lock.
+
+    If another process holds the lock, either wait for it (up to
+    SKU_LOCK_TIMEOUT) and use the map it wrote, or give up straight away.
+    Returns the new cache entry, or None.
+    """
+    try:
+        os.makedirs(SKU_CACHE_DIR, exist_ok=True)
+        lock_file = open(_sku_cache_path(key, "lock"), "w")
+    except Exception as exc:  # noqa: BLE001 -- fetch without the lock
+        _log("could not open SKU cache lock for %s: %s", key, exc)
+        lock_file = None
+    try:
+        if lock_file is not None and not _acquire_lock(lock_file, wait):
+            if not wait:
+                return None
+            _log("timed out waiting for the SKU cache lock for %s", key)
+        elif lock_file is not None:
+            # Whoever held the lock may have just written a fresh map
+            entry = _read_sku_cache_file(key)
+            if entry and time.time() - entry["fetched"] < SKU_CACHE_TTL:
+                _SKU_CACHE[key] = entry
+                return entry
+        skus = _fetch_sku_capability_map(rh, region)
+        if skus is None:
+            return None
+        entry = _make_sku_entry(time.time(), skus)
+        _write_sku_cache_file(key, entry)
+        _SKU_CACHE[key] = entry
+        return entry
+    finally:
+        if lock_file is not None:
+            lock_file.close()  # also releases the flock
+
+
+def _acquire_lock(lock_file, wait):
+    """flock the file, polling so eventlet workers are not blocked."""
+    deadline = time.time() + SKU_LOCK_TIMEOUT
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if not wait or time.time() >= deadline:
+                return False
+            time.sleep(0.2)
+
+
+def _refresh_sku_map_in_background(rh, region, key):
+    """Refresh a stale SKU map in a thread, at most one per key per process."""
+    with _SKU_CACHE_LOCK:
+        if key in _SKU_REFRESHING:
+            return
+        _SKU_REFRESHING.add(key)
+
+    def refresh():
+        try:
+            _refresh_sku_map(rh, region, key, wait=False)
+        except Exception as exc:  # noqa: BLE001 -- the stale map stays in use
+            _log("background SKU refresh failed for %s: %s", region, exc)
+        finally:
+            with _SKU_CACHE_LOCK:
+                _SKU_REFRESHING.discard(key)
+            from django.db import connection
+            connection.close()
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
 
+def _fetch_sku_capability_map(rh, region):
+    """Fetch the SKU map for the region from Azure, see _sku_capability_map.
+
+    Returns None if the SKU list can't be fetched.
+    """
     compute = _compute_client(rh)
     if compute is None:
         return None
@@ -515,10 +693,173 @@ def _sku_capability_map(rh, region):
         _log("error iterating SKUs for %s: %s", region, exc)
         return None
 
-    _SKU_CACHE[key] = result
     return result
 
 
+def _make_sku_entry(fetched, skus):
+    return {"fetched": fetched, "skus": skus, "table": _compile_sku_table(skus)}
+
+
+# ---------------------------------------------------------------------------
+# Compiled SKU table. Every capability _reject_reason looks at is reduced to a
+# bit in a per-size int once, when the SKU map is fetched or loaded, so each
+# form regeneration filters all sizes with a few integer mask tests instead of
+# re-parsing capability strings. _reject_reason remains the reference (and
+# provides the reasons for DEBUG_LOGGING).
+# ---------------------------------------------------------------------------
+_F_RESTRICTED = 1 << 0
+_F_TRUSTED_LAUNCH_DISABLED = 1 << 1
+_F_CONFIDENTIAL = 1 << 2
+# "NO_*" bits are set only when the capability is present and false; an
+# absent capability is not enforced (fail open).
+_F_NO_ACCELERATED_NETWORKING = 1 << 3
+_F_NO_ENCRYPTION_AT_HOST = 1 << 4
+_F_NO_PREMIUM_IO = 1 << 5
+
+
+def _compile_sku_table(sku_map):
+    """Return the columnar table for a SKU map.
+
+    {"index": {size_name: row}, "flags": [int], "zone_masks": [int],
+     "archs": [str], "generations": [frozenset or None], "zone_bits":
+     {zone: bit}, "zone_data_available": bool}
+    """
+    zone_bits = {}
+    table = {"index": {}, "flags": [], "zone_masks": [], "archs": [],
+             "generations": [], "zone_bits": zone_bits}
+    for row, (name, info) in enumerate(sku_map.items()):
+        caps = info["caps"]
+        flags = 0
+        if info["restricted"]:
+            flags |= _F_RESTRICTED
+        if _cap_bool(caps, "TrustedLaunchDisabled"):
+            flags |= _F_TRUSTED_LAUNCH_DISABLED
+        if _has_confidential_capability(caps):
+            flags |= _F_CONFIDENTIAL
+        if "AcceleratedNetworkingEnabled" in caps \
+                and not _cap_bool(caps, "AcceleratedNetworkingEnabled"):
+            flags |= _F_NO_ACCELERATED_NETWORKING
+        if "EncryptionAtHostSupported" in caps \
+                and not _cap_bool(caps, "EncryptionAtHostSupported"):
+            flags |= _F_NO_ENCRYPTION_AT_HOST
+        if "PremiumIO" in caps and not _cap_bool(caps, "PremiumIO"):
+            flags |= _F_NO_PREMIUM_IO
+        zone_mask = 0
+        for zone in info["zones"]:
+            if zone not in zone_bits:
+                zone_bits[zone] = 1 << len(zone_bits)
+            zone_mask |= zone_bits[zone]
+        gens = str(caps.get("HyperVGenerations", "") or "").upper()
+        table["index"][name] = row
+        table["flags"].append(flags)
+        table["zone_masks"].append(zone_mask)
+        table["archs"].append(str(caps.get("CpuArchitectureType", "x64")).lower())
+        table["generations"].append(
+            frozenset(g.strip() for g in gens.split(",")) if gens else None)
+    table["zone_data_available"] = any(table["zone_masks"])
+    return table
+
+
+def _filter_sizes(sizes, table, order):
+    """Return the sizes that pass every constraint, in order.
+
+    Same decisions as _reject_reason, with the order compiled to masks once.
+    """
+    forbidden = _F_RESTRICTED
+    required = 0
+    sec = order.get("security_type")
+    if sec == "trustedlaunch":
+        forbidden |= _F_TRUSTED_LAUNCH_DISABLED
+    elif sec == "confidentialvm":
+        required |= _F_CONFIDENTIAL
+    if order.get("accelerated_networking"):
+        forbidden |= _F_NO_ACCELERATED_NETWORKING
+    if order.get("encryption_at_host"):
+        forbidden |= _F_NO_ENCRYPTION_AT_HOST
+    if order.get("premium_required"):
+        forbidden |= _F_NO_PREMIUM_IO
+    zone_bit = 0
+    if order.get("zone") and table["zone_data_available"]:
+        # A zone no size offers gets a bit no size has, rejecting them all
+        zone_bit = table["zone_bits"].get(order["zone"], 1 << len(table["zone_bits"]))
+    arch = order.get("architecture")
+    gen = order.get("generation")
+
+    index = table["index"]
+    flags = table["flags"]
+    zone_masks = table["zone_masks"]
+    archs = table["archs"]
+    generations = table["generations"]
+    surviving = []
+    for size in sizes:
+        row = index.get(size)
+        if row is None:
+            continue
+        f = flags[row]
+        if f & forbidden or f & required != required:
+            continue
+        if zone_bit and not zone_masks[row] & zone_bit:
+            continue
+        if arch and archs[row] != arch:
+            continue
+        if gen and generations[row] is not None and gen not in generations[row]:
+            continue
+        surviving.append(size)
+    return surviving
+
+
+def benchmark_size_filter(num_sizes=500, repeat=200):
+    """Micro-benchmark of _filter_sizes against per-size _reject_reason.
+
+    Builds a synthetic region of num_sizes SKUs and times filtering all of them
+    for a demanding order. Call it from a CloudBolt shell (manage.py shell)
+    after importing this module; it makes no Azure calls.
+    Returns {"reject_reason_ms", "compiled_ms", "compile_ms"} per filter call
+    (compile_ms is paid once per SKU fetch, not per render).
+    """
+    import timeit
+
+    sku_map = {}
+    for i in range(num_sizes):
+        caps = {
+            "vCPUs": str(2 ** (i % 6)),
+            "MemoryGB": str(4 * (i % 16 + 1)),
+            "CpuArchitectureType": "Arm64" if i % 7 == 0 else "x64",
+            "HyperVGenerations": "V1,V2" if i % 3 else "V1",
+            "TrustedLaunchDisabled": "True" if i % 5 == 0 else "False",
+            "AcceleratedNetworkingEnabled": "True" if i % 4 else "False",
+            "EncryptionAtHostSupported": "True" if i % 6 else "False",
+            "PremiumIO": "True" if i % 2 else "False",
+        }
+        if i % 11 == 0:
+            caps["ConfidentialComputingType"] = "SNP"
+        zones = {str(z) for z in (1, 2, 3) if (i + z) % 4}
+        sku_map[f"Standard_Bench{i}"] = {
+            "caps": caps, "restricted": i % 13 == 0, "zones": zones}
+    sizes = list(sku_map)
+    order = {
+        "architecture": "x64", "generation": "V2", "security_type": "trustedlaunch",
+        "accelerated_networking": True, "encryption_at_host": True, "zone": "2",
+        "premium_required": True,
+    }
+
+    def reject_reason():
+        zone_data_available = any(info["zones"] for info in sku_map.values())
+        return [s for s in sizes
+                if _reject_reason(s, sku_map, order, zone_data_available) is None]
+
+    table = _compile_sku_table(sku_map)
+    assert _filter_sizes(sizes, table, order) == reject_reason()
+    results = {
+        "reject_reason_ms": timeit.timeit(reject_reason, number=repeat),
+        "compiled_ms": timeit.timeit(
+            lambda: _filter_sizes(sizes, table, order), number=repeat),
+        "compile_ms": timeit.timeit(
+            lambda: _compile_sku_table(sku_map), number=repeat),
+    }
+    return {k: round(v * 1000 / repeat, 4) for k, v in results.items()}
+
+
 def _cap_bool(caps, name):
     return str(caps.get(name, "")).strip().lower() == "true"
 
@@ -663,10 +1004,11 @@ def get_options_list(field, control_value=None, control_value_dict=None,
              type(rh).__name__ if rh else None, isinstance(rh, AzureARMHandler), region)
         return _result(base_sizes, {})
 
-    sku_map = _sku_capability_map(rh, region)
-    if sku_map is None:
+    entry = _sku_cache_entry(rh, region)
+    if entry is None:
         _log("SKU data unavailable for region=%r -> returning base sizes UNFILTERED", region)
         return _result(base_sizes, {})
+    sku_map = entry["skus"]
     _log("region=%r sku_map has %d VM sizes", region, len(sku_map))
 
     # Image-derived requirements (architecture / generation).
@@ -698,18 +1040,19 @@ def get_options_list(field, control_value=None, control_value_dict=None,
     }
 
     # Zone filter is meaningful only if the region actually reports zones for any size.
-    zone_data_available = any(info["zones"] for info in sku_map.values())
+    table = entry["table"]
+    zone_data_available = table["zone_data_available"]
     _log("order=%r zone_data_available=%s", order, zone_data_available)
 
-    surviving = []
-    for size in base_sizes:
-        reason = _reject_reason(size, sku_map, order, zone_data_available)
-        sku_arch = ((sku_map.get(size) or {}).get("caps", {}) or {}).get("CpuArchitectureType", "x64")
-        if reason is None:
-            surviving.append(size)
-            _log("size %s: KEEP (sku CpuArchitectureType=%s)", size, sku_arch)
-        else:
-            _log("size %s: DROP (%s)", size, reason)
+    surviving = _filter_sizes(base_sizes, table, order)
+    if DEBUG_LOGGING:
+        for size in base_sizes:
+            reason = _reject_reason(size, sku_map, order, zone_data_available)
+            sku_arch = ((sku_map.get(size) or {}).get("caps", {}) or {}).get("CpuArchitectureType", "x64")
+            if reason is None:
+                _log("size %s: KEEP (sku CpuArchitectureType=%s)", size, sku_arch)
+            else:
+                _log("size %s: DROP (%s)", size, reason)
 
     _log("=== result === %d/%d sizes survived: %s", len(surviving), len(base_sizes), surviving)
 
@@ -4,12 +4,17 @@ interact with the VRA8 API.
 
 Usage:
     vra = VRealizeAutomation8Connection(CONN_INFO_ID)
+    # Optional, serve the *_from_instance_uuid lookups from one sweep
+    vra.build_instance_uuid_index()
 """
+import os
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 
 import requests
 import yaml
 
+from shared_modules.aria_connection import InstanceUUIDIndex
 from utilities.logger import ThreadLogger
 from utilities.models import ConnectionInfo
 
@@ -17,6 +22,8 @@ logger = ThreadLogger(__name__)
 
 
 VERIFY_CERTS = False
+PAGE_SIZE = 200
+DEPLOYMENT_ID_FIELDS = "id,blueprintId"
 
 
 def generate_options_for_vra_projects(field, control_value=None, **kwargs):
@@ -37,8 +44,33 @@ class VRealizeAutomation8Connection(object):
         self.conn_info = self.get_connection_info()
         self.base_url = self.get_base_url()
         self.headers = self.get_headers()
+        self.instance_uuid_index = None
+
+    def build_instance_uuid_index(self, path=None, refresh=True):
+        """
+        Builds (or loads and refreshes) an InstanceUUIDIndex and uses it for
+        the *_from_instance_uuid lookups on this connection
+        :param path: Optional JSON file to persist the index to
+        :param refresh: If False, a persisted index is used as-is
+        :return: InstanceUUIDIndex
+        """
+        index = InstanceUUIDIndex(self, path)
+        if path and os.path.exists(path):
+            index.load()
+            if refresh:
+                index.refresh()
+        else:
+            index.refresh(full=True)
+        if path:
+            index.save()
+        self.instance_uuid_index = index
+        return index
 
     def get_vm_from_instance_uuid(self, instance_uuid):
+        if self.instance_uuid_index is not None:
+            machine = self.instance_uuid_index.get_machine(instance_uuid)
+            if machine:
+                return machine
         url = (f"/iaas/api/machines?$filter="
                f"customProperties.instanceUUID%20eq%20'{instance_uuid}'")
         response_json = self.submit_request(url)
@@ -62,17 +94,12 @@ class VRealizeAutomation8Connection(object):
         return response_json
 
     def get_project_options(self):
-        results = 200
-        skip = 0
-        found_results = 200
-        options = []
-        while found_results != 0:
-            projects = self.list_projects({"$top": results, "$skip": skip})
-            for project in projects["content"]:
-                options.append((project["id"], project["name"]))
-            skip = skip + results
-            found_results = projects["numberOfElements"]
-        return options
+        return [(project["id"], project["name"])
+                for project in self.iter_projects()]
+
+    def iter_projects(self, query_params: dict = None, prefetch=False):
+        return self.iter_items('/iaas/api/projects', query_params,
+                               prefetch=prefetch)
 
     def list_resources(self, query_params: dict = {}):
         url = f'/deployment/api/resources'
@@ -80,12 +107,20 @@ class VRealizeAutomation8Connection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_resources(self, query_params: dict = None, prefetch=False):
+        return self.iter_items('/deployment/api/resources', query_params,
+                               prefetch=prefetch)
+
     def get_resource(self, resource_id):
         url = f'/deployment/api/resources/{resource_id}'
         response_json = self.submit_request(url)
         return response_json
 
     def get_resource_from_instance_uuid(self, instance_uuid, vm_name):
+        if self.instance_uuid_index is not None:
+            resource = self.instance_uuid_index.get_resource(instance_uuid)
+            if resource:
+                return resource
         response_json = self.list_resources({"search": vm_name})
         for resource in response_json["content"]:
             try:
@@ -112,27 +147,63 @@ class VRealizeAutomation8Connection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_deployments(self, query_params: dict = None, prefetch=False):
+        """
+        Yields every deployment across all pages. Like list_deployments, only
+        CREATE_SUCCESSFUL deployments are returned unless a status is passed.
+        """
+        query_params = dict(query_params or {})
+        if not query_params.get("status", None):
+            query_params["status"] = "CREATE_SUCCESSFUL"
+        return self.iter_items('/deployment/api/deployments', query_params,
+                               prefetch=prefetch)
+
     def list_deployment_ids_for_blueprint(self, blueprint_id, project_ids=[]):
         """
         Returns a list of deployment_ids for a given blueprint_id. If a
         project_id is provided, only deployments for that project will be
         returned.
+        The blueprint filter and an id-only $select are pushed down to the
+        API, falling back to simpler scans if the API rejects them. Results
+        are always checked client-side, and the transferred vs matched
+        counts are stored in self.last_deployment_scan.
         """
-        results = 200
-        skip = 0
-        found_results = 200
+        params = {"status": "CREATE_SUCCESSFUL"}
+        if project_ids: # Only get deployments for this project
+            params["projects"] = ','.join(project_ids)
+        pushdowns = [
+            {"$filter": f"blueprintId eq '{blueprint_id}'",
+             "$select": DEPLOYMENT_ID_FIELDS},
+            {"$select": DEPLOYMENT_ID_FIELDS},
+            {},
+        ]
+        for pushdown in pushdowns:
+            query_params = dict(params)
+            query_params.update(pushdown)
+            try:
+                return self.scan_deployment_ids(blueprint_id, query_params)
+            except requests.HTTPError as e:
+                status_code = getattr(e.response, "status_code", None)
+                if status_code != 400 or not pushdown:
+                    raise
+                logger.info(f'Deployment API rejected {list(pushdown)}, '
+                            f'falling back to a simpler scan')
+
+    def scan_deployment_ids(self, blueprint_id, query_params: dict):
         deployment_ids = []
-        while found_results != 0:
-            params = {"$top": results, "$skip": skip,
-                      "status": "CREATE_SUCCESSFUL"}
-            if project_ids: # Only get deployments for this project
-                params["projects"] = ','.join(project_ids)
-            deployments = self.list_deployments(params)
-            for deployment in deployments["content"]:
-                if deployment["blueprintId"] == blueprint_id:
-                    deployment_ids.append(deployment["id"])
-            skip = skip + results
-            found_results = deployments["numberOfElements"]
+        transferred = 0
+        for deployment in self.iter_deployments(query_params, prefetch=True):
+            transferred += 1
+            if deployment.get("blueprintId") == blueprint_id:
+                deployment_ids.append(deployment["id"])
+        self.last_deployment_scan = {
+            "transferred": transferred,
+            "matched": len(deployment_ids),
+            "query_params": query_params,
+        }
+        logger.info(f'Deployment scan for blueprint: {blueprint_id} '
+                    f'transferred {transferred} deployments, matched '
+                    f'{len(deployment_ids)}')
         return deployment_ids
 
     def get_deployment(self, deployment_id):
@@ -172,6 +243,10 @@ class VRealizeAutomation8Connection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_blueprints(self, query_params: dict = None, prefetch=False):
+        return self.iter_items('/blueprint/api/blueprints', query_params,
+                               prefetch=prefetch)
+
     def get_blueprint(self, blueprint_id):
         url = f'/blueprint/api/blueprints/{blueprint_id}'
         response_json = self.submit_request(url)
@@ -220,12 +295,20 @@ class VRealizeAutomation8Connection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_iaas_machines(self, query_params: dict = None, prefetch=False):
+        return self.iter_items('/iaas/api/machines', query_params,
+                               prefetch=prefetch)
+
     def get_iaas_machine(self, machine_id):
         url = f'/iaas/api/machines/{machine_id}'
         response_json = self.submit_request(url)
         return response_json
 
     def get_iaas_machine_from_instance_uuid(self, instance_uuid):
+        if self.instance_uuid_index is not None:
+            machine = self.instance_uuid_index.get_machine(instance_uuid)
+            if machine:
+                return machine
         response_json = self.list_iaas_machines(
             {"$filter": f'customProperties.instanceUUID eq {instance_uuid}'}
         )
@@ -234,6 +317,64 @@ class VRealizeAutomation8Connection(object):
                             f' for instance_uuid: {instance_uuid}')
         return response_json["content"][0]
 
+    def iter_pages(self, url_path, query_params: dict = None,
+                   page_size=PAGE_SIZE, prefetch=False):
+        """
+        Yields each page of a $top/$skip paginated list endpoint, stopping on
+        the last page reported by the API (last/totalElements) rather than
+        requesting an extra empty page.
+        - prefetch: If True, the next page is requested in the background
+            while the caller consumes the current one
+        """
+        query_params = dict(query_params or {})
+
+        def get_page(skip):
+            params = dict(query_params)
+            params.update({"$top": page_size, "$skip": skip})
+            return self.submit_request(
+                self.add_query_params_to_url(url_path, params)
+            )
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            skip = 0
+            page = get_page(skip)
+            while True:
+                last_page = self.is_last_page(page, skip, page_size)
+                next_page = None
+                if executor and not last_page:
+                    next_page = executor.submit(get_page, skip + page_size)
+                yield page
+                if last_page:
+                    break
+                skip += page_size
+                if next_page:
+                    page = next_page.result()
+                else:
+                    page = get_page(skip)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def iter_items(self, url_path, query_params: dict = None,
+                   page_size=PAGE_SIZE, prefetch=False):
+        for page in self.iter_pages(url_path, query_params, page_size,
+                                    prefetch):
+            for item in page.get("content", []):
+                yield item
+
+    @staticmethod
+    def is_last_page(page, skip, page_size):
+        if page.get("last") is True:
+            return True
+        found = page.get("numberOfElements", len(page.get("content", [])))
+        if found == 0:
+            return True
+        total = page.get("totalElements")
+        if total is not None:
+            return skip + found >= total
+        return found < page_size
+
     def add_query_params_to_url(self, url, query_params: dict):
         if query_params:
             url += f'?{urlencode(query_params)}'
@@ -42,17 +42,32 @@ Execution:
             - Assign to CB Blueprint
         - get the resources and their properties
 
+Pipelined Ingest:
+    With PIPELINED_INGEST enabled, deployments and their resources are fetched
+    from vRA by a bounded pool of INGEST_WORKERS threads while the job thread
+    writes to CloudBolt in batches of INGEST_BATCH_SIZE deployments. Owners,
+    groups and service items are cached for the run, and Servers are matched
+    and updated per batch. Completed deployments are recorded in a checkpoint
+    file so a failed run can be re-run and will skip the deployments that
+    were already ingested.
+
 """
 import ast
 import json
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from urllib.parse import urlencode
 import requests
 import yaml
 from dateutil.parser import parse
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.models import Q
 
-from infrastructure.models import Server
+from infrastructure.models import CustomField, Server
+from orders.models import CustomFieldValue
 from resources.models import Resource
 from servicecatalog.models import ServiceBlueprint
 from vra.vra8_connection import (VRealizeAutomation8Connection,
@@ -123,6 +138,11 @@ except Exception:
 # managed by the OneFuse Migration script in vRO
 IGNORE_PREFIXES.append("OneFuse_")
 logger.debug(f'IGNORE_PREFIXES: {IGNORE_PREFIXES}')
+# All prefixes compiled in to a single regex so each property name is only
+# scanned once
+IGNORE_PREFIXES_RE = re.compile(
+    "|".join(re.escape(prefix) for prefix in IGNORE_PREFIXES)
+)
 
 # Explicit properties to ignore - most of these are vRA specific properties
 # that do not need to be migrated to CloudBolt
@@ -140,12 +160,25 @@ IGNORE_PROPERTIES = ["resourceId", "zone_overlapping_migrated", "powerState",
                      "primaryMAC", "computeHostRef", "account", "vcUuid",
                      "hasSnapshots", "countIndex",
                      ]
+IGNORE_PROPERTIES = frozenset(IGNORE_PROPERTIES)
 
 # Optional input allowing you to specify a custom prefix for the migrated
 # Custom Properties. This is useful if you want to keep the vRA Custom
 # Properties separate from the CloudBolt Custom Properties.
 MIGRATE_PREFIX = "{{migrate_prefix}}"
 
+# Pipelined ingest settings. Set PIPELINED_INGEST to False to fall back to
+# processing one deployment at a time.
+PIPELINED_INGEST = True
+# Number of threads fetching deployments and resources from vRA
+INGEST_WORKERS = 8
+# Number of deployments written to CloudBolt per DB transaction
+INGEST_BATCH_SIZE = 50
+# Checkpoints of completed deployments are written here, one file per
+# vRA Blueprint -> CloudBolt Blueprint migration. The file is removed once a
+# run completes successfully.
+CHECKPOINT_DIR = "/var/opt/cloudbolt/proserv/vra_migration/checkpoints"
+
 
 def generate_options_for_create_groups(**kwargs):
     return [
@@ -158,8 +191,7 @@ def generate_options_for_vra_blueprint(field, control_value=None, **kwargs):
     if not control_value:
         return [("", "------First, Select a vRA Connection------")]
     vra = VRealizeAutomation8Connection(control_value)
-    bps = vra.list_blueprints()["content"]
-    return [(bp["id"], bp["name"]) for bp in bps]
+    return [(bp["id"], bp["name"]) for bp in vra.iter_blueprints()]
 
 
 def generate_options_for_cloudbolt_blueprint(field, **kwargs):
@@ -176,7 +208,133 @@ def create_custom_fields():
                         "BOOL")
 
 
+class CustomFieldRegistry(object):
+    """
+    Run-scoped registry of the Custom Fields used for migrated properties.
+    Existing fields are loaded with one query, missing fields are created in
+    bulk and values are queued per resource/server, then written with a
+    handful of queries when flush() is called rather than one
+    create_custom_field and set_value_for_custom_field per property.
+    """
+    # CustomFieldValue column holding the value for each supported type.
+    # Values for other types fall back to set_value_for_custom_field.
+    VALUE_COLUMNS = {"STR": "str_value", "TXT": "txt_value"}
+
+    def __init__(self):
+        fields = CustomField.objects.all()
+        if MIGRATE_PREFIX:
+            fields = fields.filter(name__startswith=MIGRATE_PREFIX)
+        self.fields = {field.name: field for field in fields}
+        self.pending = {}
+
+    def ensure_fields(self, field_specs):
+        """
+        Creates any of the fields that do not exist yet with one bulk insert
+        :param field_specs: dict of field name -> (label, type, description)
+        """
+        missing = [name for name in field_specs if name not in self.fields]
+        if not missing:
+            return
+        # Fields outside the preload (or created since by another job) may
+        # already exist, pick those up rather than inserting duplicates
+        for field in CustomField.objects.filter(name__in=missing):
+            self.fields[field.name] = field
+        missing = [name for name in missing if name not in self.fields]
+        if not missing:
+            return
+        # Same attributes create_custom_field sets. A field created by another
+        # job since the query above is skipped rather than failing the batch.
+        CustomField.objects.bulk_create([
+            CustomField(name=name, label=field_specs[name][0],
+                        type=field_specs[name][1],
+                        description=field_specs[name][2],
+                        required=False, allow_multiple=False,
+                        show_on_servers=True)
+            for name in missing
+        ], ignore_conflicts=True)
+        # Re-query so the fields have their primary keys on every DB backend,
+        # and to pick up any created concurrently
+        for field in CustomField.objects.filter(name__in=missing):
+            self.fields[field.name] = field
+
+    def queue_value(self, resource, field_name, value):
+        self.pending.setdefault(resource, {})[field_name] = value
+
+    def flush(self, resource):
+        """
+        Writes all of the values queued for a resource or server, replacing
+        any existing values for the same fields
+        """
+        pending = self.pending.pop(resource, None)
+        if not pending:
+            return
+        by_column = {}
+        fallback = {}
+        for field_name, value in pending.items():
+            field = self.fields[field_name]
+            column = self.VALUE_COLUMNS.get(field.type)
+            if column:
+                by_column.setdefault(column, []).append((field, value))
+            else:
+                fallback[field_name] = value
+        cfvs = []
+        for column, pairs in by_column.items():
+            cfvs.extend(self.get_or_create_values(column, pairs))
+        if cfvs:
+            manager = get_cfv_manager(resource)
+            field_ids = [cfv.field_id for cfv in cfvs]
+            manager.remove(*manager.filter(field_id__in=field_ids))
+            manager.add(*cfvs)
+        for field_name, value in fallback.items():
+            resource.set_value_for_custom_field(field_name, value)
+
+    @staticmethod
+    def get_or_create_values(column, pairs):
+        """
+        Returns a CustomFieldValue for each (field, value) pair, creating the
+        missing ones with a single bulk insert
+        """
+        field_ids = {field.id for field, _ in pairs}
+        values = {value for _, value in pairs}
+
+        def lookup():
+            existing = CustomFieldValue.objects.filter(
+                field_id__in=field_ids, **{f'{column}__in': values}
+            )
+            return {(cfv.field_id, getattr(cfv, column)): cfv
+                    for cfv in existing}
+
+        found = lookup()
+        missing = [CustomFieldValue(field=field, **{column: value})
+                   for field, value in pairs
+                   if (field.id, value) not in found]
+        if missing:
+            CustomFieldValue.objects.bulk_create(missing)
+            found = lookup()
+        return [found[(field.id, value)] for field, value in pairs]
+
+
+_field_registry = None
+
+
+def get_field_registry():
+    global _field_registry
+    if _field_registry is None:
+        _field_registry = CustomFieldRegistry()
+    return _field_registry
+
+
+def get_cfv_manager(resource):
+    # Servers and Resources keep their Custom Field Values on different
+    # related managers
+    if isinstance(resource, Server):
+        return resource.custom_field_values
+    return resource.attributes
+
+
 def run(job=None, logger=None, **kwargs):
+    global _field_registry
+    _field_registry = None
     validate_deployment_map()
     create_custom_fields()
     # group = Group.objects.get(id=GROUP_ID)
@@ -185,7 +343,21 @@ def run(job=None, logger=None, **kwargs):
     # Get all vRA Deployments for the Blueprint
     deployment_ids = vra.list_deployment_ids_for_blueprint(VRA_BLUEPRINT_ID,
                                                         project_ids=PROJECT_IDS)
+    scan = vra.last_deployment_scan
+    set_progress(f'Found {scan["matched"]} deployments for the vRA Blueprint '
+                 f'({scan["transferred"]} deployments transferred).')
     bp = ServiceBlueprint.objects.get(id=CB_BLUEPRINT_ID)
+    if PIPELINED_INGEST:
+        if bp.resource_type is None:
+            set_progress(f'No resource type selected for Blueprint: {bp.name}.'
+                         f' Will import all resources as stand-alone servers.')
+            ingest_deployments(deployment_ids, vra)
+        else:
+            set_progress(f'Importing all resources as child resources of the '
+                         f'Blueprint: {bp.name}.')
+            ingest_deployments(deployment_ids, vra, bp)
+        return "SUCCESS", "", ""
+
     if bp.resource_type is None:
         # Since a Blueprint was selected without a resource type, we will import
         # all resources as stand-alone servers in CloudBolt (not tied to a
@@ -254,6 +426,269 @@ def migrate_servers_metadata(deployment_ids, vra):
     return servers
 
 
+class IngestCache(object):
+    """
+    Per-run cache for lookups that repeat across deployments: owners (vRA user
+    search + LDAP), the CloudBolt group for each vRA project and the service
+    item for each CloudBolt tier.
+    """
+
+    def __init__(self, vra):
+        self.vra = vra
+        self.owners = {}
+        self.groups = {}
+        self.service_items = {}
+
+    def get_owner(self, deployment):
+        key = (deployment.get("ownedBy", None), deployment["orgId"])
+        if key not in self.owners:
+            self.owners[key] = get_owner(deployment, self.vra)
+        return self.owners[key]
+
+    def get_group(self, project_id, resource):
+        if project_id not in self.groups:
+            self.groups[project_id] = get_group_from_vra_project_id(
+                project_id, self.vra, resource
+            )
+        return self.groups[project_id]
+
+    def get_service_item(self, bp, cb_tier):
+        if cb_tier not in self.service_items:
+            self.service_items[cb_tier] = bp.serviceitem_set.get(
+                name=cb_tier).cast()
+        return self.service_items[cb_tier]
+
+
+class IngestCheckpoint(object):
+    """
+    Tracks the deployment ids that have been fully ingested, persisted as a
+    JSON list so an interrupted run can be resumed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.completed = set(json.load(f))
+
+    def mark_completed(self, deployment_ids):
+        self.completed.update(deployment_ids)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, "w") as f:
+            json.dump(sorted(self.completed), f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_checkpoint_path():
+    return os.path.join(CHECKPOINT_DIR,
+                        f'{VRA_BLUEPRINT_ID}_{CB_BLUEPRINT_ID}.json')
+
+
+def ingest_deployments(deployment_ids, vra, bp=None):
+    """
+    Pipelined ingest of vRA deployments. Deployments and their resources are
+    fetched concurrently, then written to CloudBolt in batches. If bp is
+    passed, each deployment becomes a Resource on the Blueprint, otherwise
+    only the metadata of the matching Servers is updated.
+    :param deployment_ids: vRA deployment ids to ingest
+    :param vra: vRA Connection
+    :param bp: CloudBolt Blueprint for the deployment Resources
+    :return: The number of deployments ingested in this run
+    """
+    checkpoint = IngestCheckpoint(get_checkpoint_path())
+    remaining = [d for d in deployment_ids if d not in checkpoint.completed]
+    skipped = len(deployment_ids) - len(remaining)
+    if skipped:
+        set_progress(f'Resuming from checkpoint, skipping {skipped} '
+                     f'deployments that were already ingested.')
+    cache = IngestCache(vra)
+    start = time.time()
+    ingested = 0
+    batch = []
+    fetched = iter_fetched_deployments(remaining, vra, INGEST_WORKERS)
+    for deployment, vra_resources in fetched:
+        batch.append((deployment, vra_resources))
+        if len(batch) >= INGEST_BATCH_SIZE:
+            write_deployment_batch(batch, cache, bp, checkpoint)
+            ingested += len(batch)
+            report_throughput(ingested, len(remaining), start)
+            batch = []
+    if batch:
+        write_deployment_batch(batch, cache, bp, checkpoint)
+        ingested += len(batch)
+        report_throughput(ingested, len(remaining), start)
+    checkpoint.clear()
+    return ingested
+
+
+def fetch_deployment(deployment_id, vra):
+    """
+    Fetch a deployment and the full object for each of its resources
+    """
+    deployment = vra.get_deployment(deployment_id)
+    vra_resources = [vra.get_resource(r["id"])
+                     for r in deployment["resources"]]
+    return deployment, vra_resources
+
+
+def iter_fetched_deployments(deployment_ids, vra, workers):
+    """
+    Yields (deployment, resources) tuples as they are fetched by a pool of
+    worker threads. At most workers * 2 fetches are in flight so memory stays
+    bounded regardless of how many deployments are being ingested.
+    """
+    deployment_ids = iter(deployment_ids)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for deployment_id in deployment_ids:
+                pending.add(pool.submit(fetch_deployment, deployment_id, vra))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def write_deployment_batch(batch, cache, bp, checkpoint):
+    """
+    Writes a batch of fetched deployments to CloudBolt in one transaction.
+    The owners and groups of the batch are resolved first (vRA and LDAP
+    calls), so only DB writes happen while the transaction is open. Servers
+    are looked up with a single query and only the ones whose group, owner
+    or parent resource changed are saved.
+    """
+    resolve_batch_lookups(batch, cache, bp)
+    servers_by_uuid = get_servers_by_instance_uuid(batch)
+    original = {server.id: get_server_assignment(server)
+                for server in servers_by_uuid.values()}
+    with transaction.atomic():
+        for deployment, vra_resources in batch:
+            servers = ingest_deployment(deployment, vra_resources, cache,
+                                        servers_by_uuid, bp)
+            for server in servers:
+                if get_server_assignment(server) != original[server.id]:
+                    # save() rather than bulk_update so Server.save() still
+                    # runs, as it did when each server was saved on its own
+                    server.save()
+    checkpoint.mark_completed([d["id"] for d, _ in batch])
+
+
+def resolve_batch_lookups(batch, cache, bp):
+    """
+    Fills the cache with the owner and groups of every deployment in the
+    batch, the lookups that call vRA and LDAP
+    """
+    for deployment, vra_resources in batch:
+        cache.get_owner(deployment)
+        if bp:
+            cache.get_group(deployment["projectId"], deployment["name"])
+        for resource in vra_resources:
+            if resource["type"] == "Cloud.vSphere.Machine":
+                cache.get_group(resource["projectId"], resource["name"])
+
+
+def get_server_assignment(server):
+    return server.group_id, server.owner_id, server.parent_resource_id
+
+
+def get_servers_by_instance_uuid(batch):
+    uuids = []
+    for _, vra_resources in batch:
+        for resource in vra_resources:
+            if resource["type"] != "Cloud.vSphere.Machine":
+                continue
+            uuid = resource.get("properties", {}).get("instanceUUID")
+            if uuid:
+                uuids.append(uuid)
+    servers = Server.objects.filter(
+        vmwareserverinfo__instance_uuid__in=uuids
+    ).select_related("vmwareserverinfo")
+    return {server.vmwareserverinfo.instance_uuid: server
+            for server in servers}
+
+
+def ingest_deployment(deployment, vra_resources, cache, servers_by_uuid,
+                      bp=None):
+    """
+    Applies a single fetched deployment to CloudBolt. Returns the Servers that
+    were updated, the caller is responsible for saving them.
+    """
+    owner = cache.get_owner(deployment)
+    parent_resource = None
+    if bp:
+        group = cache.get_group(deployment["projectId"], deployment["name"])
+        if not group:
+            logger.warning(f'Group does not exist, skipping the '
+                           f'migration of {deployment["name"]}.')
+            return []
+        parent_resource = create_deployment_resource(deployment, owner, bp,
+                                                     cache.vra, group)
+    servers = []
+    for resource in vra_resources:
+        if bp:
+            cb_tier = DEPLOYMENT_MAP[resource["properties"]["name"]]
+            si = cache.get_service_item(bp, cb_tier)
+            resource_type = si.real_type.name
+            if resource_type == "blueprint service item":
+                create_cloudbolt_resource(resource, bp, owner, group,
+                                          parent_resource)
+                continue
+            if resource_type != "provision server service item":
+                logger.warning(f'Unknown resource type: {resource_type} for '
+                               f'service item: {si.name}. Skipping.')
+                continue
+        server = apply_server_metadata(resource, owner, cache,
+                                       servers_by_uuid)
+        if server:
+            if parent_resource:
+                server.parent_resource = parent_resource
+            servers.append(server)
+    return servers
+
+
+def apply_server_metadata(resource, owner, cache, servers_by_uuid):
+    """
+    Pipelined counterpart of migrate_server_metadata. Sets the group and
+    owner on the matching Server without saving it and migrates its custom
+    properties.
+    """
+    resource_type = resource["type"]
+    name = resource["name"]
+    if resource_type != "Cloud.vSphere.Machine":
+        logger.warning(f'Unknown resource type: {resource_type}. Skipping.')
+        return None
+    props = resource["properties"]
+    uuid = props["instanceUUID"]
+    server = servers_by_uuid.get(uuid)
+    if not server:
+        logger.warning(f'No CloudBolt Server found for server: {name} with '
+                       f'instance_uuid: {uuid}. Skipping.')
+        return None
+    group = cache.get_group(resource["projectId"], server)
+    if group:
+        server.group = group
+    server.owner = owner.userprofile
+    migrate_custom_properties(server, props)
+    return server
+
+
+def report_throughput(ingested, total, start):
+    elapsed = max(time.time() - start, 0.001)
+    rate = ingested / elapsed
+    remaining = (total - ingested) / rate if rate else 0
+    set_progress(f'Ingested {ingested}/{total} deployments '
+                 f'({rate:.2f} deployments/s, ~{int(remaining)}s remaining)')
+
+
 def get_owner_metadata(deployment, vra):
     owner = deployment.get("ownedBy", None)
     org_id = deployment["orgId"]
@@ -447,23 +882,30 @@ def get_group_from_vra_project_id(project_id, vra, resource):
 
 def migrate_custom_properties(resource, custom_properties, vra_type=None):
     # Works for a Resource or a Server
+    registry = get_field_registry()
+    values = {}
+    field_specs = {}
     for key, value in custom_properties.items():
         if key in IGNORE_PROPERTIES:
             continue
-        if any(key.startswith(prefix) for prefix in IGNORE_PREFIXES):
+        if IGNORE_PREFIXES_RE.match(key):
             continue
         if not value:
             # If the value is None, we will skip it
             continue
         if type(value) == dict:
             # If the value is a dict, dump to json string
-            if vra_type.startswith("Custom.onefuse."):
+            if vra_type and vra_type.startswith("Custom.onefuse."):
                 # Checking if object is in the OneFuse Custom Resource namespace
                 # If so, we need to separate the endpoint and IDs
                 endpoint, onefuse_id = value["id"].split(":")
                 value["id"] = onefuse_id
                 value["endpoint"] = endpoint
             value = json.dumps(value)
+        elif type(value) == list:
+            value = json.dumps(value)
+        elif type(value) != str:
+            value = str(value)
         cf_name = f'{MIGRATE_PREFIX}{key}'
         if len(cf_name) > 50:
             # Custom Field names in CloudBolt are limited to 50 chars, if the
@@ -479,31 +921,21 @@ def migrate_custom_properties(resource, custom_properties, vra_type=None):
             # of the value is greater than 500, we will use a Text field
             # which is not limited on chars
             cf_type = "TXT"
-        create_custom_field(cf_name, key, cf_type,
-                            description=f'vRA Custom Property: {key}',
-                            show_on_servers=True)
-        resource.set_value_for_custom_field(cf_name, value)
+        field_specs[cf_name] = (key, cf_type, f'vRA Custom Property: {key}')
+        values[cf_name] = value
+    registry.ensure_fields(field_specs)
+    for cf_name, value in values.items():
+        field = registry.fields[cf_name]
+        if field.type == "STR" and field_specs[cf_name][1] == "TXT":
+            # The field already exists as a String, leave it to CloudBolt to
+            # store the long value
+            resource.set_value_for_custom_field(cf_name, value)
+            continue
+        registry.queue_value(resource, cf_name, value)
+    registry.flush(resource)
     return None
 
 
-def create_custom_field_set_value(field_name, field_type, value, server):
-    cmp_type = get_cmp_type(field_type)
-    create_custom_field(field_name, field_name, cmp_type)
-
-
-def get_cmp_type(field_type):
-    if field_type == 'string':
-        return 'STR'
-    elif field_type == 'boolean':
-        return 'BOOL'
-    elif field_type == 'integer':
-        return 'INT'
-    elif field_type == 'decimal':
-        return 'DEC'
-    else:
-        raise Exception(f'Unknown field_type: {field_type}')
-
-
 def validate_deployment_map():
     vra = VRealizeAutomation8Connection(CONN_INFO_ID)
     vra_content = vra.get_blueprint_content(VRA_BLUEPRINT_ID)
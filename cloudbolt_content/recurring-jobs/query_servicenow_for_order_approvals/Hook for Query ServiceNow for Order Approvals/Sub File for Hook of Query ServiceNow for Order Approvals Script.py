@@ -2,21 +2,57 @@
 This actions should be used as a recurring job to periodically query for any
 Approvals waiting on approval from ServiceNow. Once ServiceNow has approved the
 Request, this action will set the order to Approved in CloudBolt.
+
+Incremental sync: with INCREMENTAL_SYNC on, each run stores the latest
+sys_updated_on it has seen in SYNC_STATE_FILE and only asks ServiceNow for the
+pending requests updated since then, plus any pending request it has not seen
+before. A full check of every pending order still runs every
+FULL_SYNC_INTERVAL. ServiceNow compares sys_updated_on in the service
+account's time zone, so that account should use UTC (or WATERMARK_OVERLAP
+should cover the offset).
+
+Push mode (optional): the same script can be attached to an Inbound Web Hook
+(Admin > Inbound Webhooks). ServiceNow then POSTs {"sys_id": "<sc_request
+sys_id>"} from a Business Rule when a request's approval changes, and the
+order is updated straight away instead of on the next poll. The approval is
+always re-read from ServiceNow, the posted data is not trusted.
 """
 
-import requests
+import json
+import os
+from datetime import datetime, timedelta
+
 import cbhooks
 from itsm.servicenow.models.servicenow_itsm import ServiceNowITSM
-from django.utils.http import urlencode
+from django.db import transaction
+from django.db.models import Prefetch
 from common.methods import set_progress
-from orders.models import Order, get_current_time, ActionJobOrderItem, \
-    ServerModOrderItem
+from orders.models import get_current_time, ActionJobOrderItem, \
+    BlueprintOrderItem, CustomFieldValue, Order, ServerModOrderItem
+from shared_modules.servicenow import get_stats_delta, get_table_client
 from django.contrib.auth.models import User
 from utilities.exceptions import CloudBoltException
 from django.utils.html import escape, format_html
 from jobs.models import Job
 from django.utils.translation import ugettext as _
 
+# Number of sys_ids looked up per sys_idIN query against sc_request. Keeps the
+# request URL well under ServiceNow's length limit.
+SNOW_QUERY_CHUNK_SIZE = 100
+# Fields returned for each sc_request
+SNOW_APPROVAL_FIELDS = ['sys_id', 'number', 'stage', 'approval',
+                        'sys_updated_on']
+# Parameter holding the sys_id of the sc_request submitted for an order item
+SNOW_SYS_ID_FIELD = 'snow_order_submit_sys_id'
+
+INCREMENTAL_SYNC = True
+SYNC_STATE_FILE = '/var/opt/cloudbolt/proserv/service_now/approval_sync_state.json'
+FULL_SYNC_INTERVAL = timedelta(hours=24)
+# Requests updated up to this long before the watermark are asked for again,
+# to catch updates committed late or stamped with a slightly skewed clock
+WATERMARK_OVERLAP = timedelta(minutes=10)
+SNOW_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
 """
     ServiceNow Service Request Queue
     ~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -29,110 +65,242 @@ from django.utils.translation import ugettext as _
 
 def run(job=None, logger=None, **kwargs):
     set_progress('Running ServiceNow Request queue manager')
-    pending_bpoi_orders = get_pending_bpoi_orders()
-    pending_smoi_orders = get_pending_smoi_orders()
-    if not pending_bpoi_orders and not pending_smoi_orders:
+    pending = get_pending_order_sys_ids(BlueprintOrderItem)
+    pending += get_pending_order_sys_ids(ServerModOrderItem)
+    if not pending:
         msg = "There were no pending orders waiting on ServiceNow approvals"
         return "SUCCESS", msg, ""
 
     snowitsm = ServiceNowITSM.objects.first()  # there's likely only one
-    wrapper = snowitsm.get_api_wrapper()
-    base_url = wrapper.service_now_instance_url.replace("/login.do", "")
+    client = get_table_client(snowitsm)
+    # The client is shared by the process, so report on this run's calls only
+    stats_before = client.get_stats("sc_request")
 
     """
-    Loop through pending orders which have a PENDING status.
-    Update status to be the status which has been set in ServiceNow
+    Collect the ServiceNow request sys_id of every pending order, look up the
+    approval states that may have changed in a few batched queries, then update
+    each order to the status which has been set in ServiceNow
     """
-    check_bpoi_order_approval(pending_bpoi_orders, base_url, snowitsm)
-    check_smoi_order_approval(pending_smoi_orders, base_url, snowitsm)
+    state = load_sync_state()
+    pending_sys_ids = [sys_id for _order, _order_item, sys_id in pending]
+    now = datetime.utcnow()
+    full_sync = (not INCREMENTAL_SYNC or not state.get('watermark') or
+                 not state.get('last_full_sync') or
+                 now - parse_snow_datetime(state['last_full_sync']) >=
+                 FULL_SYNC_INTERVAL)
+    if full_sync:
+        set_progress('Checking every pending order')
+        known = set()
+        failed = []
+        records = get_approval_records(pending_sys_ids, client,
+                                       failed=failed)
+        if not failed:
+            state['last_full_sync'] = format_snow_datetime(now)
+    else:
+        known = set(state.get('known_sys_ids', []))
+        new_sys_ids = [i for i in pending_sys_ids if i not in known]
+        known_sys_ids = [i for i in pending_sys_ids if i in known]
+        updated_since = parse_snow_datetime(state['watermark']) - \
+            WATERMARK_OVERLAP
+        set_progress(f'Checking {len(new_sys_ids)} new pending order(s) and '
+                     f'{len(known_sys_ids)} updated since {updated_since}')
+        records = get_approval_records(new_sys_ids, client)
+        failed = []
+        records.update(get_approval_records(known_sys_ids, client,
+                                            updated_since=updated_since,
+                                            failed=failed))
+
+    for order, _order_item, ci_sys_id in pending:
+        record = records.get(ci_sys_id)
+        if record is None:
+            # Unchanged since the last run, or the lookup failed
+            continue
+        approval_status = record["approval"]
+        set_progress(f'SNOW pending order: {order.id} -> {order.status}, '
+                     f'SNOW request_id: {ci_sys_id}, SNOW approval state: '
+                     f'{approval_status}')
+        approve_order_from_status(order, approval_status)
+
+    # Only move the watermark on if every request that had to be checked was,
+    # otherwise updates to the ones that failed could be skipped over
+    if not failed:
+        watermarks = [r['sys_updated_on'] for r in records.values()
+                      if r.get('sys_updated_on')]
+        if state.get('watermark'):
+            watermarks.append(state['watermark'])
+        if watermarks:
+            # Same fixed format, so the latest sorts last
+            state['watermark'] = max(watermarks)
+    # A request only becomes known once it has been read successfully, until
+    # then it is looked up in full on every run
+    state['known_sys_ids'] = sorted({i for i in pending_sys_ids
+                                     if i in known or i in records})
+    save_sync_state(state)
+    stats = get_stats_delta(stats_before, client.get_stats("sc_request"))
+    set_progress(f'SNOW sc_request calls: {stats}')
     return "SUCCESS", "", ""
 
 
-def get_pending_bpoi_orders():
-    # Get all PENDING orders that have ServiceNow sys_ids atached
-    return Order.objects.filter(
-        status='PENDING',
-        orderitem__blueprintorderitem__isnull=False,
-        orderitem__blueprintorderitem__custom_field_values__field__name='snow_order_submit_sys_id'
-    )
+def inbound_web_hook_post(*args, parameters={}, **kwargs):
+    """
+    Update the pending order for one sc_request as soon as ServiceNow reports
+    a change to it, see the module docstring
+    """
+    ci_sys_id = parameters.get("sys_id", None)
+    if not ci_sys_id:
+        raise ValueError("sys_id is required")
+    pending = [(order, order_item, sys_id) for order, order_item, sys_id in
+               get_pending_order_sys_ids(BlueprintOrderItem) +
+               get_pending_order_sys_ids(ServerModOrderItem)
+               if sys_id == ci_sys_id]
+    if not pending:
+        return {"message": f"No pending order found for {ci_sys_id}"}
+
+    client = get_table_client(ServiceNowITSM.objects.first())
+    records = get_approval_records([ci_sys_id], client)
+    if ci_sys_id not in records:
+        return {"message": f"Request {ci_sys_id} not found in ServiceNow"}
+    approval_status = records[ci_sys_id]["approval"]
+    for order, _order_item, _sys_id in pending:
+        approve_order_from_status(order, approval_status)
+    return {
+        "message": f"Updated {len(pending)} order(s) from ServiceNow",
+        "result": f"Request {ci_sys_id} approval: {approval_status}",
+    }
 
 
-def get_pending_smoi_orders():
-    temp_smoi_orders = Order.objects.filter(
-        status='PENDING',
-        orderitem__servermodorderitem__isnull=False,
-        orderitem__servermodorderitem__custom_field_values__field__name='snow_order_submit_sys_id'
-    )
-    # Some orders can have multiplke ServerModOrderItems, so loop through all
-    # found Orders and only return a single order per group of SMOIs
-    pending_smoi_orders = []
-    for smoi_order in temp_smoi_orders:
-        if smoi_order not in pending_smoi_orders:
-            pending_smoi_orders.append(smoi_order)
-    return pending_smoi_orders
-
-
-def check_bpoi_order_approval(pending_bpoi_orders, base_url, snowitsm):
-    for order in pending_bpoi_orders:
-        set_progress(f'SNOW pending order: {order.id} -> {order.status}')
-        bpoi = order.orderitem_set.filter(
-            blueprintorderitem__isnull=False,
-            blueprintorderitem__custom_field_values__field__name='snow_order_submit_sys_id'
-        ).first().cast()
-        ci_sys_id = bpoi.custom_field_values.filter(
-            field__name='snow_order_submit_sys_id').first().value
-        set_progress(
-            f'&nbsp;&nbsp;&nbsp;&nbsp;Getting approval status for order # '
-            f'({order.id}) for SNOW request_id: {ci_sys_id}')
-        approval_status = get_approval_status(ci_sys_id, base_url, snowitsm)
-        approve_order_from_status(order, approval_status)
+def parse_snow_datetime(value):
+    return datetime.strptime(value, SNOW_DATETIME_FORMAT)
 
 
-def check_smoi_order_approval(pending_smoi_orders, base_url, snowitsm):
-    for order in pending_smoi_orders:
-        set_progress(f'SNOW pending order: {order.id} -> {order.status}')
-        smois = order.orderitem_set.filter(
-            servermodorderitem__isnull=False,
-            servermodorderitem__custom_field_values__field__name='snow_order_submit_sys_id'
-        )
-        smoi = smois.first().cast()
-        ci_sys_id = smoi.custom_field_values.filter(
-            field__name='snow_order_submit_sys_id').first().value
-        set_progress(
-            f'&nbsp;&nbsp;&nbsp;&nbsp;Getting approval status for order # '
-            f'({order.id}) for SNOW request_id: {ci_sys_id}')
-        approval_status = get_approval_status(ci_sys_id, base_url,
-                                              snowitsm)
-        approve_order_from_status(order, approval_status)
+def format_snow_datetime(value):
+    return value.strftime(SNOW_DATETIME_FORMAT)
+
+
+def load_sync_state():
+    try:
+        with open(SYNC_STATE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_sync_state(state):
+    os.makedirs(os.path.dirname(SYNC_STATE_FILE), exist_ok=True)
+    tmp_file = f'{SYNC_STATE_FILE}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, SYNC_STATE_FILE)
 
 
+def get_pending_order_sys_ids(order_item_model):
+    """
+    Find every PENDING order with an order item of order_item_model that has a
+    ServiceNow sys_id attached. Costs two queries however many orders are
+    pending: the order items joined to their orders, and the sys_id
+    CustomFieldValues of all of them.
+    :param order_item_model: BlueprintOrderItem or ServerModOrderItem
+    :return: list of (order, order_item, sys_id), one per order using its
+        first order item with a sys_id
+    """
+    sys_id_cfvs = Prefetch(
+        'custom_field_values',
+        queryset=CustomFieldValue.objects.filter(
+            field__name=SNOW_SYS_ID_FIELD).select_related('field').order_by('id'),
+        to_attr='snow_sys_id_cfvs'
+    )
+    order_items = order_item_model.objects.filter(
+        order__status='PENDING',
+        custom_field_values__field__name=SNOW_SYS_ID_FIELD
+    ).select_related('order').prefetch_related(sys_id_cfvs).order_by(
+        'order_id', 'id')
+
+    # Orders can have multiple matching order items (and the join can return
+    # an order item more than once), so only keep the first per order
+    pending = []
+    seen_order_ids = set()
+    for order_item in order_items:
+        if order_item.order_id in seen_order_ids:
+            continue
+        seen_order_ids.add(order_item.order_id)
+        ci_sys_id = order_item.snow_sys_id_cfvs[0].value
+        pending.append((order_item.order, order_item, ci_sys_id))
+    return pending
 
-def get_approval_status(ci_sys_id, base_url, snowitsm):
-    approval_data = lookup_ci(table_name='sc_request',
-                              ci_name='sys_id',
-                              ci_value=ci_sys_id,
-                              base_url=base_url,
-                              return_ci=['number', 'stage', 'approval'],
-                              conn=snowitsm)
-    # set_progress(f'JSON Data: {approval_data}')
-    approval_status = approval_data["approval"]
-    set_progress(f'&nbsp;&nbsp;&nbsp;&nbsp;SNOW approval state: '
-                 f'{approval_status}')
-    return approval_status
+
+def get_approval_records(ci_sys_ids, client, updated_since=None, failed=None):
+    """
+    Look up the approval state of many sc_requests, SNOW_QUERY_CHUNK_SIZE at a
+    time, with a sys_idIN encoded query returning only SNOW_APPROVAL_FIELDS
+    :param ci_sys_ids: the sys_ids of the sc_requests
+    :param client: the ServiceNowTableClient to query with
+    :param updated_since: if passed, a UTC datetime. Only requests updated at
+        or after it are returned.
+    :param failed: if passed, a list the sys_ids of failed chunks are added to
+    :return: dict of sys_id -> record. sys_ids that were not found, not
+        updated since updated_since, or whose chunk failed, are left out.
+    """
+    unique_sys_ids = list(dict.fromkeys(ci_sys_ids))
+    records = {}
+    for i in range(0, len(unique_sys_ids), SNOW_QUERY_CHUNK_SIZE):
+        chunk = unique_sys_ids[i:i + SNOW_QUERY_CHUNK_SIZE]
+        query = f"sys_idIN{','.join(chunk)}"
+        if updated_since:
+            query += \
+                f"^sys_updated_on>={format_snow_datetime(updated_since)}"
+        try:
+            results = client.get_records("sc_request", query=query,
+                                         fields=SNOW_APPROVAL_FIELDS,
+                                         page_size=len(chunk),
+                                         limit=len(chunk))
+        except Exception as e:
+            # Orders in this chunk stay PENDING and are retried next run
+            set_progress(f'Failed to look up {len(chunk)} SNOW requests: {e}')
+            if failed is not None:
+                failed.extend(chunk)
+            continue
+        for result in results:
+            records[result["sys_id"]] = result
+    if unique_sys_ids:
+        set_progress(f'Looked up {len(unique_sys_ids)} SNOW requests in '
+                     f'{-(-len(unique_sys_ids) // SNOW_QUERY_CHUNK_SIZE)} '
+                     f'queries, {len(records)} returned')
+    return records
 
 
 def approve_order_from_status(order, approval_status):
-    if approval_status == 'approved':
-        approve_order(order)
-    elif approval_status == 'rejected':
-        reject_order(order)
-    elif approval_status == 'cancelled':
-        cancel_order(order)
-    else:
+    """
+    Approve, reject or cancel an order to match its ServiceNow request. The
+    recurring job and the webhook can act on the same order at once, so the
+    order is locked and re-read first, and left alone unless it is still
+    PENDING, otherwise it could be approved (and its Jobs created) twice.
+    """
+    if approval_status not in ['approved', 'rejected', 'cancelled']:
         set_progress(
             f"&nbsp;&nbsp;&nbsp;&nbsp;Order was not approved in "
             f"ServiceNow:Order ID: {order.id} --> state: "
             f"{approval_status}")
+        return
+    error = None
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(id=order.id)
+        if order.status != 'PENDING':
+            set_progress(f"&nbsp;&nbsp;&nbsp;&nbsp;Order {order.id} is "
+                         f"already {order.status}, skipping")
+            return
+        if approval_status == 'approved':
+            try:
+                approve_order(order)
+            except CloudBoltException as e:
+                # Raised after the order is marked FAILURE, which should be
+                # committed rather than rolled back with the transaction
+                error = e
+        elif approval_status == 'rejected':
+            reject_order(order)
+        else:
+            cancel_order(order)
+    if error:
+        raise error
 
 
 def reject_order(order):
@@ -263,67 +431,3 @@ def approve_order(order):
     msg = 'order complete'
     set_progress(f"&nbsp;&nbsp;&nbsp;&nbsp;Order approved: {order.id}")
     return jobs, msg
-
-
-def lookup_ci(table_name=None, ci_name=None, ci_value=None, ci_query=None,
-              base_url=None, return_ci='sys_id', sysparm_query=True,
-              conn=None):
-    '''
-        ex.
-        table_name = 'ci_cmdb_server'
-        ci_name = 'asset_tag'
-        ci_value = '421e19fe-5920-4ae9-75be-4646430d6772'
-        return_ci = (str) or (list) (str for 1 value, list for multiple values)
-                    ex. 'sys_id' or ['sys_id', 'email']
-        Query servicenow with a table, and looks for a CI that has
-        the field(ci_name) with the value(ci_value) and returns the sys_id for that
-        CI.
-
-        Optionally, you can pass multiple filters in the ci_query parameter as a
-            dictionary...
-
-            i.e. {'column1': 'column_value', 'column2': 'some other value'}
-            ...if there is more than one filter field to query with
-
-        If it doesn't find a record that matches the filter passed in,
-           it returns None
-    '''
-    ci_value_data = None
-    if ci_query:
-        query = urlencode(ci_query)
-    else:
-        prefix = "sysparm_query"
-        if not sysparm_query:
-            query = urlencode({ci_name: ci_value})
-        else:
-            query = urlencode({prefix: f"{ci_name}={ci_value}"})
-
-    url = base_url + f"/api/now/table/{table_name}?{query}"
-    # print(f'lookup_ci - url: {url}')
-    response = requests.get(
-        url=url,
-        auth=(conn.service_account, conn.password),
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        },
-        timeout=5.0
-    )
-    # set_progress(f'response = {response.text}')
-
-    try:
-        # if a list of values are sent for return, then populate a dictionary
-        if isinstance(return_ci, list):
-            ci_value_data = {}
-            for item in return_ci:
-                ci_value_data[item] = response.json()["result"][0][item]
-        else:
-            if return_ci == "*":
-                # return everything we got back
-                ci_value_data = response.json()["result"][0]
-            else:
-                ci_value_data = response.json()["result"][0][return_ci]
-    except Exception:
-        pass
-
-    return ci_value_data
@@ -1,66 +1,18 @@
 """
 Get Options Action for App ID
-"""
-from urllib.parse import urlencode
-
-from api.api_samples.python_client.ext import requests
-from common.methods import set_progress
-from itsm.servicenow.models import ServiceNowITSM
-import json
-
-
-def get_options_list(field, **kwargs):
-    options = [('', '--- Select an App ID ---')]
-    snowitsm = ServiceNowITSM.objects.first()
-    wrapper = snowitsm.get_api_wrapper()
-    base_url = wrapper.service_now_instance_url.replace("/login.do", "")
-    req_for_data = lookup_ci(table_name='cmdb_ci_appl',
-                             base_url=base_url,
-                             conn=snowitsm,
-                             sysparm_fields=[
-                                 'name',
-                                 'u_application_id',
-                                 'u_systemid',
-                                 'install_status',
-                                 'owned_by',
-                                 'support_group',
-                                 'u_priority',
-                                 'version',
-                                 'operational_status',
-                                 'sys_created_on',
-                             ]
-                             )
-    response_json = json.loads(req_for_data)
-    results = response_json["result"]
-    for result in results:
-        if result["support_group"]:
-            support_group = result["support_group"]["display_value"]
-            result["support_group"] = support_group
-        if result["owned_by"]:
-            support_group = result["owned_by"]["display_value"]
-            result["owned_by"] = support_group
-        options.append((json.dumps(result), result["name"]))
-    return options
 
+Type-ahead over the App IDs in the ServiceNow CMDB (cmdb_ci_appl). Options
+are served from a local snapshot of the table, see
+shared_modules/servicenow_cmdb.py. The value of each option is the App's
+sys_id, write_params_from_table_query.py looks up the full record once the
+server has been built.
+"""
+from shared_modules.servicenow_cmdb import get_app_id_provider
 
-def lookup_ci(table_name=None, base_url=None, conn=None,
-              sysparm_fields: list = None, url=None):
-    if not url:
-        query = ''
-        if sysparm_fields:
-            query = urlencode({'sysparm_display_value': 'true',
-                               'sysparm_fields': ",".join(sysparm_fields)})
 
-        url = base_url + f"/api/now/table/{table_name}?{query}"
+def suggest_options(custom_field, query, **kwargs):
+    return get_app_id_provider().suggest_options(query)
 
-    response = requests.get(
-        url=url,
-        auth=(conn.service_account, conn.password),
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        },
-        timeout=5.0
-    )
 
-    return response.content
+def get_options_list(*args, **kwargs):
+    return None
@@ -1,17 +1,15 @@
 """
 Get Options Action for App ID
+
+Type-ahead over the snapshot of cmdb_ci_appl kept by app_id_query.py, see
+shared_modules/servicenow_cmdb.py. Retired applications are not offered.
 """
-from common.methods import set_progress
-import json
+from shared_modules.servicenow_cmdb import get_app_id_provider, is_retired
+
 
+def suggest_options(custom_field, query, **kwargs):
+    return get_app_id_provider().suggest_options(query, exclude=is_retired)
 
-def get_options_list(field, **kwargs):
-    options = [('', '--- Select an App ID ---')]
-    file_path = '/var/opt/cloudbolt/proserv/service_now/app_ids.json'
-    with open(file_path, 'r') as f:
-        content = f.read()
-        results = json.loads(content)
-        for result in results:
-            options.append((json.dumps(result), result["u_application_id"]))
 
-    return options
+def get_options_list(*args, **kwargs):
+    return None
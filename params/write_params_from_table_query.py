@@ -1,5 +1,6 @@
 from common.methods import set_progress
 from infrastructure.models import CustomField
+from shared_modules.servicenow_cmdb import get_app_id_provider
 from utilities.logger import ThreadLogger
 import json
 
@@ -15,8 +16,28 @@ def run(job, **kwargs):
     return "SUCCESS", "", ""
 
 
+def get_tags(tags_string):
+    """
+    The tags parameter holds the sys_id of the selected App ID, look up its
+    record. Servers ordered before that hold the record itself as JSON.
+    """
+    try:
+        tags_json = json.loads(tags_string)
+    except ValueError:
+        tags_json = None
+    if isinstance(tags_json, dict):
+        return tags_json
+    tags_json = get_app_id_provider().get_row(tags_string)
+    if tags_json is None:
+        logger.warning(f'App ID {tags_string} not found in ServiceNow')
+        return {}
+    tags_json = dict(tags_json)
+    tags_json.pop('sys_id', None)
+    return tags_json
+
+
 def create_tags(tags_string, server):
-    tags_json = json.loads(tags_string)
+    tags_json = get_tags(tags_string)
     for key in tags_json.keys():
         param_name = f'tags_{key}'
         param_value = tags_json[key]
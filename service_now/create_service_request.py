@@ -5,7 +5,6 @@ hook point
 """
 
 import json
-import requests
 from django.contrib.auth.models import User
 from django.db.models.query import QuerySet
 
@@ -15,8 +14,8 @@ from itsm.servicenow.models.servicenow_itsm import ServiceNowITSM
 from jobs.models import Job
 from orders.models import get_current_time, ActionJobOrderItem, \
     BlueprintOrderItem, ServerModOrderItem, ProvisionServerOrderItem
+from shared_modules.servicenow import get_table_client
 from utilities.logger import ThreadLogger
-from urllib.parse import urlencode
 
 logger = ThreadLogger("Service Now Order Submit")
 
@@ -43,7 +42,7 @@ def run(order, *args, **kwargs):
     wrapper = snowitsm.get_api_wrapper()
     base_url = wrapper.service_now_instance_url.replace("/login.do", "")
     sysid_for_req_by, sysid_for_req_for = get_sysid_for_users(snowitsm,
-                                                              base_url, order)
+                                                              order)
 
     # CloudBolt can either have a single Blueprint Order Item submitted in a
     # single order, or one (or more) Server Mod Order Items - these need to be
@@ -61,70 +60,6 @@ def run(order, *args, **kwargs):
     return result
 
 
-def lookup_ci(table_name=None, ci_name=None, ci_value=None, ci_query=None,
-              base_url=None, return_ci='sys_id', sysparm_query=True,
-              conn=None):
-    '''
-        ex.
-        table_name = 'ci_cmdb_server'
-        ci_name = 'asset_tag'
-        ci_value = '421e19fe-5920-4ae9-75be-4646430d6772'
-        return_ci = (str) or (list) (str for 1 value, list for multiple values)
-                    ex. 'sys_id' or ['sys_id', 'email']
-        Query servicenow with a table, and looks for a CI that has
-        the field(ci_name) with the value(ci_value) and returns the sys_id for that
-        CI.
-
-        Optionally, you can pass multiple filters in the ci_query parameter as a
-            dictionary...
-
-            i.e. {'column1': 'column_value', 'column2': 'some other value'}
-            ...if there is more than one filter field to query with
-
-        If it doesn't find a record that matches the filter passed in,
-           it returns None
-    '''
-    ci_value_data = None
-    if ci_query:
-        query = urlencode(ci_query)
-    else:
-        prefix = "sysparm_query"
-        if not sysparm_query:
-            query = urlencode({ci_name: ci_value})
-        else:
-            query = urlencode({prefix: f"{ci_name}={ci_value}"})
-
-    url = base_url + f"/api/now/table/{table_name}?{query}"
-    # print(f'lookup_ci - url: {url}')
-    response = requests.get(
-        url=url,
-        auth=(conn.service_account, conn.password),
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        },
-        timeout=5.0
-    )
-    # print(f'response = {response.text}')
-
-    try:
-        # if a list of values are sent for return, then populate a dictionary
-        if isinstance(return_ci, list):
-            ci_value_data = {}
-            for item in return_ci:
-                ci_value_data[item] = response.json()["result"][0][item]
-        else:
-            if return_ci == "*":
-                # return everything we got back
-                ci_value_data = response.json()["result"][0]
-            else:
-                ci_value_data = response.json()["result"][0][return_ci]
-    except Exception:
-        pass
-
-    return ci_value_data
-
-
 def get_order_items(order):
     bpoi, smois = None, None
     bpoi = get_bp_order_item(order)
@@ -253,44 +188,41 @@ def get_clean_custom_field_values(bpia):
     return custom_fields
 
 
-def get_sysid_for_users(snowitsm, base_url, order):
+def get_sysid_for_users(snowitsm, order):
     # Requested By
     requested_by = order.owner.user
-    sysid_for_req_by = sysid_username_then_email(requested_by, base_url,
-                                                 snowitsm, order)
+    sysid_for_req_by = sysid_username_then_email(requested_by, snowitsm,
+                                                 order)
     # Requested For
     sysid_for_req_for = sysid_for_req_by
     if order.recipient:
         recipient = order.recipient.user
-        sysid_for_req_for = sysid_username_then_email(recipient, base_url,
-                                                      snowitsm, order)
+        sysid_for_req_for = sysid_username_then_email(recipient, snowitsm,
+                                                      order)
     return sysid_for_req_by, sysid_for_req_for
 
 
-def sysid_username_then_email(user, base_url, snowitsm, order):
+def sysid_username_then_email(user, snowitsm, order):
     """
     Try to get the sysid for the CloudBolt user first by username, if that
     doesn't work try email.
     """
     user_name = user.username
     try:
-        sysid = get_snow_user_sys_id(user_name, base_url, snowitsm, order)
+        sysid = get_snow_user_sys_id(user_name, snowitsm, order)
     except Exception as e:
         if str(e).find('Unable to find data matching order owner') == 0:
             # If user can't be found using username, try email
             user_name = user.email
-            sysid = get_snow_user_sys_id(user_name, base_url, snowitsm, order)
+            sysid = get_snow_user_sys_id(user_name, snowitsm, order)
         else:
             raise
     return sysid
 
 
-def get_snow_user_sys_id(user_name, base_url, snowitsm, order):
-    snow_user_data = lookup_ci(table_name='sys_user',
-                               ci_query={'user_name': user_name},
-                               base_url=base_url,
-                               return_ci=['sys_id'],
-                               conn=snowitsm)
+def get_snow_user_sys_id(user_name, snowitsm, order):
+    snow_user_data = get_table_client(snowitsm).get_record(
+        'sys_user', query={'user_name': user_name}, fields=['sys_id'])
     if not snow_user_data:
         err = 'Unable to find data matching order owner in ServiceNow. '
         err += f'requested_by: {user_name} --> order: {order.id}'
@@ -11,14 +11,41 @@ To connect to vRA for vRA API Calls:
 To connect to a vRO instance for vRO API Calls:
     vro = AriaOrchestratorConnection(CONN_INFO_ID)
     workflows = vra.list_workflows()
+To run a workflow across many VMs and handle each result as it finishes:
+    vro = AriaOrchestratorConnection(CONN_INFO_ID)
+    runs = [(workflow_id, {"vmName": name}) for name in vm_names]
+    for result in vro.execute_workflows(runs):
+        set_progress(f'{result["execution_id"]}: {result["state"]}')
+To resolve many VMs by instanceUUID with a single sweep of vRA:
+    vra = AriaAutomationConnection(CONN_INFO_ID)
+    vra.build_instance_uuid_index(path="/var/tmp/aria_uuid_index.json")
+    resource = vra.get_resource_from_instance_uuid(instance_uuid, vm_name)
+
+Connections built for the same ConnectionInfo share a single pooled
+requests.Session (keep-alive) and a process-wide cached auth token, so
+building many connection objects does not re-login or re-handshake. Use
+get_connection_stats(CONN_INFO_ID) to see how many logins and TCP/TLS
+handshakes were avoided.
 """
+import base64
+import heapq
 import json
+import os
+import re
 import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from urllib.parse import urlencode
 
 import requests
 import yaml
 from django.db.models import Q
+from requests.adapters import HTTPAdapter
+
+try:
+    from eventlet.green import threading  # CB 7.7 and up
+except ImportError:
+    import threading  # CB 7.6 and earlier
 
 from common.methods import set_progress
 from utilities.logger import ThreadLogger
@@ -28,6 +55,54 @@ logger = ThreadLogger(__name__)
 
 VERIFY_CERTS = False
 
+# Size of the keep-alive pool kept per ConnectionInfo. This should be at least
+# as large as the number of threads making concurrent calls to one vRA/vRO.
+POOL_MAXSIZE = 32
+# Refresh the cached token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 120
+# Lifetime assumed for tokens that do not carry a readable expiry (seconds)
+DEFAULT_TOKEN_TTL = 25 * 60
+
+# Default $top used when paging through list endpoints
+PAGE_SIZE = 200
+# Fields requested when only deployment ids are needed
+DEPLOYMENT_ID_FIELDS = "id,blueprintId"
+
+# Terminal states of a vRO workflow execution
+WORKFLOW_DONE_STATES = ["completed", "failed", "canceled"]
+# State execute_workflows reports for an execution that could not be started,
+# or whose state could not be read from vRO before the timeout. Unlike
+# "failed", the workflow may still be running in vRO.
+WORKFLOW_ERROR_STATE = "error"
+# Maximum number of vRO workflow executions in flight for execute_workflows
+WORKFLOW_CONCURRENCY = 16
+
+# Seconds vRO catalog listings are cached for by list_objects_for_type
+CATALOG_CACHE_TTL = 60
+# Most vRO catalog listings kept in the cache, least recently used first out
+CATALOG_CACHE_MAX_ENTRIES = 64
+# maxResult used when paging through vRO catalog listings
+CATALOG_PAGE_SIZE = 200
+
+# Seconds a workflow's input schema is cached for by format_params
+WORKFLOW_SCHEMA_TTL = 300
+
+# Process-wide state shared by every connection object, keyed on conn_info_id
+_SESSIONS = {}
+_TOKENS = {}
+_STATS = {}
+_CONN_LOCKS = {}
+_REGISTRY_LOCK = threading.Lock()
+# (conn_info_id, workflow_id) -> (expiry, {input name: (type, converter)})
+_WORKFLOW_INPUTS = {}
+# (conn_info_id, object_type, attributes, query) -> (expiry, objects), in
+# least recently used order
+_CATALOG_CACHE = OrderedDict()
+_CATALOG_CACHE_LOCK = threading.Lock()
+_QUERY_RE = re.compile(
+    r"^\s*([\w.]+)\s+(eq|contains|like)\s+'?(.*?)'?\s*$", re.IGNORECASE
+)
+
 
 def generate_options_for_aria_projects(field, control_value=None, **kwargs):
     if not control_value:
@@ -42,12 +117,225 @@ def generate_options_for_aria_connection(field, **kwargs):
     return [(ci.id, ci.name) for ci in cis]
 
 
+def _string_value(value):
+    return {"string": {"value": value}}
+
+
+def _number_value(value):
+    return {"number": {"value": int(value)}}
+
+
+def _boolean_value(value):
+    return {"boolean": {"value": bool(value)}}
+
+
+def _properties_value(input_value):
+    """
+    Creates a properties value for a workflow input. The input_value
+    should be a dict of the form:
+    {
+        "key": "value",
+        "key2": "value2"
+    }
+    """
+    value_dict = {"properties": {"property": []}}
+    for key, value in input_value.items():
+        if type(value) == dict:
+            value = json.dumps(value)
+        value = {"string": {"value": value}}
+        value_dict["properties"]["property"].append(
+            {"key": key, "value": value}
+        )
+    return value_dict
+
+
+_SCALAR_CONVERTERS = {
+    "string": _string_value,
+    "number": _number_value,
+    "boolean": _boolean_value,
+    "Properties": _properties_value,
+}
+_PARAM_CONVERTERS = {}
+
+
+def get_param_converter(param_type):
+    """
+    Returns the function that formats a value for a vRO workflow input of
+    param_type, or None if the type isn't supported. Converters are built once
+    per type, Array/<type> converters wrap the converter of the element type.
+    :param param_type: ex. string, Array/string, Properties
+    :return:
+    """
+    if param_type in _PARAM_CONVERTERS:
+        return _PARAM_CONVERTERS[param_type]
+    converter = _SCALAR_CONVERTERS.get(param_type)
+    if converter is None and param_type.startswith("Array/"):
+        element_converter = _SCALAR_CONVERTERS.get(param_type.split("/")[1])
+        if element_converter is not None:
+            def converter(input_value, element_converter=element_converter):
+                if type(input_value) is not list:
+                    input_value = [input_value]
+                return {"array": {"elements": [
+                    element_converter(element) for element in input_value
+                ]}}
+    _PARAM_CONVERTERS[param_type] = converter
+    return converter
+
+
+def clear_workflow_input_cache():
+    """
+    Drops all cached vRO workflow input schemas
+    """
+    _WORKFLOW_INPUTS.clear()
+
+
+def cache_catalog_listing(key, objects):
+    """
+    Stores a listing in _CATALOG_CACHE, dropping expired listings and then the
+    least recently used ones once there are more than
+    CATALOG_CACHE_MAX_ENTRIES
+    """
+    now = time.time()
+    with _CATALOG_CACHE_LOCK:
+        _CATALOG_CACHE[key] = (now + CATALOG_CACHE_TTL, objects)
+        _CATALOG_CACHE.move_to_end(key)
+        for expired in [k for k, (expiry, _) in _CATALOG_CACHE.items()
+                        if expiry <= now]:
+            del _CATALOG_CACHE[expired]
+        while len(_CATALOG_CACHE) > CATALOG_CACHE_MAX_ENTRIES:
+            _CATALOG_CACHE.popitem(last=False)
+
+
+def _get_conn_lock(conn_info_id):
+    """
+    Returns the lock guarding the session and token for a conn_info_id
+    """
+    with _REGISTRY_LOCK:
+        lock = _CONN_LOCKS.get(conn_info_id)
+        if lock is None:
+            lock = threading.RLock()
+            _CONN_LOCKS[conn_info_id] = lock
+            _STATS[conn_info_id] = {"requests": 0, "logins": 0,
+                                    "token_cache_hits": 0,
+                                    "unauthorized_retries": 0}
+        return lock
+
+
+def _increment_stat(conn_info_id, stat, amount=1):
+    with _get_conn_lock(conn_info_id):
+        _STATS[conn_info_id][stat] += amount
+
+
+def get_shared_session(conn_info_id):
+    """
+    Returns the pooled requests.Session shared by all connections for the
+    conn_info_id, creating it on first use
+    :param conn_info_id:
+    :return: requests.Session
+    """
+    with _get_conn_lock(conn_info_id):
+        session = _SESSIONS.get(conn_info_id)
+        if session is None:
+            session = requests.Session()
+            session.verify = VERIFY_CERTS
+            adapter = HTTPAdapter(pool_connections=4,
+                                  pool_maxsize=POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSIONS[conn_info_id] = session
+        return session
+
+
+def get_token_expiry(token):
+    """
+    Returns the expiry (epoch seconds) of a CSP token. CSP tokens are JWTs, so
+    the exp claim is read from the payload. Falls back to DEFAULT_TOKEN_TTL
+    from now if the token can't be decoded.
+    :param token:
+    :return:
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return float(claims["exp"])
+    except Exception:
+        return time.time() + DEFAULT_TOKEN_TTL
+
+
+def invalidate_token(conn_info_id, token=None):
+    """
+    Drops the cached token for the conn_info_id so the next call re-logs in
+    :param conn_info_id:
+    :param token: if passed, the token that was rejected. The cached token is
+        only dropped if it is still that token, so a token another thread has
+        just fetched is kept and reused.
+    :return:
+    """
+    with _get_conn_lock(conn_info_id):
+        cached = _TOKENS.get(conn_info_id)
+        if cached and (token is None or cached[0] == token):
+            del _TOKENS[conn_info_id]
+
+
+def get_connection_stats(conn_info_id):
+    """
+    Returns counters for the shared session of a conn_info_id:
+        requests: API calls submitted (logins excluded)
+        logins: Calls made to the CSP login endpoint
+        token_cache_hits: Token lookups served from the cache
+        unauthorized_retries: Calls retried after a 401
+        connections_opened: New TCP/TLS connections opened by the pool
+        handshakes_avoided: Calls that reused a pooled connection
+    :param conn_info_id:
+    :return: dict
+    """
+    with _get_conn_lock(conn_info_id):
+        stats = dict(_STATS[conn_info_id])
+        session = _SESSIONS.get(conn_info_id)
+        opened = 0
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    opened += getattr(pools[key], "num_connections", 0)
+    stats["connections_opened"] = opened
+    total_calls = stats["requests"] + stats["logins"]
+    stats["handshakes_avoided"] = max(total_calls - opened, 0)
+    return stats
+
+
 class AriaAutomationConnection(object):
     def __init__(self, conn_info_id):
         self.conn_info_id = conn_info_id
         self.conn_info = self.get_connection_info()
         self.base_url = self.get_base_url()
+        # base_url is extended by subclasses, the login url always lives at
+        # the root of the host
+        self.host_url = self.base_url
+        self.session = get_shared_session(conn_info_id)
         self.headers = self.get_headers()
+        self.instance_uuid_index = None
+
+    def build_instance_uuid_index(self, path=None, refresh=True):
+        """
+        Builds (or loads and refreshes) an InstanceUUIDIndex and uses it for
+        the *_from_instance_uuid lookups on this connection
+        :param path: Optional JSON file to persist the index to
+        :param refresh: If False, a persisted index is used as-is
+        :return: InstanceUUIDIndex
+        """
+        index = InstanceUUIDIndex(self, path)
+        if path and os.path.exists(path):
+            index.load()
+            if refresh:
+                index.refresh()
+        else:
+            index.refresh(full=True)
+        if path:
+            index.save()
+        self.instance_uuid_index = index
+        return index
 
     def get_vm_from_instance_uuid(self, instance_uuid):
         """
@@ -55,6 +343,10 @@ class AriaAutomationConnection(object):
         :param instance_uuid:
         :return:
         """
+        if self.instance_uuid_index is not None:
+            machine = self.instance_uuid_index.get_machine(instance_uuid)
+            if machine:
+                return machine
         url = (f"/iaas/api/machines?$filter="
                f"customProperties.instanceUUID%20eq%20'{instance_uuid}'")
         response_json = self.submit_request(url)
@@ -101,17 +393,19 @@ class AriaAutomationConnection(object):
         used in a generated_options_for field
         :return:
         """
-        results = 200
-        skip = 0
-        found_results = 200
-        options = []
-        while found_results != 0:
-            projects = self.list_projects({"$top": results, "$skip": skip})
-            for project in projects["content"]:
-                options.append((project["id"], project["name"]))
-            skip = skip + results
-            found_results = projects["numberOfElements"]
-        return options
+        return [(project["id"], project["name"])
+                for project in self.iter_projects()]
+
+    def iter_projects(self, query_params=None, prefetch=False):
+        """
+        Yields every project, paging through the results. The query_params
+        dict can be used to filter the results.
+        :param query_params:
+        :param prefetch: Fetch the next page while the current one is consumed
+        :return:
+        """
+        return self.iter_items('/iaas/api/projects', query_params,
+                               prefetch=prefetch)
 
     def list_resources(self, query_params=None):
         """
@@ -127,6 +421,17 @@ class AriaAutomationConnection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_resources(self, query_params=None, prefetch=False):
+        """
+        Yields every resource, paging through the results. The query_params
+        dict can be used to filter the results.
+        :param query_params:
+        :param prefetch: Fetch the next page while the current one is consumed
+        :return:
+        """
+        return self.iter_items('/deployment/api/resources', query_params,
+                               prefetch=prefetch)
+
     def get_resource(self, resource_id):
         """
         Returns the resource object for the provided resource_id
@@ -144,6 +449,10 @@ class AriaAutomationConnection(object):
         :param vm_name:
         :return:
         """
+        if self.instance_uuid_index is not None:
+            resource = self.instance_uuid_index.get_resource(instance_uuid)
+            if resource:
+                return resource
         response_json = self.list_resources({"search": vm_name})
         for resource in response_json["content"]:
             try:
@@ -172,29 +481,79 @@ class AriaAutomationConnection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_deployments(self, query_params=None, prefetch=False):
+        """
+        Yields every deployment, paging through the results. Like
+        list_deployments, only CREATE_SUCCESSFUL deployments are returned
+        unless a status is passed in the query_params.
+        :param query_params:
+        :param prefetch: Fetch the next page while the current one is consumed
+        :return:
+        """
+        query_params = dict(query_params or {})
+        if not query_params.get("status", None):
+            query_params["status"] = "CREATE_SUCCESSFUL"
+        return self.iter_items('/deployment/api/deployments', query_params,
+                               prefetch=prefetch)
+
     def list_deployment_ids_for_blueprint(self, blueprint_id, project_ids=None):
         """
         Returns a list of deployment_ids for a given blueprint_id. If a
         project_id is provided, only deployments for that project will be
         returned.
+
+        The blueprint filter and an id-only $select projection are pushed down
+        to the API. If the API rejects them, the call falls back to a
+        projected scan and then to a plain scan, filtering client-side. Any
+        filter the API silently ignores is still enforced client-side. The
+        number of deployments transferred vs matched is logged and stored in
+        self.last_deployment_scan.
         """
         if project_ids is None:
             project_ids = []
-        results = 200
-        skip = 0
-        found_results = 200
+        params = {"status": "CREATE_SUCCESSFUL"}
+        if project_ids:  # Only get deployments for this project
+            params["projects"] = ','.join(project_ids)
+        pushdowns = [
+            {"$filter": f"blueprintId eq '{blueprint_id}'",
+             "$select": DEPLOYMENT_ID_FIELDS},
+            {"$select": DEPLOYMENT_ID_FIELDS},
+            {},
+        ]
+        for pushdown in pushdowns:
+            query_params = dict(params)
+            query_params.update(pushdown)
+            try:
+                return self.scan_deployment_ids(blueprint_id, query_params)
+            except requests.HTTPError as e:
+                status_code = getattr(e.response, "status_code", None)
+                if status_code != 400 or not pushdown:
+                    raise
+                logger.info(f'Deployment API rejected {list(pushdown)}, '
+                            f'falling back to a simpler scan')
+
+    def scan_deployment_ids(self, blueprint_id, query_params):
+        """
+        Pages through the deployments matching query_params and returns the
+        ids of those built from blueprint_id
+        :param blueprint_id:
+        :param query_params:
+        :return:
+        """
         deployment_ids = []
-        while found_results != 0:
-            params = {"$top": results, "$skip": skip,
-                      "status": "CREATE_SUCCESSFUL"}
-            if project_ids:  # Only get deployments for this project
-                params["projects"] = ','.join(project_ids)
-            deployments = self.list_deployments(params)
-            for deployment in deployments["content"]:
-                if deployment["blueprintId"] == blueprint_id:
-                    deployment_ids.append(deployment["id"])
-            skip = skip + results
-            found_results = deployments["numberOfElements"]
+        transferred = 0
+        for deployment in self.iter_deployments(query_params, prefetch=True):
+            transferred += 1
+            if deployment.get("blueprintId") == blueprint_id:
+                deployment_ids.append(deployment["id"])
+        self.last_deployment_scan = {
+            "transferred": transferred,
+            "matched": len(deployment_ids),
+            "query_params": query_params,
+        }
+        logger.info(f'Deployment scan for blueprint: {blueprint_id} '
+                    f'transferred {transferred} deployments, matched '
+                    f'{len(deployment_ids)}')
         return deployment_ids
 
     def get_deployment(self, deployment_id):
@@ -249,6 +608,17 @@ class AriaAutomationConnection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_blueprints(self, query_params=None, prefetch=False):
+        """
+        Yields every blueprint, paging through the results. The query_params
+        dict can be used to filter the results.
+        :param query_params:
+        :param prefetch: Fetch the next page while the current one is consumed
+        :return:
+        """
+        return self.iter_items('/blueprint/api/blueprints', query_params,
+                               prefetch=prefetch)
+
     def get_blueprint(self, blueprint_id):
         """
         Returns the blueprint object for the provided blueprint_id
@@ -331,6 +701,17 @@ class AriaAutomationConnection(object):
         response_json = self.submit_request(url)
         return response_json
 
+    def iter_iaas_machines(self, query_params=None, prefetch=False):
+        """
+        Yields every IaaS machine, paging through the results. The
+        query_params dict can be used to filter the results.
+        :param query_params:
+        :param prefetch: Fetch the next page while the current one is consumed
+        :return:
+        """
+        return self.iter_items('/iaas/api/machines', query_params,
+                               prefetch=prefetch)
+
     def get_iaas_machine(self, machine_id):
         """
         Returns the IaaS machine object for the provided machine_id
@@ -347,6 +728,10 @@ class AriaAutomationConnection(object):
         :param instance_uuid:
         :return:
         """
+        if self.instance_uuid_index is not None:
+            machine = self.instance_uuid_index.get_machine(instance_uuid)
+            if machine:
+                return machine
         response_json = self.list_iaas_machines(
             {"$filter": f'customProperties.instanceUUID eq {instance_uuid}'}
         )
@@ -355,6 +740,85 @@ class AriaAutomationConnection(object):
                             f' for instance_uuid: {instance_uuid}')
         return response_json["content"][0]
 
+    def iter_pages(self, url_path, query_params=None, page_size=PAGE_SIZE,
+                   prefetch=False):
+        """
+        Yields each page (the raw response dict) of a $top/$skip paginated
+        list endpoint. Paging stops on the last page as reported by the API
+        (last/totalElements), so no extra empty page is requested. When
+        prefetch is True the next page is requested in the background while
+        the caller works through the current one.
+        :param url_path: ex. /deployment/api/deployments
+        :param query_params: Additional filters for the call
+        :param page_size: The $top to request for each page
+        :param prefetch: Fetch the next page while the current one is consumed
+        :return:
+        """
+        query_params = dict(query_params or {})
+
+        def get_page(skip):
+            params = dict(query_params)
+            params.update({"$top": page_size, "$skip": skip})
+            return self.submit_request(
+                self.add_query_params_to_url(url_path, params)
+            )
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            skip = 0
+            page = get_page(skip)
+            while True:
+                last_page = self.is_last_page(page, skip, page_size)
+                next_page = None
+                if executor and not last_page:
+                    next_page = executor.submit(get_page, skip + page_size)
+                yield page
+                if last_page:
+                    break
+                skip += page_size
+                if next_page:
+                    page = next_page.result()
+                else:
+                    page = get_page(skip)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def iter_items(self, url_path, query_params=None, page_size=PAGE_SIZE,
+                   prefetch=False):
+        """
+        Yields the items in the content of every page of a paginated list
+        endpoint. See iter_pages.
+        :param url_path:
+        :param query_params:
+        :param page_size:
+        :param prefetch:
+        :return:
+        """
+        for page in self.iter_pages(url_path, query_params, page_size,
+                                    prefetch):
+            for item in page.get("content", []):
+                yield item
+
+    @staticmethod
+    def is_last_page(page, skip, page_size):
+        """
+        Returns True if the page is the final page of the results
+        :param page: The response dict for the page
+        :param skip: The $skip used to request the page
+        :param page_size: The $top used to request the page
+        :return:
+        """
+        if page.get("last") is True:
+            return True
+        found = page.get("numberOfElements", len(page.get("content", [])))
+        if found == 0:
+            return True
+        total = page.get("totalElements")
+        if total is not None:
+            return skip + found >= total
+        return found < page_size
+
     def add_query_params_to_url(self, url, query_params: dict):
         """
         Adds the provided query_params to the provided url
@@ -373,10 +837,26 @@ class AriaAutomationConnection(object):
         """
         headers = {'Content-Type': 'application/json',
                    'Accept': 'application/json'}
-        token = self.get_token(headers)
+        token = self.get_cached_token(headers)
         headers['Authorization'] = f'Bearer {token}'
         return headers
 
+    def get_cached_token(self, headers):
+        """
+        Returns the process-wide cached token for this ConnectionInfo, logging
+        in again when there is no token or it is about to expire
+        :param headers:
+        :return:
+        """
+        with _get_conn_lock(self.conn_info_id):
+            cached = _TOKENS.get(self.conn_info_id)
+            if cached and cached[1] - TOKEN_REFRESH_MARGIN > time.time():
+                _STATS[self.conn_info_id]["token_cache_hits"] += 1
+                return cached[0]
+            token = self.get_token(headers)
+            _TOKENS[self.conn_info_id] = (token, get_token_expiry(token))
+            return token
+
     def get_base_url(self):
         """
         Returns the base url to be used for API calls
@@ -419,8 +899,7 @@ class AriaAutomationConnection(object):
         :return:
         """
         conn = self.conn_info
-        base_url = self.base_url
-        url = f'{base_url}/csp/gateway/am/api/login'
+        url = f'{self.host_url}/csp/gateway/am/api/login'
         username = conn.username.split('@')[0]
         password = conn.password
         if conn.username.find('@') != -1:
@@ -430,8 +909,9 @@ class AriaAutomationConnection(object):
         data = {"username": username, "password": password}
         if domain:
             data["domain"] = domain
-        response = requests.post(url, headers=headers, verify=VERIFY_CERTS,
-                                 json=data)
+        response = self.session.post(url, headers=headers,
+                                     verify=VERIFY_CERTS, json=data)
+        _increment_stat(self.conn_info_id, "logins")
         response.raise_for_status()
         return response.json()['cspAuthToken']
 
@@ -444,17 +924,20 @@ class AriaAutomationConnection(object):
         :param kwargs:
         :return:
         """
-        headers = self.headers
         base_url = self.base_url
         url = f'{base_url}{url_path}'
-        if method == "get":
-            response = requests.get(url, headers=headers,
-                                    verify=VERIFY_CERTS)
-        elif method == 'post':
-            response = requests.post(url, headers=headers,
-                                     verify=VERIFY_CERTS, **kwargs)
-        else:
+        if method not in ["get", "post"]:
             raise Exception(f"Method: {method} not supported")
+        response = self._send(method, url, **kwargs)
+        if response.status_code == 401:
+            # The cached token was revoked or expired early, log in again (or
+            # pick up the token another thread already logged in for) and
+            # retry the call once
+            logger.info(f'Received 401 for URL: {url}, refreshing token')
+            failed_token = self.headers['Authorization'].split(' ', 1)[1]
+            invalidate_token(self.conn_info_id, failed_token)
+            _increment_stat(self.conn_info_id, "unauthorized_retries")
+            response = self._send(method, url, **kwargs)
         try:
             response.raise_for_status()
         except Exception as e:
@@ -463,6 +946,19 @@ class AriaAutomationConnection(object):
             raise
         return response.json()
 
+    def _send(self, method, url, **kwargs):
+        """
+        Sends a single call over the shared session using the current token
+        :param method:
+        :param url:
+        :param kwargs:
+        :return: requests.Response
+        """
+        self.headers = self.get_headers()
+        _increment_stat(self.conn_info_id, "requests")
+        return self.session.request(method, url, headers=self.headers,
+                                    verify=VERIFY_CERTS, **kwargs)
+
 
 class AriaOrchestratorConnection(AriaAutomationConnection):
     def __init__(self, conn_info_id):
@@ -533,37 +1029,55 @@ class AriaOrchestratorConnection(AriaAutomationConnection):
             type: The type of the parameter (string, number, boolean, etc)
             value: value to pass ex: {"string": {"value": "My Value"}}
             scope: The scope of the parameter (local, shared, etc)
+        The workflow input schema is cached for WORKFLOW_SCHEMA_TTL seconds,
+        so repeated executions of a workflow don't re-fetch it.
         """
         output_params = []
-        workflow = self.get_workflow(workflow_id)
-        input_params = workflow["input-parameters"]
-        supported_types = ["string", "number", "boolean", "Array/string",
-                           "Array/number", "Array/boolean", "Array/Properties",
-                           "Properties"]
+        input_params = self.get_cached_workflow_inputs(workflow_id)
 
         for key, value in parameters.items():
-            key_found = False
             if type(value) is dict:
                 if self.check_valid_value_dict(value):
                     output_params.append(value)
                     continue
-            for param in input_params:
-                if param["name"] == key:
-                    param_type = param["type"]
-                    if param_type not in supported_types:
-                        raise Exception(f"Type: {param['type']} inputs are not"
-                                        f" supported for vRO Workflow")
-                    value = self.construct_param_value(param_type, value)
-                    logger.debug(f"param_type: {param_type}, value: {value}")
-                    param_dict = {"name": key, "type": param["type"],
-                                  "value": value, "scope": "local"}
-                    output_params.append(param_dict)
-                    key_found = True
-            if not key_found:
+            try:
+                param_type, converter = input_params[key]
+            except KeyError:
                 logger.warning(f"Key: {key} not found in workflow inputs")
+                continue
+            if converter is None:
+                raise Exception(f"Type: {param_type} inputs are not"
+                                f" supported for vRO Workflow")
+            value = converter(value)
+            logger.debug(f"param_type: {param_type}, value: {value}")
+            param_dict = {"name": key, "type": param_type,
+                          "value": value, "scope": "local"}
+            output_params.append(param_dict)
 
         return output_params
 
+    def get_cached_workflow_inputs(self, workflow_id):
+        """
+        Returns a dict of input name -> (type, converter) for the workflow,
+        where converter is the precompiled function formatting a value for
+        that input (None for unsupported types). The schema is cached per
+        ConnectionInfo and workflow_id for WORKFLOW_SCHEMA_TTL seconds.
+        :param workflow_id:
+        :return:
+        """
+        key = (self.conn_info_id, workflow_id)
+        cached = _WORKFLOW_INPUTS.get(key)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        input_params = {}
+        for param in self.get_workflow_inputs(workflow_id):
+            param_type = param["type"]
+            input_params[param["name"]] = (param_type,
+                                           get_param_converter(param_type))
+        _WORKFLOW_INPUTS[key] = (time.time() + WORKFLOW_SCHEMA_TTL,
+                                 input_params)
+        return input_params
+
     def construct_param_value(self, param_type, input_value):
         """
         Constructs the value for a workflow input based on the type of the
@@ -573,25 +1087,11 @@ class AriaOrchestratorConnection(AriaAutomationConnection):
         :param input_value:
         :return:
         """
-        if param_type in ["string", "number", "boolean", "Properties"]:
-            value = self.get_type_value(param_type, input_value)
-        elif param_type.startswith("Array/"):
-            value_dict = {"array": {"elements": []}}
-            param_type = param_type.split("/")[1]
-            if type(input_value) is list:
-                for element in input_value:
-                    value_dict["array"]["elements"].append(
-                        self.get_type_value(param_type, element)
-                    )
-            else:
-                value_dict["array"]["elements"].append(
-                    self.get_type_value(param_type, input_value)
-                )
-            value = value_dict
-        else:
+        converter = get_param_converter(param_type)
+        if converter is None:
             raise Exception(f"Type: {param_type} inputs are not supported for "
                             f"vRO Workflow")
-        return value
+        return converter(input_value)
 
     @staticmethod
     def get_type_value(param_type, value):
@@ -602,38 +1102,12 @@ class AriaOrchestratorConnection(AriaAutomationConnection):
         :param param_type: The type of the workflow input
         :param value: The value to pass to the workflow input
         """
-
-        def create_properties_value(input_value):
-            """
-            Creates a properties value for a workflow input. The input_value
-            should be a dict of the form:
-            {
-                "key": "value",
-                "key2": "value2"
-            }
-            """
-            value_dict = {"properties": {"property": []}}
-            for key, value in input_value.items():
-                if type(value) == dict:
-                    value = json.dumps(value)
-                value = {"string": {"value": value}}
-                value_dict["properties"]["property"].append(
-                    {"key": key, "value": value}
-                )
-            return value_dict
-
-        if param_type == "string":
-            value = {param_type: {"value": value}}
-        elif param_type == "number":
-            value = {param_type: {"value": int(value)}}
-        elif param_type == "boolean":
-            value = {param_type: {"value": bool(value)}}
-        elif param_type == "Properties":
-            value = create_properties_value(value)
-        else:
+        try:
+            converter = _SCALAR_CONVERTERS[param_type]
+        except KeyError:
             raise Exception(f"Type: {param_type} inputs are not"
                             f" supported for vRO Workflow")
-        return value
+        return converter(value)
 
     def wait_for_workflow_execution(self, workflow_id, execution_id,
                                     sleep_time=5):
@@ -641,7 +1115,7 @@ class AriaOrchestratorConnection(AriaAutomationConnection):
         Waits for the workflow execution to complete. Returns the state of
         the workflow execution when it is done.
         """
-        done_states = ["completed", "failed", "canceled"]
+        done_states = WORKFLOW_DONE_STATES
         state = "running"
         max_sleep = 300
         total_sleep = 0
@@ -657,6 +1131,110 @@ class AriaOrchestratorConnection(AriaAutomationConnection):
                                 f"{max_sleep} seconds. State: {state}")
         return state
 
+    def execute_workflows(self, executions, max_concurrency=None,
+                          initial_sleep=2, max_sleep=30, timeout=300):
+        """
+        Executes many workflows and waits on all of them together, yielding
+        each result as soon as its execution reaches a done state. At most
+        max_concurrency executions are started or polled at once, and each
+        execution's /state is polled with exponential backoff from
+        initial_sleep up to max_sleep seconds, so a fan-out across hundreds
+        of VMs takes roughly as long as the slowest execution.
+        :param executions: iterable of (workflow_id, parameters) tuples
+        :param max_concurrency: Defaults to WORKFLOW_CONCURRENCY
+        :param initial_sleep: Seconds before the first /state poll
+        :param max_sleep: Maximum seconds between /state polls
+        :param timeout: Seconds before an execution is reported as timed out
+        :return: generator of dicts with the keys index, workflow_id,
+            parameters, execution_id, state and error. index is the position
+            of the execution in the executions passed in. state is the vRO
+            state, or WORKFLOW_ERROR_STATE if the execution could not be
+            started or its state could not be read. Failed /state polls are
+            retried with the same backoff until the timeout.
+        """
+        if max_concurrency is None:
+            max_concurrency = WORKFLOW_CONCURRENCY
+        queued = list(enumerate(executions))
+        queued.reverse()
+        in_flight = {}
+        scheduled = []
+        with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            while queued or in_flight or scheduled:
+                while queued and len(in_flight) + len(scheduled) < \
+                        max_concurrency:
+                    index, (workflow_id, parameters) = queued.pop()
+                    run = {"index": index, "workflow_id": workflow_id,
+                           "parameters": parameters, "execution_id": None,
+                           "state": None, "error": None,
+                           "started": time.time(), "sleep": initial_sleep}
+                    future = pool.submit(self.execute_workflow, workflow_id,
+                                         parameters)
+                    in_flight[future] = run
+                now = time.time()
+                while scheduled and scheduled[0][0] <= now:
+                    _, _, run = heapq.heappop(scheduled)
+                    future = pool.submit(self.get_workflow_execution_state,
+                                         run["workflow_id"],
+                                         run["execution_id"])
+                    in_flight[future] = run
+                wait_time = max(scheduled[0][0] - now, 0) if scheduled \
+                    else None
+                if not in_flight:
+                    time.sleep(wait_time)
+                    continue
+                done, _ = wait(in_flight, timeout=wait_time,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    run = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if run["execution_id"] is None:
+                            run["state"] = WORKFLOW_ERROR_STATE
+                            run["error"] = str(e)
+                            yield self._finish_workflow_run(run)
+                            continue
+                        # The execution is still running in vRO, a failed
+                        # poll is retried until the timeout
+                        logger.warning(f'Polling workflow execution: '
+                                       f'{run["execution_id"]} failed: {e}')
+                        poll_error = str(e)
+                    else:
+                        poll_error = None
+                        if run["execution_id"] is None:
+                            run["execution_id"] = result["id"]
+                            run["state"] = result.get("state", "running")
+                        else:
+                            run["state"] = result
+                        if run["state"] in WORKFLOW_DONE_STATES:
+                            yield self._finish_workflow_run(run)
+                            continue
+                    if time.time() - run["started"] > timeout:
+                        run["error"] = (f"Workflow execution did not complete "
+                                        f"after {timeout} seconds. State: "
+                                        f"{run['state']}")
+                        if poll_error:
+                            run["state"] = WORKFLOW_ERROR_STATE
+                            run["error"] += f", last poll failed: {poll_error}"
+                        yield self._finish_workflow_run(run)
+                        continue
+                    heapq.heappush(scheduled, (time.time() + run["sleep"],
+                                               run["index"], run))
+                    run["sleep"] = min(run["sleep"] * 2, max_sleep)
+
+    @staticmethod
+    def _finish_workflow_run(run):
+        """
+        Returns the result dict for a finished execute_workflows run
+        """
+        logger.info(f'Workflow: {run["workflow_id"]} execution: '
+                    f'{run["execution_id"]} finished with state: '
+                    f'{run["state"]}')
+        result = dict(run)
+        result.pop("started")
+        result.pop("sleep")
+        return result
+
     def check_valid_value_dict(self, value):
         """
         Checks to see if the value is already formatted properly for vRO
@@ -708,14 +1286,211 @@ class AriaOrchestratorConnection(AriaAutomationConnection):
     def list_objects_for_type(self, object_type, display_attribute: list,
                               query=None):
         """
-        Returns a list of objects for the provided object type. The
-        return_attributes list should be a list of attributes to return
-        for each object. If no attributes are provided, all attributes
-        will be returned.
+        Returns a list of objects for the provided object type. The query is
+        applied server-side, results are paged through and only the
+        display_attribute(s) and id are returned for each object. Results are
+        cached per (type, attributes, query) for CATALOG_CACHE_TTL seconds so
+        generated options fields render quickly.
         :param object_type: The type of object to return. ex: VC:VirtualMachine
-        :param display_attribute: The attribute to use as the display name
+        :param display_attribute: The attribute (or list of attributes) to use
+            as the display name
         :param query: A query to filter the results. ex: name eq 'myVM'
         """
+        if isinstance(display_attribute, str):
+            display_attribute = [display_attribute]
+        key = (self.conn_info_id, object_type, tuple(display_attribute),
+               query)
+        with _CATALOG_CACHE_LOCK:
+            cached = _CATALOG_CACHE.get(key)
+            if cached and cached[0] > time.time():
+                _CATALOG_CACHE.move_to_end(key)
+                return cached[1]
+        objects = list(self.iter_objects_for_type(object_type,
+                                                  display_attribute, query))
+        cache_catalog_listing(key, objects)
+        return objects
+
+    def iter_objects_for_type(self, object_type, display_attribute: list,
+                              query=None, page_size=CATALOG_PAGE_SIZE):
+        """
+        Lazily yields the objects of the provided type, one catalog page at a
+        time. Each object is returned as a dict of its attributes plus href.
+        :param object_type: The type of object to return. ex: VC:VirtualMachine
+        :param display_attribute: A list of attributes to return
+        :param query: A query to filter the results. ex: name eq 'myVM'
+        :param page_size: The maxResult to request for each page
+        """
         namespace, type = object_type.split(":")
         url = f'/catalog/{namespace}/{type}'
-        return self.submit_request(url)
+        keys = list(display_attribute)
+        if "id" not in keys:
+            keys.append("id")
+        query_params = {"keys": ",".join(keys), "maxResult": page_size,
+                        "queryCount": "true"}
+        conditions = self.query_to_conditions(query)
+        if conditions:
+            query_params["conditions"] = conditions
+        start_index = 0
+        while True:
+            query_params["startIndex"] = start_index
+            response_json = self.submit_request(
+                self.add_query_params_to_url(url, query_params)
+            )
+            links = response_json.get("link", [])
+            for link in links:
+                obj = {a["name"]: a.get("value")
+                       for a in link.get("attributes", [])}
+                obj["href"] = link.get("href")
+                yield obj
+            start_index += len(links)
+            total = response_json.get("total")
+            if len(links) < page_size or (total is not None and
+                                          start_index >= total):
+                break
+
+    def get_object_options_for_type(self, object_type, display_attribute,
+                                    query=None):
+        """
+        Returns a list of tuples containing the object id and display
+        attribute to be used in a generated_options_for field
+        :param object_type: The type of object to return. ex: VC:VirtualMachine
+        :param display_attribute: The attribute to use as the display name
+        :param query: A query to filter the results. ex: name eq 'myVM'
+        :return:
+        """
+        objects = self.list_objects_for_type(object_type, [display_attribute],
+                                             query)
+        return [(obj.get("id"), obj.get(display_attribute))
+                for obj in objects]
+
+    @staticmethod
+    def query_to_conditions(query):
+        """
+        Converts a query to the vRO catalog conditions syntax. Simple
+        "<attribute> eq '<value>'" and "<attribute> contains '<value>'"
+        queries are translated to "<attribute>=<value>" and
+        "<attribute>~<value>", anything else is passed through as-is.
+        :param query:
+        :return:
+        """
+        if not query:
+            return None
+        match = _QUERY_RE.match(query)
+        if not match:
+            return query
+        attribute, operator, value = match.groups()
+        if operator.lower() == "eq":
+            return f'{attribute}={value}'
+        return f'{attribute}~{value}'
+
+
+class InstanceUUIDIndex(object):
+    """
+    In-memory index of vRA deployment resources and IaaS machines keyed on
+    their vCenter instanceUUID, filled by one paginated sweep of
+    /deployment/api/resources and /iaas/api/machines. Lookups are then O(1)
+    instead of one name search per VM.
+
+    The index can be persisted to a JSON file and refreshed incrementally,
+    in which case only items with an updatedAt newer than the last one seen
+    are requested. An incremental refresh doesn't see deletions, use
+    refresh(full=True) to rebuild from scratch.
+
+    vra can be an AriaAutomationConnection or a
+    VRealizeAutomation8Connection, anything with iter_resources and
+    iter_iaas_machines.
+    """
+
+    def __init__(self, vra, path=None):
+        self.vra = vra
+        self.path = path
+        self.resources = {}
+        self.machines = {}
+        self.resources_updated_at = None
+        self.machines_updated_at = None
+
+    def get_resource(self, instance_uuid):
+        return self.resources.get(instance_uuid)
+
+    def get_machine(self, instance_uuid):
+        return self.machines.get(instance_uuid)
+
+    def refresh(self, full=False):
+        """
+        Sweeps vRA for resources and machines. Unless full is True, only
+        items updated since the last refresh are requested.
+        :param full:
+        :return:
+        """
+        if full:
+            self.resources, self.machines = {}, {}
+            self.resources_updated_at = self.machines_updated_at = None
+        self.resources_updated_at = self._sweep(
+            self.vra.iter_resources, self.resources,
+            self.resources_updated_at,
+            lambda r: r.get("properties", {}).get("instanceUUID")
+        )
+        self.machines_updated_at = self._sweep(
+            self.vra.iter_iaas_machines, self.machines,
+            self.machines_updated_at,
+            lambda m: m.get("customProperties", {}).get("instanceUUID")
+        )
+        logger.info(f'Instance UUID index holds {len(self.resources)} '
+                    f'resources and {len(self.machines)} machines')
+
+    @staticmethod
+    def _sweep(iter_items, target, updated_at, get_uuid):
+        """
+        Adds every item yielded by iter_items to target keyed on get_uuid,
+        returning the newest updatedAt seen. If the API rejects the
+        updatedAt filter, a full sweep is done instead.
+        """
+        query_params = {}
+        if updated_at:
+            query_params["$filter"] = f"updatedAt gt '{updated_at}'"
+        try:
+            items = list(iter_items(query_params, prefetch=True))
+        except requests.HTTPError as e:
+            if getattr(e.response, "status_code", None) != 400 or \
+                    not query_params:
+                raise
+            logger.info('updatedAt filter rejected, doing a full sweep')
+            items = list(iter_items({}, prefetch=True))
+        for item in items:
+            uuid = get_uuid(item)
+            if uuid:
+                target[uuid] = item
+            item_updated_at = item.get("updatedAt")
+            # ISO 8601 timestamps from vRA sort lexically
+            if item_updated_at and (not updated_at or
+                                    item_updated_at > updated_at):
+                updated_at = item_updated_at
+        return updated_at
+
+    def save(self):
+        """
+        Writes the index to self.path
+        :return:
+        """
+        data = {
+            "resources": self.resources,
+            "machines": self.machines,
+            "resources_updated_at": self.resources_updated_at,
+            "machines_updated_at": self.machines_updated_at,
+        }
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """
+        Reads the index from self.path
+        :return:
+        """
+        with open(self.path) as f:
+            data = json.load(f)
+        self.resources = data.get("resources", {})
+        self.machines = data.get("machines", {})
+        self.resources_updated_at = data.get("resources_updated_at")
+        self.machines_updated_at = data.get("machines_updated_at")
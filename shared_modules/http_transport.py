@@ -0,0 +1,271 @@
+"""
+A pooled HTTP transport shared by the Git API clients (GitHubWrapper and
+GitLabWrapper in xui/git_management, GitLabConnector in xui/gitlab) and the
+ServiceNow table client (shared_modules/servicenow.py).
+
+All calls go through one requests.Session, so connections to a host are kept
+alive and reused across wrapper instances and threads. The transport also:
+- Tracks the rate limit headers returned by GitHub (X-RateLimit-*) and GitLab
+  (RateLimit-*) per host, and slows down as the remaining budget runs low
+  instead of running in to the limit
+- Honours Retry-After, waiting the requested time before the next call to
+  that host
+- Retries rate limited calls, and idempotent calls that failed with a
+  connection error or a 502/503/504, with jittered exponential backoff
+- Keeps per-host call, retry, error and latency counters
+
+Usage:
+    from shared_modules.http_transport import get_transport
+    r = get_transport().request("GET", url, headers=headers)
+    stats = get_transport().get_stats("api.github.com")
+"""
+import random
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from eventlet.green import threading  # CB 7.7 and up
+except ImportError:
+    import threading  # CB 7.6 and earlier
+
+from utilities.logger import ThreadLogger
+
+logger = ThreadLogger(__name__)
+
+# Keep-alive connections kept per host. This should be at least as large as
+# the number of threads making concurrent calls to one host.
+POOL_MAXSIZE = 16
+# Number of hosts a keep-alive pool is kept for
+POOL_CONNECTIONS = 10
+# Number of times a call is retried before the last response or error is
+# returned to the caller
+MAX_RETRIES = 4
+# Backoff before retry n is a random time between 0 and
+# min(BACKOFF_MAX, BACKOFF_BASE * 2 ** n) seconds
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Longest time a single Retry-After or rate limit reset is waited for
+MAX_WAIT = 300
+# Once fewer than this many calls remain in the rate limit window, calls to
+# the host are spread evenly over the rest of the window
+RATE_LIMIT_LOW_WATER = 50
+
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+RETRY_STATUSES = [502, 503, 504]
+
+
+class HostState(object):
+    """
+    Rate limit state and counters for one host
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.not_before = 0
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "errors": self.errors,
+                "throttled": self.throttled,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "avg_latency": round(self.total_latency / self.calls, 3)
+                if self.calls else 0.0,
+                "max_latency": round(self.max_latency, 3),
+                "rate_limit_remaining": self.rate_limit_remaining,
+                "rate_limit_reset": self.rate_limit_reset,
+            }
+
+
+class HttpTransport(object):
+    """
+    Thread safe, pooled HTTP transport with rate limit handling and retries
+    """
+
+    def __init__(self, pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES):
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def get_host_state(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = HostState()
+            return state
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, waiting for the host's rate limit and retrying where
+        it is safe to. Takes the same arguments as requests.request.
+        :return: the requests.Response of the last attempt
+        """
+        method = method.upper()
+        state = self.get_host_state(urlsplit(url).netloc)
+        attempt = 0
+        while True:
+            self.wait_for_host(state)
+            start = time.monotonic()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError:
+                self.record_call(state, time.monotonic() - start, error=True)
+                if method not in IDEMPOTENT_METHODS or \
+                        attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Connection error on {method} {url}, "
+                               f"retrying")
+                self.backoff(state, attempt)
+                self.record_retry(state)
+                attempt += 1
+                continue
+            self.record_call(state, time.monotonic() - start,
+                             error=r.status_code >= 400)
+            retry_after = self.update_rate_limit(state, r)
+            if attempt >= self.max_retries:
+                return r
+            if self.is_rate_limited(r):
+                # Rate limited calls were not processed, so are safe to retry
+                # whatever the method
+                logger.warning(f"Rate limited on {method} {url}, retrying")
+            elif r.status_code in RETRY_STATUSES and \
+                    method in IDEMPOTENT_METHODS:
+                logger.warning(f"{r.status_code} on {method} {url}, "
+                               f"retrying")
+            else:
+                return r
+            if retry_after is None:
+                self.backoff(state, attempt)
+            self.record_retry(state)
+            attempt += 1
+
+    def is_rate_limited(self, r):
+        if r.status_code == 429:
+            return True
+        # GitHub returns 403 for both primary and secondary rate limits
+        if r.status_code == 403:
+            if "Retry-After" in r.headers:
+                return True
+            return get_header(r, "X-RateLimit-Remaining",
+                              "RateLimit-Remaining") == "0"
+        return False
+
+    def update_rate_limit(self, state, r):
+        """
+        Record the rate limit headers of a response and push back the time
+        the next call to the host may be sent
+        :return: the Retry-After in seconds, if the response had one
+        """
+        now = time.time()
+        remaining = get_header(r, "X-RateLimit-Remaining",
+                               "RateLimit-Remaining")
+        reset = get_header(r, "X-RateLimit-Reset", "RateLimit-Reset")
+        retry_after = r.headers.get("Retry-After")
+        not_before = 0
+        with state.lock:
+            if remaining is not None and reset is not None:
+                try:
+                    state.rate_limit_remaining = int(remaining)
+                    state.rate_limit_reset = int(reset)
+                except ValueError:
+                    pass
+                else:
+                    window = max(state.rate_limit_reset - now, 0)
+                    window = min(window, MAX_WAIT)
+                    if state.rate_limit_remaining == 0:
+                        not_before = now + window
+                    elif state.rate_limit_remaining < RATE_LIMIT_LOW_WATER:
+                        # Spread what is left of the budget over the window
+                        not_before = now + \
+                            window / (state.rate_limit_remaining + 1)
+            if retry_after is not None:
+                try:
+                    retry_after = min(float(retry_after), MAX_WAIT)
+                except ValueError:
+                    retry_after = None
+                else:
+                    not_before = max(not_before, now + retry_after)
+            state.not_before = max(state.not_before, not_before)
+        return retry_after
+
+    def wait_for_host(self, state):
+        with state.lock:
+            delay = state.not_before - time.time()
+            if delay > 0:
+                state.throttled += 1
+                state.throttled_seconds += delay
+        if delay > 0:
+            if delay > 1:
+                logger.info(f"Throttling for {delay:.1f}s to stay within the "
+                            f"rate limit")
+            time.sleep(delay)
+
+    def backoff(self, state, attempt):
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        time.sleep(delay)
+
+    def record_call(self, state, latency, error=False):
+        with state.lock:
+            state.calls += 1
+            state.total_latency += latency
+            state.max_latency = max(state.max_latency, latency)
+            if error:
+                state.errors += 1
+
+    def record_retry(self, state):
+        with state.lock:
+            state.retries += 1
+
+    def get_stats(self, host=None):
+        """
+        :param host: the host (netloc) to return the counters for
+        :return: the counters for the host, or a dict of host -> counters for
+            every host called if host is not passed
+        """
+        if host is not None:
+            return self.get_host_state(host).as_dict()
+        with self.lock:
+            hosts = dict(self.hosts)
+        return {h: state.as_dict() for h, state in hosts.items()}
+
+
+def get_header(r, *names):
+    for name in names:
+        value = r.headers.get(name)
+        if value is not None:
+            return value
+    return None
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Return the process-wide HttpTransport
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HttpTransport()
+        return _transport
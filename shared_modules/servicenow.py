@@ -0,0 +1,276 @@
+"""
+A ServiceNow Table API client shared by the ServiceNow plugins (service_now/
+and the App ID parameters in params/).
+
+Calls go through the process-wide HttpTransport (see http_transport.py), so
+connections to the instance are kept alive and reused between calls, and
+rate limited calls are retried. The client adds:
+- Paging through a table with sysparm_limit/sysparm_offset, as a generator,
+  so large tables are never held in one response. Pages are ordered by
+  sys_id so records are not skipped or repeated between pages.
+- Field projection with sysparm_fields, so only the fields used are returned
+- Errors raised as ServiceNowError instead of being swallowed
+- Per-table call, record, error and latency counters
+
+Usage:
+    from shared_modules.servicenow import get_table_client
+    client = get_table_client()
+    for ci in client.iter_records('cmdb_ci_appl', fields=['name']):
+        ...
+    user = client.get_record('sys_user', query={'user_name': 'jdoe'},
+                             fields=['sys_id'])
+    before = client.get_stats('cmdb_ci_appl')
+    ...
+    calls_made = get_stats_delta(before, client.get_stats('cmdb_ci_appl'))
+"""
+import time
+
+try:
+    from eventlet.green import threading  # CB 7.7 and up
+except ImportError:
+    import threading  # CB 7.6 and earlier
+
+from itsm.servicenow.models import ServiceNowITSM
+from shared_modules.http_transport import get_transport
+from utilities.logger import ThreadLogger
+
+logger = ThreadLogger(__name__)
+
+# Records fetched per call when paging through a table
+PAGE_SIZE = 1000
+# Seconds to wait for a response from ServiceNow
+TIMEOUT = 30.0
+# Ordering added to every paged query, see iter_records
+PAGE_ORDER = "ORDERBYsys_id"
+
+
+class ServiceNowError(Exception):
+    pass
+
+
+class TableStats(object):
+    """
+    Counters for the calls made to one table
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.records = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record_call(self, latency, records=0, error=False):
+        with self.lock:
+            self.calls += 1
+            self.records += records
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if error:
+                self.errors += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "records": self.records,
+                "errors": self.errors,
+                "total_latency": round(self.total_latency, 3),
+                "avg_latency": round(self.total_latency / self.calls, 3)
+                if self.calls else 0.0,
+                "max_latency": round(self.max_latency, 3),
+            }
+
+
+class ServiceNowTableClient(object):
+    """
+    Thread safe client for the ServiceNow Table API (/api/now/table)
+    """
+
+    def __init__(self, base_url, username, password, proxies=None,
+                 verify=True, timeout=TIMEOUT):
+        """
+        :param base_url: the instance url, ex. https://acme.service-now.com
+        :param username: the ServiceNow account to authenticate as
+        :param password: the password of that account
+        :param proxies: optional requests proxies dict
+        :param verify: whether to verify the instance's certificate
+        """
+        self.base_url = base_url.rstrip("/")
+        self.auth = (username, password)
+        self.proxies = proxies
+        self.verify = verify
+        self.timeout = timeout
+        self.headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get_table_stats(self, table):
+        with self.lock:
+            stats = self.stats.get(table)
+            if stats is None:
+                stats = self.stats[table] = TableStats()
+            return stats
+
+    def get_page(self, table, params):
+        """
+        Make one GET against a table
+        :param params: the query string parameters
+        :return: tuple of the list of records in the response and the total
+            number of records matching the query (X-Total-Count), or None if
+            ServiceNow did not return it
+        """
+        url = f"{self.base_url}/api/now/table/{table}"
+        stats = self.get_table_stats(table)
+        start = time.monotonic()
+        try:
+            r = get_transport().request(
+                "GET", url, params=params, auth=self.auth,
+                headers=self.headers, proxies=self.proxies,
+                verify=self.verify, timeout=self.timeout
+            )
+        except Exception as e:
+            stats.record_call(time.monotonic() - start, error=True)
+            raise ServiceNowError(f"GET {table} failed: {e}")
+        latency = time.monotonic() - start
+        if r.status_code >= 400:
+            stats.record_call(latency, error=True)
+            raise ServiceNowError(f"GET {table} failed with "
+                                  f"{r.status_code}: {r.text[:500]}")
+        try:
+            results = r.json()["result"]
+        except (ValueError, KeyError) as e:
+            stats.record_call(latency, error=True)
+            raise ServiceNowError(f"GET {table} returned an unexpected "
+                                  f"response: {e}")
+        stats.record_call(latency, records=len(results))
+        try:
+            total = int(r.headers["X-Total-Count"])
+        except (KeyError, TypeError, ValueError):
+            total = None
+        return results, total
+
+    def iter_records(self, table, query=None, fields=None,
+                     display_value=None, page_size=PAGE_SIZE, limit=None,
+                     params=None):
+        """
+        Yield the records of a table, fetching page_size records at a time
+        :param table: the table name, ex. 'cmdb_ci_appl'
+        :param query: an encoded query string (sysparm_query), ex.
+            'sys_idINa,b^active=true', or a dict of field -> value filters
+        :param fields: the fields to return, defaults to every field
+        :param display_value: passed as sysparm_display_value, ex. 'true' to
+            return reference fields as {"display_value": ..., "link": ...}
+        :param limit: the most records to return, defaults to every match
+        :param params: any other query string parameters to send
+        """
+        base_params = dict(params or {})
+        if isinstance(query, dict):
+            base_params.update(query)
+        elif query:
+            base_params["sysparm_query"] = query
+        # Without a stable order ServiceNow can return the same record on two
+        # pages and skip another, so order by sys_id unless the query
+        # already sets an order
+        encoded_query = base_params.get("sysparm_query")
+        if not encoded_query:
+            base_params["sysparm_query"] = PAGE_ORDER
+        elif "ORDERBY" not in encoded_query:
+            base_params["sysparm_query"] = f"{encoded_query}^{PAGE_ORDER}"
+        if fields:
+            base_params["sysparm_fields"] = ",".join(fields)
+        if display_value is not None:
+            base_params["sysparm_display_value"] = str(display_value).lower()
+        else:
+            base_params.setdefault("sysparm_exclude_reference_link", "true")
+        offset = 0
+        while limit is None or offset < limit:
+            count = page_size if limit is None else min(page_size,
+                                                        limit - offset)
+            page_params = dict(base_params, sysparm_limit=count,
+                               sysparm_offset=offset)
+            results, total = self.get_page(table, page_params)
+            for result in results:
+                yield result
+            # A page can be short when ACLs hide some of its records, so only
+            # an empty page, or reaching X-Total-Count, ends the table
+            offset += count
+            if not results or (total is not None and offset >= total):
+                return
+
+    def get_records(self, table, **kwargs):
+        """
+        Return the records of a table as a list, see iter_records
+        """
+        return list(self.iter_records(table, **kwargs))
+
+    def get_record(self, table, query=None, fields=None, **kwargs):
+        """
+        Return the first record matching the query, or None if there is none
+        """
+        for record in self.iter_records(table, query=query, fields=fields,
+                                        limit=1, **kwargs):
+            return record
+        return None
+
+    def get_stats(self, table=None):
+        """
+        :param table: the table to return the counters for
+        :return: the counters for the table, or a dict of table -> counters
+            for every table called if table is not passed
+        """
+        if table is not None:
+            return self.get_table_stats(table).as_dict()
+        with self.lock:
+            tables = dict(self.stats)
+        return {t: stats.as_dict() for t, stats in tables.items()}
+
+
+def get_stats_delta(before, after):
+    """
+    The calls made between two get_stats snapshots of a table, ex. to report
+    on one run of a job when the client is shared by the whole process
+    """
+    calls = after["calls"] - before["calls"]
+    total_latency = after["total_latency"] - before["total_latency"]
+    return {
+        "calls": calls,
+        "records": after["records"] - before["records"],
+        "errors": after["errors"] - before["errors"],
+        "avg_latency": round(total_latency / calls, 3) if calls else 0.0,
+    }
+
+
+def get_base_url(snowitsm):
+    wrapper = snowitsm.get_api_wrapper()
+    return wrapper.service_now_instance_url.replace("/login.do", "")
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_table_client(snowitsm=None, proxies=None, verify=True):
+    """
+    Return the process-wide ServiceNowTableClient for a ServiceNow ITSM
+    :param snowitsm: the ServiceNowITSM to connect to, defaults to the first
+    :param proxies: optional requests proxies dict
+    :param verify: whether to verify the instance's certificate
+    """
+    if snowitsm is None:
+        snowitsm = ServiceNowITSM.objects.first()
+    base_url = get_base_url(snowitsm)
+    key = (base_url, snowitsm.service_account, snowitsm.password, verify,
+           tuple(sorted((proxies or {}).items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = ServiceNowTableClient(
+                base_url, snowitsm.service_account, snowitsm.password,
+                proxies=proxies, verify=verify
+            )
+        return client
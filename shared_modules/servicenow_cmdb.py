@@ -0,0 +1,387 @@
+"""
+Type-ahead options for CloudBolt Parameters backed by a ServiceNow CMDB table.
+
+Instead of pulling the whole table from ServiceNow every time a form renders,
+a CMDBOptionProvider keeps a local snapshot of the table:
+- The snapshot is stored as JSON under SNAPSHOT_DIR and refreshed
+  periodically, by a Recurring Job (see params/app_id_query.py) or, once it
+  is older than SNAPSHOT_FRESH_TTL, in the background by the next lookup.
+  Only one process at a time downloads the table (file lock), the others
+  wait for and then read its snapshot.
+- Each process builds a prefix index over the snapshot once per refresh, so
+  suggest_options only returns the top matches for what has been typed
+- Options carry only the record's key. The full record is looked up with
+  get_row once an option has been selected, from ServiceNow unless this
+  process already has the snapshot loaded.
+
+Usage, in a Generated Options action:
+    from shared_modules.servicenow_cmdb import get_app_id_provider
+
+    def suggest_options(custom_field, query, **kwargs):
+        return get_app_id_provider().suggest_options(query)
+
+    def get_options_list(*args, **kwargs):
+        return None
+
+The snapshot holds every row. Each consumer filters what it offers, ex.
+suggest_options(query, exclude=is_retired) leaves out retired App IDs.
+"""
+import fcntl
+import json
+import os
+import re
+import time
+from bisect import bisect_left
+
+try:
+    from eventlet.green import threading  # CB 7.7 and up
+except ImportError:
+    import threading  # CB 7.6 and earlier
+
+from common.methods import get_proxies
+from itsm.servicenow.models import ServiceNowITSM
+from shared_modules.servicenow import ServiceNowError, get_base_url, \
+    get_table_client
+from utilities.logger import ThreadLogger
+
+logger = ThreadLogger(__name__)
+
+SNAPSHOT_DIR = "/var/opt/cloudbolt/proserv/service_now/cmdb"
+# Seconds a snapshot is used without refreshing it
+SNAPSHOT_FRESH_TTL = 60 * 60
+# Seconds a snapshot may be used while it is refreshed in the background.
+# Older snapshots are refreshed before they are used.
+SNAPSHOT_MAX_STALE = 7 * 24 * 60 * 60
+# Longest a lookup waits for another process to finish downloading the table
+SNAPSHOT_LOCK_TIMEOUT = 120
+# Most options returned by suggest_options
+SUGGEST_LIMIT = 25
+
+# Start of every word after the first
+WORD_START = re.compile(r"(?<=\s)\S")
+
+APP_ID_FIELDS = [
+    'sys_id',
+    'name',
+    'u_application_id',
+    'u_systemid',
+    'install_status',
+    'owned_by',
+    'support_group',
+    'u_priority',
+    'version',
+    'operational_status',
+    'sys_created_on',
+]
+
+
+def normalize(value):
+    if value is None:
+        return ""
+    return str(value).casefold().strip()
+
+
+def flatten_record(record):
+    """
+    Replace reference fields, returned as {"display_value": ..., "link": ...}
+    with sysparm_display_value=true, with their display value
+    """
+    return {field: value.get("display_value")
+            if isinstance(value, dict) else value
+            for field, value in record.items()}
+
+
+class CMDBSnapshot(object):
+    """
+    The rows of a table at one point in time, indexed by key and by the
+    prefixes of their search fields
+    """
+
+    def __init__(self, rows, fetched, key_field, search_fields, mtime=None):
+        self.rows = rows
+        self.fetched = fetched
+        self.mtime = mtime
+        self.by_key = {row.get(key_field): row for row in rows}
+        # Every search field value, from the start of each of its words, is a
+        # token, so typing any part of a name from a word boundary matches.
+        # Tokens are kept sorted so the tokens starting with a prefix are one
+        # contiguous run, found with a binary search.
+        entries = []
+        for i, row in enumerate(rows):
+            for field in search_fields:
+                value = normalize(row.get(field))
+                if not value:
+                    continue
+                entries.append((value, i))
+                for match in WORD_START.finditer(value):
+                    entries.append((value[match.start():], i))
+        entries.sort()
+        self.tokens = [token for token, _i in entries]
+        self.token_rows = [i for _token, i in entries]
+
+    def search(self, query, limit, exclude=None):
+        """
+        :param exclude: optional callable(row) returning True for rows that
+            should not be returned
+        :return: up to limit rows with a token starting with query, ordered
+            by the matching token
+        """
+        prefix = normalize(query)
+        matches = []
+        seen = set()
+        for position in range(bisect_left(self.tokens, prefix),
+                              len(self.tokens)):
+            if not self.tokens[position].startswith(prefix):
+                break
+            i = self.token_rows[position]
+            if i in seen:
+                continue
+            seen.add(i)
+            if exclude and exclude(self.rows[i]):
+                continue
+            matches.append(self.rows[i])
+            if len(matches) >= limit:
+                break
+        return matches
+
+
+class CMDBOptionProvider(object):
+    """
+    Parameter options from a locally cached snapshot of a ServiceNow table
+    """
+
+    def __init__(self, name, table, fields, label, key_field="sys_id",
+                 search_fields=None, get_client=None):
+        """
+        :param name: the name the snapshot is stored under in SNAPSHOT_DIR
+        :param table: the ServiceNow table, ex. 'cmdb_ci_appl'
+        :param fields: the fields stored for each row, must include key_field
+        :param label: callable(row) returning the label of a row's option
+        :param key_field: the field used as the value of each option
+        :param search_fields: the fields type-ahead matches on
+        :param get_client: callable returning the ServiceNowTableClient to
+            use, defaults to get_table_client
+        """
+        self.name = name
+        self.table = table
+        self.fields = fields
+        self.label = label
+        self.key_field = key_field
+        self.search_fields = search_fields or [key_field]
+        self.get_client = get_client or get_table_client
+        self.path = os.path.join(SNAPSHOT_DIR, f"{name}.json")
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def suggest_options(self, query, limit=SUGGEST_LIMIT, exclude=None):
+        """
+        :param exclude: optional callable(row) returning True for rows that
+            should not be offered
+        :return: list of (key, label) for the rows matching what was typed
+        """
+        rows = self.get_snapshot().search(query or "", limit, exclude)
+        return [(row.get(self.key_field), self.label(row)) for row in rows]
+
+    def get_row(self, key):
+        """
+        Hydrate a selected option: return the full row with the given key.
+        Jobs only need the one row, so it is read from the snapshot only if
+        this process already has it loaded, otherwise it is looked up in
+        ServiceNow, and only if that fails read from the stored snapshot
+        without indexing it.
+        :return: the row, or None if no row has the key
+        """
+        with self.lock:
+            snapshot = self.snapshot
+        if snapshot is not None and key in snapshot.by_key:
+            try:
+                if snapshot.mtime == os.stat(self.path).st_mtime:
+                    return snapshot.by_key[key]
+            except FileNotFoundError:
+                pass
+        try:
+            record = self.get_client().get_record(
+                self.table, query={self.key_field: key}, fields=self.fields,
+                display_value=True
+            )
+        except ServiceNowError as e:
+            logger.warning(f"Could not look up {key} in {self.table}, "
+                           f"reading it from the snapshot: {e}")
+            return self.find_stored_row(key)
+        if record is None:
+            return None
+        return flatten_record(record)
+
+    def find_stored_row(self, key):
+        """
+        Return the row with the given key from the stored snapshot, or None
+        """
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        for row in data["rows"]:
+            if row.get(self.key_field) == key:
+                return row
+        return None
+
+    def get_snapshot(self):
+        snapshot = self.load()
+        if snapshot is None:
+            return self.refresh()
+        age = time.time() - snapshot.fetched
+        if age >= SNAPSHOT_MAX_STALE:
+            return self.refresh()
+        if age >= SNAPSHOT_FRESH_TTL:
+            self.refresh_in_background()
+        return snapshot
+
+    def load(self):
+        """
+        Return the stored snapshot, only reading and indexing the file again
+        when it has been replaced since it was last loaded
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if self.snapshot is not None and self.snapshot.mtime == mtime:
+                return self.snapshot
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        snapshot = CMDBSnapshot(data["rows"], data["fetched"], self.key_field,
+                                self.search_fields, mtime=mtime)
+        with self.lock:
+            self.snapshot = snapshot
+        return snapshot
+
+    def refresh(self, wait=True):
+        """
+        Fetch every row of the table from ServiceNow and store the snapshot,
+        holding the snapshot's cross-process lock. If another process
+        replaces the snapshot while this waits for the lock, its snapshot is
+        used instead of fetching the table again.
+        :param wait: whether to wait (up to SNAPSHOT_LOCK_TIMEOUT) if another
+            process holds the lock, or give up straight away
+        :return: the new snapshot, or None if wait is False and another
+            process is refreshing it
+        """
+        requested = time.time()
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        # Closing the lock file releases the lock
+        with open(f"{self.path}.lock", "w") as lock_file:
+            if self.acquire_lock(lock_file, wait):
+                snapshot = self.load()
+                if snapshot is not None and snapshot.mtime >= requested:
+                    return snapshot
+            elif not wait:
+                return None
+            else:
+                logger.warning(f"Timed out waiting for the {self.name} "
+                               f"snapshot lock")
+                snapshot = self.load()
+                if snapshot is not None:
+                    return snapshot
+            return self.fetch()
+
+    @staticmethod
+    def acquire_lock(lock_file, wait):
+        """
+        flock the file, polling so eventlet workers are not blocked
+        """
+        deadline = time.time() + SNAPSHOT_LOCK_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if not wait or time.time() >= deadline:
+                    return False
+                time.sleep(0.2)
+
+    def fetch(self):
+        """
+        Fetch every row of the table from ServiceNow and store the snapshot
+        """
+        start = time.time()
+        rows = []
+        for record in self.get_client().iter_records(
+                self.table, fields=self.fields, display_value=True):
+            rows.append(flatten_record(record))
+        # Write then rename so a concurrent reader never sees a partial file
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"fetched": start, "rows": rows}, f)
+        os.replace(tmp_path, self.path)
+        snapshot = CMDBSnapshot(rows, start, self.key_field,
+                                self.search_fields,
+                                mtime=os.stat(self.path).st_mtime)
+        with self.lock:
+            self.snapshot = snapshot
+        logger.info(f"Refreshed {self.table} snapshot {self.name}: "
+                    f"{len(rows)} rows in {time.time() - start:.1f}s")
+        return snapshot
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.refresh(wait=False)
+            except Exception:
+                logger.exception(f"Background refresh of {self.name} failed")
+            finally:
+                with self.lock:
+                    self.refreshing = False
+                from django.db import connection
+                connection.close()
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+
+def get_app_id_client():
+    snowitsm = ServiceNowITSM.objects.first()
+    proxies = get_proxies(get_base_url(snowitsm))
+    return get_table_client(snowitsm, proxies=proxies, verify=False)
+
+
+def is_retired(row):
+    return row.get("install_status") == "Retired"
+
+
+def get_app_id_label(row):
+    if row.get("u_application_id"):
+        return f'{row["u_application_id"]} - {row["name"]}'
+    return row.get("name")
+
+
+_app_id_provider = None
+_app_id_provider_lock = threading.Lock()
+
+
+def get_app_id_provider():
+    """
+    Return the process-wide CMDBOptionProvider for App IDs (cmdb_ci_appl).
+    The snapshot holds every application, pass exclude=is_retired to
+    suggest_options to leave out retired ones.
+    """
+    global _app_id_provider
+    with _app_id_provider_lock:
+        if _app_id_provider is None:
+            _app_id_provider = CMDBOptionProvider(
+                "app_ids", "cmdb_ci_appl", APP_ID_FIELDS, get_app_id_label,
+                search_fields=["name", "u_application_id"],
+                get_client=get_app_id_client,
+            )
+        return _app_id_provider
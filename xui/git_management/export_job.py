@@ -0,0 +1,33 @@
+"""
+Action run by the Jobs that Git Management exports are queued as, see
+export_queue.py. The content to export is looked up by the id of the Job.
+"""
+from accounts.models import UserProfile
+from common.methods import set_progress
+from xui.git_management.export_queue import get_export_comment, \
+    start_export, finish_export
+from xui.git_management.utilities import create_git_commit_from_contents
+
+
+def run(job=None, logger=None, **kwargs):
+    export = start_export(job.id)
+    if export is None:
+        return "FAILURE", "", f"No Git export was queued for Job {job.id}"
+    try:
+        user = UserProfile.objects.get(id=export["user_id"])
+        set_progress(f'Exporting {len(export["content_ids"])} '
+                     f'{export["content_type"]}(s) to Git config '
+                     f'{export["git_config_name"]}')
+
+        def progress(completed, message):
+            set_progress(f'{message} ({completed} of '
+                         f'{len(export["content_ids"])})')
+
+        result = create_git_commit_from_contents(
+            export["content_type"], export["content_ids"],
+            export["git_config_name"], get_export_comment(export), user,
+            progress=progress
+        )
+    finally:
+        finish_export(job.id)
+    return "SUCCESS", f"Export complete: {result}", ""
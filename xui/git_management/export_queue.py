@@ -0,0 +1,175 @@
+"""
+Runs Git Management exports as CloudBolt Jobs.
+
+The views queue an export and return straight away with a link to the Job,
+which shows the export's progress and result on the native Job page. The
+Job runs the "Git Management Export" action (export_job.py), which is created
+the first time an export is queued.
+
+What each Job exports is stored in EXPORT_STATE_FILE, keyed by Job id, so
+every web server worker and the job engine see the same queue. Duplicate
+exports are coalesced: content queued for a Git config that already has an
+export waiting to start is added to that export, along with the caller's
+commit comment, instead of starting another Job. Exports whose Job has
+ended, been cancelled or been deleted without running them are dropped, so
+nothing is coalesced in to a Job that will never run.
+"""
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from cbhooks.models import CloudBoltHook
+from jobs.models import Job
+from utilities.logger import ThreadLogger
+
+logger = ThreadLogger(__name__)
+
+EXPORT_DIR = "/var/opt/cloudbolt/proserv/xui/git_management/exports"
+EXPORT_STATE_FILE = os.path.join(EXPORT_DIR, "exports.json")
+# Seconds an export is kept in EXPORT_STATE_FILE if its Job never picks it up
+EXPORT_STATE_TTL = 24 * 60 * 60
+EXPORT_ACTION_NAME = "Git Management Export"
+EXPORT_ACTION_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "export_job.py")
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+# Statuses of a Job that has not ended yet
+JOB_ACTIVE_STATUSES = ["PENDING", "QUEUED", "INIT", "RUNNING"]
+
+
+@contextmanager
+def export_state():
+    """
+    Yield the dict of Job id -> export stored in EXPORT_STATE_FILE, holding
+    an exclusive lock on it across processes. Changes made to the dict are
+    written back when the block exits.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    with open(f"{EXPORT_STATE_FILE}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(EXPORT_STATE_FILE, "r") as f:
+                    exports = json.load(f)
+            except (FileNotFoundError, ValueError):
+                exports = {}
+            yield exports
+            tmp_path = f"{EXPORT_STATE_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(exports, f, indent=2)
+            os.replace(tmp_path, EXPORT_STATE_FILE)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_export_action():
+    """
+    Return the action run by export Jobs, creating it from export_job.py if
+    it does not exist yet
+    """
+    action = CloudBoltHook.objects.filter(name=EXPORT_ACTION_NAME).first()
+    if action is None:
+        action = CloudBoltHook.objects.create(
+            name=EXPORT_ACTION_NAME,
+            description="Exports CloudBolt content to a Git repo, queued by "
+                        "the Git Management XUI",
+            source_code_url=f"file://{EXPORT_ACTION_SCRIPT}",
+        )
+        action.fetch_remote_content()
+        logger.info(f"Created action {EXPORT_ACTION_NAME}")
+    return action
+
+
+def get_export_comment(export):
+    """
+    The commit comment of an export, combining the comments of every
+    request coalesced in to it
+    """
+    return "\n\n".join(export["comments"])
+
+
+def prune_exports(exports):
+    """
+    Drop the exports that are older than EXPORT_STATE_TTL, whose Job no
+    longer exists, or whose Job has ended, ex. been cancelled or failed
+    before it could run the export
+    :return: dict of Job id -> Job for the exports that are kept
+    """
+    cutoff = time.time() - EXPORT_STATE_TTL
+    jobs = Job.objects.in_bulk([int(job_id) for job_id in exports])
+    kept = {}
+    for job_id, export in list(exports.items()):
+        job = jobs.get(int(job_id))
+        if export["created"] < cutoff or job is None or \
+                job.status not in JOB_ACTIVE_STATUSES:
+            logger.info(f"Dropping {export['state'].lower()} export for Job "
+                        f"{job_id}, Job is "
+                        f"{job.status if job else 'deleted'}")
+            del exports[job_id]
+        else:
+            kept[job_id] = job
+    return kept
+
+
+def queue_git_export(content_type, content_ids, git_config_name, git_comment,
+                     user):
+    """
+    Queue an export of one or more pieces of content in to a single commit
+    :param content_type: the type of content to export
+    :param content_ids: the global ids of the content to export
+    :param git_config_name: the name of the Git Management XUI config
+    :param git_comment: the comment to use for the commit
+    :param user: the UserProfile the export is run as
+    :return: the Job that will commit the content
+    """
+    with export_state() as exports:
+        jobs = prune_exports(exports)
+        for job_id, export in exports.items():
+            if export["state"] == QUEUED and \
+                    export["git_config_name"] == git_config_name and \
+                    export["content_type"] == content_type and \
+                    export["user_id"] == user.id:
+                # The Job has not picked the export up yet (start_export takes
+                # the same lock), so it will export these too
+                export["content_ids"].extend(
+                    c for c in content_ids if c not in export["content_ids"])
+                if git_comment and git_comment not in export["comments"]:
+                    export["comments"].append(git_comment)
+                logger.info(f"Coalesced export of {content_ids} in to queued "
+                            f"export Job {job_id}")
+                return jobs[job_id]
+        # The lock is held until the export is stored, so the Job can not
+        # start before it is there to be read
+        # The job is the first item of what run_as_job returns
+        job = get_export_action().run_as_job(owner=user)[0]
+        exports[str(job.id)] = {
+            "state": QUEUED,
+            "content_type": content_type,
+            "content_ids": list(content_ids),
+            "git_config_name": git_config_name,
+            "comments": [git_comment] if git_comment else [],
+            "user_id": user.id,
+            "created": time.time(),
+        }
+    return job
+
+
+def start_export(job_id):
+    """
+    Mark the export of a Job as running, so nothing more is coalesced in to
+    it, and return it
+    :return: the export, or None if none was queued for the Job
+    """
+    with export_state() as exports:
+        export = exports.get(str(job_id))
+        if export is not None:
+            export["state"] = RUNNING
+        return export
+
+
+def finish_export(job_id):
+    with export_state() as exports:
+        exports.pop(str(job_id), None)
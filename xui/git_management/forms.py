@@ -5,13 +5,32 @@ from django.forms import PasswordInput
 from common.forms import C2Form
 from common.widgets import SelectizeMultiple
 from utilities.models import ConnectionInfo
+from xui.git_management.export_queue import queue_git_export
 from xui.git_management.utilities import get_content_choices, \
-    GitManagementConfigs, create_git_commit_from_content
+    GitManagementConfigs
 from utilities.logger import ThreadLogger
 
 logger = ThreadLogger(__name__)
 
 
+def add_edit_check_fields(form, initial):
+    """
+    Add hidden fields carrying the name and hash of the config being edited,
+    as it was when the form was opened, so saving the form can detect that
+    someone else changed the config in the meantime
+    """
+    form.fields["original_name"] = forms.CharField(
+        required=False,
+        initial=initial.get("original_name", None),
+        widget=forms.HiddenInput()
+    )
+    form.fields["config_hash"] = forms.CharField(
+        required=False,
+        initial=initial.get("config_hash", None),
+        widget=forms.HiddenInput()
+    )
+
+
 class GitConfigForm(C2Form):
     def __init__(self, *args, **kwargs):
         super(GitConfigForm, self).__init__(*args, **kwargs)
@@ -74,6 +93,7 @@ class GitConfigForm(C2Form):
             initial=initial.get("root_directory", None),
             help_text="Enter a Root directory for CloudBolt to synch content to"
         )
+        add_edit_check_fields(self, initial)
 
     def save(self):
         name = self.cleaned_data.get("name")
@@ -82,9 +102,12 @@ class GitConfigForm(C2Form):
         repo = self.cleaned_data.get("repo")
         branch = self.cleaned_data.get("branch")
         root_directory = self.cleaned_data.get("root_directory")
-        self.git_configs.add_or_edit_git_config(name, config_type, repo, branch,
-                                                git_auth_token_name,
-                                                root_directory)
+        self.git_configs.add_or_edit_git_config(
+            name, config_type, repo, branch, git_auth_token_name,
+            root_directory,
+            original_name=self.cleaned_data.get("original_name"),
+            expected_hash=self.cleaned_data.get("config_hash")
+        )
 
         # Returns the name of the Git Config to be used as the success message
         return name
@@ -133,6 +156,7 @@ class GitTokenForm(C2Form):
                       "you want to synch",
             widget=PasswordInput(render_value=True)
         )
+        add_edit_check_fields(self, initial)
 
     def clean(self):
         cleaned_data = super().clean()
@@ -143,8 +167,11 @@ class GitTokenForm(C2Form):
         git_type = self.cleaned_data.get("git_type")
         token = self.cleaned_data.get("token")
         api_url = self.cleaned_data.get("api_url")
-        self.git_configs.add_or_edit_git_token(token_name, git_type, token,
-                                               api_url)
+        self.git_configs.add_or_edit_git_token(
+            token_name, git_type, token, api_url,
+            original_name=self.cleaned_data.get("original_name"),
+            expected_hash=self.cleaned_data.get("config_hash")
+        )
 
         # Returns the name of the Git Config to be used as the success message
         return token_name
@@ -199,12 +226,11 @@ class GitCommitForm(C2Form):
         logger.debug(f"content_type: {content_type}")
         logger.debug(f"content_id: {content_id}")
         logger.debug(f"user: {self.user}, type: {type(self.user)}")
-        git_commit_id = create_git_commit_from_content(content_type, content_id,
-                                                       git_config_name,
-                                                       git_comment, self.user)
+        job = queue_git_export(content_type, [content_id], git_config_name,
+                               git_comment, self.user)
 
-        # Returns the name of the Git Config to be used as the success message
-        return git_commit_id
+        # Returns the export Job to be linked to in the success message
+        return job
 
     def format_outbound_configs(self):
         git_configs = GitManagementConfigs(self.user, "git_config")
@@ -231,8 +257,9 @@ class GitCommitMultipleForm(GitCommitForm):
             choices=get_content_choices(self.content_type),
             widget=SelectizeMultiple,
             required=True,
-            help_text=f"Select the {self.content_type}s to commit. A new commit"
-                      f" will be created for each {self.content_type} selected",
+            help_text=f"Select the {self.content_type}s to commit. A single "
+                      f"commit will be created for all of the "
+                      f"{self.content_type}s selected",
         )
 
     def clean(self):
@@ -248,15 +275,10 @@ class GitCommitMultipleForm(GitCommitForm):
         logger.debug(f"user: {self.user}")
         logger.debug(f"git_comment: {git_comment}")
 
-        commit_ids = []
-        for content_id in content_ids:
-            this_git_comment = f"{git_comment} - {content_id}"
-            git_commit_id = create_git_commit_from_content(content_type,
-                                                           content_id,
-                                                           git_config_name,
-                                                           this_git_comment,
-                                                           self.user)
-            commit_ids.append(git_commit_id)
+        content_list = "\n".join(f"- {c}" for c in content_ids)
+        git_comment = f"{git_comment}\n\n{content_list}"
+        job = queue_git_export(content_type, content_ids, git_config_name,
+                               git_comment, self.user)
 
-        # Returns the name of the Git Config to be used as the success message
-        return ', '.join(commit_ids)
+        # Returns the export Job to be linked to in the success message
+        return job
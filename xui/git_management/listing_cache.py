@@ -0,0 +1,159 @@
+"""
+Persistent cache for paged Git API listings (repos and branches).
+
+Each page of a listing is stored with the ETag it was returned with, and is
+revalidated with If-None-Match. Unchanged pages come back as 304 Not Modified,
+which GitHub does not count against the rate limit, so refreshing a listing of
+thousands of repos costs one cheap round trip per page.
+
+Listings younger than LISTING_FRESH_TTL are served from the cache without
+calling the API. Older listings, up to LISTING_MAX_STALE, are served from the
+cache while a background thread revalidates them, so forms that show these
+listings render immediately.
+"""
+import hashlib
+import json
+import os
+import time
+
+try:
+    from eventlet.green import threading  # CB 7.7 and up
+except ImportError:
+    import threading  # CB 7.6 and earlier
+
+from utilities.logger import ThreadLogger
+
+logger = ThreadLogger(__name__)
+
+CACHE_DIR = "/var/opt/cloudbolt/proserv/xui/git_management/cache"
+# Seconds a listing is served without revalidating it
+LISTING_FRESH_TTL = 5 * 60
+# Seconds a listing may be served while it is revalidated in the background.
+# Older listings are revalidated before they are returned.
+LISTING_MAX_STALE = 7 * 24 * 60 * 60
+
+
+def get_cache_key(base_url, token, url):
+    """
+    Key a listing by the API, the token it was fetched with (what a token can
+    see differs between users) and the listing url. Hashed so the token is not
+    written to disk.
+    """
+    return hashlib.sha256(f"{base_url}|{token}|{url}".encode("utf-8")) \
+        .hexdigest()
+
+
+class ListingCache(object):
+    """
+    ETag cache of paged listings, stored as one JSON file per listing
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.refreshing = set()
+
+    def get_listing(self, key, get_page, first_url):
+        """
+        Return every item of a paged listing
+        :param key: the cache key, see get_cache_key
+        :param get_page: callable(url, etag) returning None if the page is
+            unchanged (304), otherwise a dict with the page's url, etag,
+            items and the url of the next page (None on the last page)
+        :param first_url: the url of the first page
+        :return: the items of every page, in order
+        """
+        entry = self.load(key)
+        if entry is not None:
+            age = time.time() - entry["fetched"]
+            if age < LISTING_FRESH_TTL:
+                return get_items(entry)
+            if age < LISTING_MAX_STALE:
+                self.refresh_in_background(key, get_page, first_url, entry)
+                return get_items(entry)
+        return get_items(self.refresh(key, get_page, first_url, entry))
+
+    def refresh(self, key, get_page, first_url, entry=None):
+        """
+        Fetch every page of the listing, revalidating the pages in entry
+        """
+        cached_pages = {}
+        if entry is not None:
+            cached_pages = {p["url"]: p for p in entry["pages"]}
+        pages = []
+        not_modified = 0
+        url = first_url
+        while url:
+            cached_page = cached_pages.get(url)
+            etag = cached_page["etag"] if cached_page else None
+            page = get_page(url, etag)
+            if page is None:
+                not_modified += 1
+                page = cached_page
+            pages.append(page)
+            url = page["next"]
+        logger.info(f"Refreshed listing {first_url}: {len(pages)} page(s), "
+                    f"{not_modified} not modified")
+        entry = {"fetched": time.time(), "pages": pages}
+        self.save(key, entry)
+        return entry
+
+    def refresh_in_background(self, key, get_page, first_url, entry):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.refresh(key, get_page, first_url, entry)
+            except Exception:
+                logger.exception(f"Background refresh of {first_url} failed")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, key):
+        try:
+            with open(self.get_path(key), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, key, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(key)
+        # Write then rename so a concurrent reader never sees a partial file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+
+def get_items(entry):
+    items = []
+    for page in entry["pages"]:
+        items.extend(page["items"])
+    return items
+
+
+_listing_cache = None
+_listing_cache_lock = threading.Lock()
+
+
+def get_listing_cache():
+    """
+    Return the process-wide ListingCache
+    """
+    global _listing_cache
+    with _listing_cache_lock:
+        if _listing_cache is None:
+            _listing_cache = ListingCache()
+        return _listing_cache
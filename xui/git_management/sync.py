@@ -0,0 +1,345 @@
+"""
+Scheduled sync of CloudBolt content to a Git Management config.
+
+A sync covers every ServiceBlueprint, ServerAction, HookPointAction,
+RecurringJob and UIExtension (as returned by the get_all_* helpers) and
+compares each to the manifest stored for the Git config by the last sync, in
+two steps:
+- A source fingerprint is computed from the DB rows the export is built
+  from: the content, its service items and the actions they run, including
+  the size and modification time of the actions' script files. Only content
+  whose source fingerprint changed is exported, as exporting is what takes
+  the time on a large catalog.
+- Each export is fingerprinted from its files, and only exports whose
+  fingerprint changed are committed, with one commit per content type (per
+  batch, see below).
+So a nightly backup of the whole catalog only exports, and talks to Git for,
+the handful of items that were edited that day. Content is re-exported in
+full every FULL_EXPORT_INTERVAL anyway, to pick up changes to related data
+the source fingerprint does not cover. UIExtensions are kept on disk rather
+than in the DB, so they are always exported.
+
+Exports are streamed: each one is fingerprinted as it finishes and dropped
+straight away unless it changed, and changed content is committed in batches
+of SYNC_COMMIT_BATCH_SIZE, so only a batch of exports is held in memory
+however large the catalog is.
+
+The manifest is written after each batch has been committed, so a sync that
+fails part way through picks up where it left off on the next run.
+
+See sync_recurring_job.py for the Recurring Job entry point.
+"""
+import hashlib
+import json
+import os
+import time
+
+from django.db.models import FileField
+from django.utils.text import slugify
+
+from cbhooks.models import CloudBoltHook
+from utilities.logger import ThreadLogger
+from xui.git_management.utilities import get_all_blueprints, \
+    get_all_server_actions, get_all_orchestration_actions, \
+    get_all_recurring_jobs, get_all_xuis, get_git_wrapper, \
+    GitManagementConfigs, iter_exports, git_blob_sha
+
+logger = ThreadLogger(__name__)
+
+MANIFEST_DIR = "/var/opt/cloudbolt/proserv/xui/git_management/manifests"
+# Most changed items committed, and so held in memory, at once
+SYNC_COMMIT_BATCH_SIZE = 100
+# Seconds between syncs that export every item regardless of its source
+# fingerprint
+FULL_EXPORT_INTERVAL = 7 * 24 * 60 * 60
+
+# Content types synced, in the order they are committed, and the helper that
+# lists the content of each type
+SYNC_CONTENT_TYPES = {
+    "ServiceBlueprint": get_all_blueprints,
+    "ServerAction": get_all_server_actions,
+    "HookPointAction": get_all_orchestration_actions,
+    "RecurringJob": get_all_recurring_jobs,
+    "UIExtension": get_all_xuis,
+}
+# Content types that can be fingerprinted from the DB, see fingerprint_source
+SOURCE_FINGERPRINT_TYPES = ["ServiceBlueprint", "ServerAction",
+                            "HookPointAction", "RecurringJob"]
+
+
+def fingerprint_export(export):
+    """
+    Fingerprint an exported piece of content. The export name is included
+    since it becomes the directory name in Git, so renaming content changes its
+    fingerprint.
+    :param export: the ContentExport of the content
+    :return: hex sha256 of the relative path and blob sha of every file
+    """
+    digest = hashlib.sha256()
+    digest.update(export.name.encode("utf-8"))
+    for rel_path, content in sorted(export.files):
+        digest.update(f"\0{rel_path}\0{git_blob_sha(content)}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_file_state(field_file):
+    if not field_file:
+        return ""
+    try:
+        stat = os.stat(field_file.path)
+    except (NotImplementedError, OSError, ValueError):
+        return field_file.name
+    return f"{field_file.name}:{stat.st_size}:{stat.st_mtime}"
+
+
+def get_model_state(obj):
+    """
+    The values of every field of a model instance as a string, with file
+    fields as the size and modification time of the file
+    """
+    state = [f"{obj._meta.label}:{obj.pk}"]
+    for field in obj._meta.concrete_fields:
+        value = field.value_from_object(obj)
+        if isinstance(field, FileField):
+            value = get_file_state(value)
+        state.append(f"{field.attname}={value}")
+    for field in obj._meta.many_to_many:
+        related_ids = sorted(getattr(obj, field.name).values_list(
+            "pk", flat=True))
+        state.append(f"{field.name}={related_ids}")
+    return "\0".join(state)
+
+
+def iter_source_objects(content_type, content):
+    """
+    Yield the model instances an export of the content is built from: the
+    content, the service items of a blueprint, and the actions they run
+    """
+    if content_type == "RecurringJob":
+        content = content.cast()
+    objects = [content]
+    if content_type == "ServiceBlueprint":
+        objects.extend(si.cast()
+                       for si in content.serviceitem_set.order_by("id"))
+    for obj in objects:
+        yield obj
+        for field in obj._meta.concrete_fields:
+            if not field.is_relation or \
+                    not issubclass(field.related_model, CloudBoltHook):
+                continue
+            hook = getattr(obj, field.name)
+            if hook is not None:
+                yield hook.cast()
+
+
+def fingerprint_source(content_type, content):
+    """
+    Fingerprint the DB rows an export of the content is built from, without
+    exporting it
+    :return: hex sha256, or None if the content type can not be
+        fingerprinted this way
+    """
+    if content_type not in SOURCE_FINGERPRINT_TYPES:
+        return None
+    digest = hashlib.sha256()
+    for obj in iter_source_objects(content_type, content):
+        digest.update(get_model_state(obj).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class GitSyncManifest(object):
+    """
+    The fingerprints of the content committed by the last sync of a Git
+    config, and of the DB rows it was exported from, stored as JSON under
+    MANIFEST_DIR.
+    """
+
+    def __init__(self, user, git_config):
+        """
+        :param user: the UserProfile the sync runs as
+        :param git_config: the Git Management config dict being synced to
+        """
+        self.git_config = git_config
+        name = slugify(f'{user.user.username}-{git_config["name"]}')
+        self.path = os.path.join(MANIFEST_DIR, f"{name}.json")
+        self.fingerprints = {}
+        self.source_fingerprints = {}
+        # Content type -> when all of its content was last exported
+        self.full_exports = {}
+        self.load()
+
+    def get_target(self):
+        # The manifest only describes what is in Git if the config still
+        # points at the same place
+        return {key: self.git_config.get(key)
+                for key in ["config_type", "repo", "branch", "root_directory"]}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            logger.info(f"No usable sync manifest at {self.path}, all content "
+                        f"will be treated as changed")
+            return
+        if data.get("target") != self.get_target():
+            logger.info(f"Git config {self.git_config['name']} has changed "
+                        f"since the last sync, discarding the manifest")
+            return
+        self.fingerprints = data.get("fingerprints", {})
+        self.source_fingerprints = data.get("source_fingerprints", {})
+        self.full_exports = data.get("full_exports", {})
+
+    def save(self):
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        data = {
+            "target": self.get_target(),
+            "updated": time.time(),
+            "fingerprints": self.fingerprints,
+            "source_fingerprints": self.source_fingerprints,
+            "full_exports": self.full_exports,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get_changed(self, content_type, fingerprints):
+        """
+        :param content_type: the type of the content
+        :param fingerprints: dict of global id -> current fingerprint
+        :return: the global ids whose fingerprint differs from the manifest
+        """
+        previous = self.fingerprints.get(content_type, {})
+        return [global_id for global_id, fingerprint in fingerprints.items()
+                if previous.get(global_id) != fingerprint]
+
+    def is_source_unchanged(self, content_type, global_id, source):
+        """
+        :return: True if the content was exported from the same DB rows by
+            the last sync, so its export can be skipped
+        """
+        return source is not None and \
+            global_id in self.fingerprints.get(content_type, {}) and \
+            self.source_fingerprints.get(content_type, {}).get(
+                global_id) == source
+
+    def is_full_export_due(self, content_type):
+        last = self.full_exports.get(content_type)
+        return last is None or time.time() - last >= FULL_EXPORT_INTERVAL
+
+    def set_fingerprints(self, content_type, fingerprints, sources):
+        # Replaces the whole content type so deleted content drops out
+        self.fingerprints[content_type] = dict(fingerprints)
+        self.source_fingerprints[content_type] = dict(sources)
+
+    def update_fingerprints(self, content_type, fingerprints, sources):
+        self.fingerprints.setdefault(content_type, {}).update(fingerprints)
+        self.source_fingerprints.setdefault(content_type, {}).update(sources)
+
+
+def sync_git_config(git_config_name, user, content_types=None, full=False,
+                    git_comment=None, progress=None):
+    """
+    Commit all content that changed since the last sync to the Git config
+    :param git_config_name: the name of the Git Management XUI configuration
+    :param user: the UserProfile to run the sync as
+    :param content_types: the content types to sync, defaults to all of
+        SYNC_CONTENT_TYPES
+    :param full: ignore the manifest, and export and compare every item to
+        the repo
+    :param git_comment: the commit message, a default naming the content type
+        is used if not passed
+    :param progress: optional callable(message)
+    :return: dict of content type -> list of commit urls, or None if nothing
+        changed
+    """
+    git_config = GitManagementConfigs(user, "git_config").get_git_config_by_name(
+        git_config_name)
+    wrapper = get_git_wrapper(git_config_name, user)
+    manifest = GitSyncManifest(user, git_config)
+    if content_types is None:
+        content_types = list(SYNC_CONTENT_TYPES.keys())
+    results = {}
+    for content_type in content_types:
+        contents = list(SYNC_CONTENT_TYPES[content_type]())
+        if progress:
+            progress(f"Fingerprinting {len(contents)} {content_type}(s)")
+        export_all = full or manifest.is_full_export_due(content_type)
+        sources = {}
+        to_export = []
+        for content in contents:
+            global_id = content.global_id
+            try:
+                sources[global_id] = fingerprint_source(content_type, content)
+            except Exception as e:
+                logger.warning(f"Could not fingerprint {content_type} "
+                               f"{global_id}, exporting it: {e}")
+                sources[global_id] = None
+            if export_all or not manifest.is_source_unchanged(
+                    content_type, global_id, sources[global_id]):
+                to_export.append(global_id)
+        # Content that was not exported keeps its fingerprint from the last
+        # sync
+        previous = manifest.fingerprints.get(content_type, {})
+        fingerprints = {global_id: previous[global_id]
+                        for global_id in sources
+                        if global_id not in to_export}
+        if progress:
+            progress(f"Exporting {len(to_export)} of {len(contents)} "
+                     f"{content_type}(s)")
+        batch = {}
+        changed = 0
+        for global_id, export in iter_exports(content_type, to_export):
+            fingerprint = fingerprint_export(export)
+            fingerprints[global_id] = fingerprint
+            if not full and not manifest.get_changed(
+                    content_type, {global_id: fingerprint}):
+                # Unchanged, its files are released here
+                continue
+            changed += 1
+            batch[global_id] = (export, fingerprint, sources[global_id])
+            if len(batch) >= SYNC_COMMIT_BATCH_SIZE:
+                results.setdefault(content_type, []).append(
+                    commit_batch(wrapper, manifest, content_type, batch,
+                                 git_comment, progress))
+                batch = {}
+        if batch:
+            results.setdefault(content_type, []).append(
+                commit_batch(wrapper, manifest, content_type, batch,
+                             git_comment, progress))
+        logger.info(f"Exported {len(to_export)} of {len(contents)} "
+                    f"{content_type}(s), {changed} changed since the last "
+                    f"sync")
+        manifest.set_fingerprints(content_type, fingerprints, sources)
+        if export_all:
+            manifest.full_exports[content_type] = time.time()
+        manifest.save()
+    return results or None
+
+
+def commit_batch(wrapper, manifest, content_type, batch, git_comment,
+                 progress=None):
+    """
+    Commit a batch of changed exports and record their fingerprints
+    :param batch: dict of global id -> (ContentExport, fingerprint, source
+        fingerprint)
+    :return: the commit url
+    """
+    if progress:
+        progress(f"Committing {len(batch)} changed {content_type}(s)")
+    comment = git_comment or \
+        f"Scheduled sync of {len(batch)} {content_type}(s)"
+    commit_url = wrapper.create_commit_from_exports(
+        [export for export, _, _ in batch.values()], comment, content_type
+    )
+    # Only record the fingerprints once the commit has landed
+    manifest.update_fingerprints(content_type, {
+        global_id: fingerprint
+        for global_id, (_, fingerprint, _) in batch.items()
+    }, {
+        global_id: source
+        for global_id, (_, _, source) in batch.items()
+    })
+    manifest.save()
+    return commit_url
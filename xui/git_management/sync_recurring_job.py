@@ -0,0 +1,30 @@
+"""
+Recurring Job action that syncs CloudBolt content to a Git Management config.
+
+Create a Recurring Job using this script as its action, with the following
+action inputs:
+- git_config_name: the name of the Git Management configuration to sync to
+- git_username: the CloudBolt user that owns the configuration and token
+- full_sync: set to True to ignore the stored manifest and compare every item
+  to the repo, for example after content was changed directly in Git
+"""
+from accounts.models import UserProfile
+from common.methods import set_progress
+from xui.git_management.sync import sync_git_config
+
+
+def run(job=None, logger=None, **kwargs):
+    git_config_name = "{{ git_config_name }}"
+    git_username = "{{ git_username }}"
+    full_sync = "{{ full_sync }}" == "True"
+
+    user = UserProfile.objects.get(user__username=git_username)
+    set_progress(f"Syncing content to Git config {git_config_name}")
+    results = sync_git_config(git_config_name, user, full=full_sync,
+                              progress=set_progress)
+    if not results:
+        return "SUCCESS", "No content changed since the last sync", ""
+    for content_type, commit_urls in results.items():
+        for commit_url in commit_urls:
+            set_progress(f"{content_type}: {commit_url}")
+    return "SUCCESS", f"Committed changes for {', '.join(results)}", ""
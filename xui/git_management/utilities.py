@@ -1,7 +1,10 @@
 import base64
+import hashlib
 import json
 import os
+import time
 import urllib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import List, Dict, Any
 
 import requests
@@ -15,10 +18,34 @@ from cbhooks.models import ServerAction, HookPointAction
 from extensions.models import UIExtension
 from jobs.models import RecurringJob
 from servicecatalog.models import ServiceBlueprint
+from shared_modules.http_transport import get_transport
+from xui.git_management.listing_cache import get_cache_key, get_listing_cache
 from utilities.logger import ThreadLogger
 
+try:
+    from eventlet.green import threading  # CB 7.7 and up
+except ImportError:
+    import threading  # CB 7.6 and earlier
+
 logger = ThreadLogger(__name__)
 
+# Maximum number of blobs uploaded to GitHub at the same time
+BLOB_UPLOAD_WORKERS = 8
+# Maximum number of content items exported at the same time when committing
+# several items at once
+EXPORT_WORKERS = 4
+# Seconds parsed GitManagementConfigs data is cached for in each process.
+# Within that time the cache is still dropped as soon as any process, on any
+# node, writes the data, see CONFIG_VERSION_KEY.
+CONFIG_CACHE_TTL = 60
+# Key of the version stamp stored with the config data, rewritten on every
+# write so each process can tell when its cached copy is stale
+CONFIG_VERSION_KEY = "_version"
+
+_CONFIG_FIELDS = {}
+_CONFIG_CACHE = {}
+_CONFIG_CACHE_LOCK = threading.Lock()
+
 
 def get_all_blueprints():
     bps = ServiceBlueprint.objects.filter(status="ACTIVE")
@@ -51,6 +78,13 @@ def get_documentation():
     export content to. The name of the configuration will be used to identify
     the configuration in the Git Management XUI.
 </p>
+    <h3>Scheduled Sync</h3>
+    <p>
+    To back up all content on a schedule, create a Recurring Job using
+    xui/git_management/sync_recurring_job.py as its action. Each run exports
+    all content, compares it to the fingerprints stored by the previous run
+    and commits only the content that changed.
+    </p>
 """
 
 
@@ -66,6 +100,41 @@ def create_git_commit_from_content(content_type, content_id, git_config_name,
     :param git_comment: the comment to use for the commit
     :param user: the user to create the commit for
     """
+    wrapper = get_git_wrapper(git_config_name, user)
+    logger.info(f"Creating commit for {content_type} {content_id} with "
+                f"comment {git_comment}")
+    return wrapper.create_git_commit_from_content(content_type, content_id,
+                                                  git_comment)
+
+
+def create_git_commit_from_contents(content_type, content_ids, git_config_name,
+                                    git_comment, user, progress=None):
+    """
+    Export several pieces of content of the same type and land them in the
+    Git repo as a single commit with a single branch update.
+    :param content_type: the type of content to create the commit for
+    :param content_ids: the ids of the content to create the commit for
+    :param git_config_name: the name of the Git Management XUI configuration
+    :param git_comment: the comment to use for the commit
+    :param user: the user to create the commit for
+    :param progress: optional callable(completed, message) called as each
+        item is exported and before the commit is created
+    """
+    wrapper = get_git_wrapper(git_config_name, user)
+    logger.info(f"Creating commit for {len(content_ids)} {content_type}s with "
+                f"comment {git_comment}")
+    return wrapper.create_git_commit_from_contents(content_type, content_ids,
+                                                   git_comment,
+                                                   progress=progress)
+
+
+def get_git_wrapper(git_config_name, user):
+    """
+    Return the GitHubWrapper or GitLabWrapper for a Git Management XUI
+    configuration, based off of the git_type of its auth token
+    :param git_config_name: the name of the Git Management XUI configuration
+    :param user: the user the configuration belongs to
+    """
     git_configs = GitManagementConfigs(user, "git_config")
     git_config = git_configs.get_git_config_by_name(git_config_name)
     git_auth_token_name = git_config["git_auth_token_name"]
@@ -81,10 +150,24 @@ def create_git_commit_from_content(content_type, content_id, git_config_name,
     if not wrapper:
         raise Exception(f"Wrapper could not be determined for type: {git_type}"
                         f", user:{user}, and config: {git_config}")
-    logger.info(f"Creating commit for {content_type} {content_id} with "
-                f"comment {git_comment}")
-    return wrapper.create_git_commit_from_content(content_type, content_id,
-                                                  git_comment)
+    return wrapper
+
+
+class GitConfigConflict(Exception):
+    """
+    Raised when a config was changed by someone else between it being shown
+    in a form and the form being saved
+    """
+
+
+def get_config_hash(config):
+    """
+    Hash of a single git config or token as stored, used by the config forms
+    to detect edits made after the form was opened
+    :param config: the config dict, or None if the config does not exist
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True)
+                          .encode("utf-8")).hexdigest()
 
 
 class GitManagementConfigs(object):
@@ -93,6 +176,15 @@ class GitManagementConfigs(object):
     There are two types of configs:
     1. git_config: the actual configuration data for the Git Management XUI
     2. git_tokens: the auth tokens for the Git Management XUI
+
+    The parsed config data is cached per process for CONFIG_CACHE_TTL seconds,
+    so repeated lookups while rendering views and forms do not go back to the
+    database. Every write stores a new version stamp in the config data's
+    CustomFieldValue, and a cached copy is only used while the stamp in the
+    database is unchanged, so other processes and nodes pick up a write on
+    their next lookup. Writes lock the
+    CustomFieldValue row and apply the change to the data currently stored, so
+    concurrent edits to different configs do not overwrite each other.
     """
 
     def __init__(self, user, record_type):
@@ -107,14 +199,15 @@ class GitManagementConfigs(object):
         if record_type not in ["git_config", "git_tokens"]:
             raise Exception("record_type must be git_config or git_tokens")
         self.record_type = record_type
+        self.cache_key = (user.id, record_type)
 
-    def get_config_data(self):
+    def get_custom_field(self):
         """
-        Create a CustomField for the configuration data for the GitHub
-        Management XUI
-        :return: the CustomField, CustomFieldValue, and the config data as a
-        tuple
+        Create the CustomField for the record type once per process
         """
+        cf = _CONFIG_FIELDS.get(self.record_type)
+        if cf is not None:
+            return cf
         if self.record_type == "git_config":
             cf = create_custom_field("git_management_config_data",
                                      "Git Configuration Data",
@@ -133,6 +226,17 @@ class GitManagementConfigs(object):
                                                  " Token Data",
                                      show_on_servers=True,
                                      )
+        _CONFIG_FIELDS[self.record_type] = cf
+        return cf
+
+    def get_config_data(self):
+        """
+        Load the configuration data for the GitHub Management XUI from the
+        database, creating its CustomField and CustomFieldValue if needed
+        :return: the CustomField, CustomFieldValue, and the config data as a
+        tuple
+        """
+        cf = self.get_custom_field()
         cfvs = self.user.get_cfvs_for_custom_field(cf.name)
         if len(cfvs) > 1:
             raise Exception("More than one CustomFieldValue found for "
@@ -148,29 +252,106 @@ class GitManagementConfigs(object):
             cfv, _ = self.user.custom_field_values.get_or_create(field=cf,
                                                                  value=value)
         config_data = json.loads(cfv.value)
+        version = config_data.pop(CONFIG_VERSION_KEY, None)
+        self.cache_config_data(cfv.id, version, config_data)
         return cf, cfv, config_data
 
+    def get_cached_config_data(self, reload=False):
+        """
+        Return the config data from the process cache, loading it if it is
+        missing, older than CONFIG_CACHE_TTL or was written since it was
+        cached. The returned dict is shared, do not modify it.
+        :param reload: load the data from the database whatever the cache holds
+        """
+        with _CONFIG_CACHE_LOCK:
+            entry = _CONFIG_CACHE.get(self.cache_key)
+        if entry and not reload and \
+                time.time() - entry["cached"] < CONFIG_CACHE_TTL and \
+                entry["version"] == self.get_stored_version(entry["cfv_id"]):
+            return entry["data"]
+        _, _, config_data = self.get_config_data()
+        return config_data
+
+    def cache_config_data(self, cfv_id, version, config_data):
+        with _CONFIG_CACHE_LOCK:
+            _CONFIG_CACHE[self.cache_key] = {
+                "cfv_id": cfv_id,
+                "version": version,
+                "data": config_data,
+                "cached": time.time(),
+            }
+
+    @staticmethod
+    def get_stored_version(cfv_id):
+        """
+        Read the version stamp of the config data from the database with a
+        single lookup of its CustomFieldValue
+        :return: the version, or False if the CustomFieldValue is gone
+        """
+        from orders.models import CustomFieldValue
+
+        cfv = CustomFieldValue.objects.filter(id=cfv_id).first()
+        if cfv is None:
+            return False
+        return json.loads(cfv.value).get(CONFIG_VERSION_KEY)
+
     def set_config_data(self, new_data):
         """
         Set the config data for the GitHub Management XUI
         :param new_data: the new data to set type: dict
         :return: None
         """
-        new_data = json.dumps(new_data)
+        self.update_config_data(lambda config_data: new_data)
+
+    def update_config_data(self, update):
+        """
+        Atomically read, modify and write the config data. The row is locked
+        for the duration, so concurrent updates are applied one after another
+        rather than the last write winning.
+        :param update: callable that takes the current config data and returns
+            the new config data
+        :return: the new config data
+        """
+        from django.db import transaction
+        from orders.models import CustomFieldValue
+
         _, cfv, _ = self.get_config_data()
-        cfv.value = new_data
-        cfv.save()
+        version = f"{time.time()}-{os.getpid()}-{threading.get_ident()}"
+        with transaction.atomic():
+            cfv = CustomFieldValue.objects.select_for_update().get(id=cfv.id)
+            config_data = json.loads(cfv.value)
+            config_data.pop(CONFIG_VERSION_KEY, None)
+            config_data = update(config_data)
+            # The version is written with the data, in the same row, so every
+            # process sees the new version exactly when it sees the new data
+            cfv.value = json.dumps({**config_data,
+                                    CONFIG_VERSION_KEY: version})
+            cfv.save()
+        self.cache_config_data(cfv.id, version, config_data)
+        return config_data
+
+    def check_unchanged(self, config_data, config_name, expected_hash):
+        """
+        Raise GitConfigConflict unless the stored config_name still hashes to
+        expected_hash (see get_config_hash). Nothing is checked if
+        expected_hash is not passed.
+        """
+        if expected_hash and \
+                get_config_hash(config_data.get(config_name)) != expected_hash:
+            raise GitConfigConflict(
+                f"{config_name} was changed by someone else since this form "
+                f"was opened, reload and try again")
 
     def get_git_configs(self):
         """
         Get the git configurations from the CustomField
         :return: the git configurations as a list of dicts
         """
-        _, _, config_data = self.get_config_data()
+        config_data = self.get_cached_config_data()
         configs = []
         for k, v in config_data.items():
             if k != "user":
-                configs.append(v)
+                configs.append(dict(v))
         return configs
 
     def get_git_config_by_name(self, config_name):
@@ -179,8 +360,12 @@ class GitManagementConfigs(object):
         :param config_name: the name of the config to get
         :return: the git configuration as a dict
         """
-        _, _, git_configs = self.get_config_data()
-        git_config = git_configs[config_name]
+        git_configs = self.get_cached_config_data()
+        if config_name not in git_configs:
+            # May have been added by another process since the cache was
+            # filled
+            git_configs = self.get_cached_config_data(reload=True)
+        git_config = dict(git_configs[config_name])
         return git_config
 
     def delete_git_config(self, config_name):
@@ -189,13 +374,15 @@ class GitManagementConfigs(object):
         :param config_name: the name of the config to delete
         :return: None
         """
-        _, _, config_data = self.get_config_data()
-        if config_name in config_data:
-            del config_data[config_name]
-        self.set_config_data(config_data)
+        def delete(config_data):
+            config_data.pop(config_name, None)
+            return config_data
+
+        self.update_config_data(delete)
 
     def add_or_edit_git_config(self, config_name, config_type, repo, branch,
-                               git_auth_token_name, root_directory):
+                               git_auth_token_name, root_directory,
+                               original_name=None, expected_hash=None):
         """
         Add a new or edit an existing git configuration on the CustomField
         :param config_name: the name of the config to add
@@ -204,9 +391,13 @@ class GitManagementConfigs(object):
         :param branch: the branch of the config to add
         :param git_auth_token_name: the git auth token to associate with the config
         :param root_directory: the root directory in the git repo to export to
+        :param original_name: the name of the config being edited, if it is
+            not config_name
+        :param expected_hash: the get_config_hash of the config being edited
+            when it was read. GitConfigConflict is raised if it has changed
+            since.
         :return: None
         """
-        _, _, config_data = self.get_config_data()
         if not root_directory:
             root_directory = ""
         config = {
@@ -217,27 +408,36 @@ class GitManagementConfigs(object):
             "git_auth_token_name": git_auth_token_name,
             "root_directory": root_directory
         }
-        config_data[config_name] = config
-        self.set_config_data(config_data)
+        self.save_config(config_name, config, original_name, expected_hash)
 
-    def add_or_edit_git_token(self, token_name, git_type, token, api_url):
+    def add_or_edit_git_token(self, token_name, git_type, token, api_url,
+                              original_name=None, expected_hash=None):
         """
         Add a new or edit an existing git token on the CustomField
         :param token_name: the name of the token config to add
         :param git_type: the type of the config to add - GitHub or gitlab
         :param token: the token to associate with the config
         :param api_url: the api url to associate with the config
+        :param original_name: see add_or_edit_git_config
+        :param expected_hash: see add_or_edit_git_config
         :return: None
         """
-        _, _, config_data = self.get_config_data()
         config = {
             "name": token_name,
             "git_type": git_type,
             "token": token,
             "api_url": api_url
         }
-        config_data[token_name] = config
-        self.set_config_data(config_data)
+        self.save_config(token_name, config, original_name, expected_hash)
+
+    def save_config(self, config_name, config, original_name=None,
+                    expected_hash=None):
+        def save(config_data):
+            self.check_unchanged(config_data, original_name or config_name,
+                                 expected_hash)
+            return {**config_data, config_name: config}
+
+        self.update_config_data(save)
 
 
 def get_root_content_directory(root_directory, content_type):
@@ -291,14 +491,130 @@ def get_content_directory_for_type(content_type):
 
 
 def export_content_to_tmp_dir(content_type, content_id):
-    # Get the content from CloudBolt
-    function_string = f'{content_type}.objects.get(global_id="{content_id}")'
+    if content_type not in CONTENT_EXPORTERS:
+        raise Exception(f"Content type {content_type} is not supported")
+    model, export_function = CONTENT_EXPORTERS[content_type]
 
-    # Export the content in supported format to a /tmp directory
-    export_call = f'export_{content_type.lower()}({function_string})'
-    tmp_dir = eval(export_call)
+    # Get the content from CloudBolt and export it in supported format to a
+    # /tmp directory
+    content = model.objects.get(global_id=content_id)
+    return export_function(content)
 
-    return tmp_dir
+
+class ContentExport(object):
+    """
+    The files of one exported piece of content, held in memory so they can be
+    hashed and sent to Git without going back to disk
+    """
+
+    def __init__(self, name, files):
+        """
+        :param name: the name of the export directory, used to name the
+            content's directory in Git
+        :param files: list of (path relative to the export, content as bytes)
+        """
+        self.name = name
+        self.files = files
+
+    def get_content_dir(self, root_content_directory):
+        content_dir = slugify(self.name).replace('-', '_')
+        return f'{root_content_directory}/{content_dir}'
+
+    def iter_files(self, content_dir):
+        """
+        Yield (path in Git, content as bytes) for each file in the export
+        :param content_dir: the content's directory in Git, see
+            get_content_dir
+        """
+        for rel_path, content in self.files:
+            yield f'{content_dir}/{rel_path}', content
+
+
+def read_export_directory(tmp_dir):
+    """
+    Read every file of an exported content directory in to a ContentExport
+    """
+    files = []
+    for root, dirs, filenames in os.walk(tmp_dir):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            with open(file_path, 'rb') as f:
+                files.append((os.path.relpath(file_path, tmp_dir), f.read()))
+    return ContentExport(tmp_dir.rstrip("/").split("/")[-1], files)
+
+
+def export_content(content_type, content_id):
+    """
+    Export a piece of content and read it in to memory. The serializers only
+    export to the filesystem, so the tmp directory they write is read once
+    and removed straight away.
+    :return: ContentExport
+    """
+    tmp_dir = export_content_to_tmp_dir(content_type, content_id)
+    try:
+        return read_export_directory(tmp_dir)
+    finally:
+        delete_tmp_dir(tmp_dir)
+
+
+def iter_exports(content_type, content_ids, progress=None):
+    """
+    Export several pieces of content in parallel, using up to EXPORT_WORKERS
+    threads, yielding each export as it finishes. No more than EXPORT_WORKERS
+    exports are held by the generator at once, so the files of a whole
+    catalog are never in memory together as long as the caller drops each
+    export once it is done with it.
+    :param content_type: the type of content to export
+    :param content_ids: the global ids of the content to export
+    :param progress: optional callable(completed, message) called as each
+        item finishes exporting
+    :return: generator of (content id, ContentExport), in the order the
+        exports finish
+    """
+    from django.db import connection
+
+    def export(content_id):
+        try:
+            return export_content(content_type, content_id)
+        finally:
+            # Each worker thread gets its own DB connection, close it rather
+            # than leaking it when the thread is reused or exits
+            connection.close()
+
+    total = len(content_ids)
+    if not total:
+        return
+    remaining = iter(content_ids)
+    completed = 0
+    with ThreadPoolExecutor(max_workers=min(EXPORT_WORKERS, total)) as pool:
+        running = {}
+        for content_id in remaining:
+            running[pool.submit(export, content_id)] = content_id
+            if len(running) >= EXPORT_WORKERS:
+                break
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                content_id = running.pop(future)
+                completed += 1
+                if progress:
+                    progress(completed, f"Exported {completed} of {total} "
+                                        f"{content_type}(s)")
+                yield content_id, future.result()
+                next_id = next(remaining, None)
+                if next_id is not None:
+                    running[pool.submit(export, next_id)] = next_id
+
+
+def export_contents(content_type, content_ids, progress=None):
+    """
+    Export several pieces of content in parallel, see iter_exports. Only
+    for the handful of items going in to one commit, as every export is held
+    in memory.
+    :return: the list of ContentExports, in the same order as content_ids
+    """
+    exports = dict(iter_exports(content_type, content_ids, progress))
+    return [exports[content_id] for content_id in content_ids]
 
 
 def delete_tmp_dir(tmp_dir):
@@ -346,6 +662,26 @@ def export_uiextension(xui):
     return tmp_dir
 
 
+CONTENT_EXPORTERS = {
+    "ServiceBlueprint": (ServiceBlueprint, export_serviceblueprint),
+    "ServerAction": (ServerAction, export_serveraction),
+    "HookPointAction": (HookPointAction, export_hookpointaction),
+    "RecurringJob": (RecurringJob, export_recurringjob),
+    "UIExtension": (UIExtension, export_uiextension),
+}
+
+
+def git_blob_sha(content):
+    """
+    Compute the sha git assigns to a blob with the given content, so local
+    files can be compared to the remote tree without uploading them
+    :param content: the file content as bytes
+    :return: the hex sha1 of the blob
+    """
+    header = f"blob {len(content)}\0".encode("ascii")
+    return hashlib.sha1(header + content).hexdigest()
+
+
 def get_all_orchestration_actions():
     """
     Get all orchestration actions
@@ -491,13 +827,28 @@ class GitHubWrapper(object):
         """
         Return the json of a Request to the GitHub API
         """
+        return self._send(url, method, data).json()
+
+    def _send(self, url, method="GET", data=None, extra_headers=None):
+        """
+        Send a Request to the GitHub API and return the response
+        :param url: path under the API url, or a full url such as the next
+            page link of a listing
+        :param extra_headers: headers to add to the request, for example
+            If-None-Match
+        """
         headers = {
             "Authorization": f"token {self.token}",
             "X-GitHub-Api-Version": self.github_api_version,
             "Accept": "application/vnd.github+json"
         }
-        request_url = f"{self.base_url}{url}"
-        r = requests.request(
+        if extra_headers:
+            headers.update(extra_headers)
+        if url.startswith("https://"):
+            request_url = url
+        else:
+            request_url = f"{self.base_url}{url}"
+        r = get_transport().request(
             method,
             request_url,
             headers=headers,
@@ -512,24 +863,54 @@ class GitHubWrapper(object):
             logger.error(f"Error: {e}")
             logger.error(f"Error Message: {err_message}")
             raise e
-        return r.json()
+        return r
 
     def get_repos(self):
         """
-        Query the GitHub API and return a list of repos for the user
+        Query the GitHub API and return a list of all repos for the user, see
+        get_all_pages_cached
         :return:
         """
         url = f"/user/repos"
-        return self.get(url)
+        return self.get_all_pages_cached(url)
 
     def get_branches_for_repository(self):
         """
-        Query the GitHub API and return a list of branches for the repo in the
-        config
+        Query the GitHub API and return a list of all branches for the repo in
+        the config, see get_all_pages_cached
         :return:
         """
         url = f"/repos/{self.repo}/branches"
-        return self.get(url)
+        return self.get_all_pages_cached(url)
+
+    def get_all_pages_cached(self, url, per_page=100):
+        """
+        Return the combined json lists of every page of a GitHub list
+        endpoint, from the ETag listing cache
+        :param url: the url of the list endpoint
+        :param per_page: the page size to request, GitHub caps this at 100
+        """
+        separator = "&" if "?" in url else "?"
+        first_url = f"{self.base_url}{url}{separator}per_page={per_page}"
+        key = get_cache_key(self.base_url, self.token, url)
+        return get_listing_cache().get_listing(key, self.get_page, first_url)
+
+    def get_page(self, url, etag=None):
+        """
+        Fetch one page of a list endpoint for the listing cache, following
+        the Link header for the next page
+        :return: None if the page matches etag, otherwise the page dict
+        """
+        extra_headers = {"If-None-Match": etag} if etag else None
+        r = self._send(url, extra_headers=extra_headers)
+        if r.status_code == 304:
+            return None
+        return {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "items": r.json(),
+            "next": r.links.get("next", {}).get("url"),
+        }
 
     def create_or_update_file_contents(
             self,
@@ -633,13 +1014,35 @@ class GitHubWrapper(object):
         :return: The sha of the blob
         """
         url = f"/repos/{self.repo}/git/blobs"
-        file_content_encoded = base64.b64encode(content)
-        data = {
-            "content": file_content_encoded,
-            "encoding": "base64",
-        }
+        # Text is sent as is, base64 is only needed for binary content and
+        # makes the request a third larger
+        try:
+            data = {
+                "content": content.decode("utf-8"),
+                "encoding": "utf-8",
+            }
+        except UnicodeDecodeError:
+            data = {
+                "content": base64.b64encode(content).decode("ascii"),
+                "encoding": "base64",
+            }
         return self.post(url, data)["sha"]
 
+    def create_blobs(self, files):
+        """
+        Create blobs for several files concurrently, using at most
+        BLOB_UPLOAD_WORKERS requests at a time
+        :param files: dict of path -> file content as bytes
+        :return: dict of path -> blob sha
+        """
+        if not files:
+            return {}
+        paths = list(files.keys())
+        workers = min(BLOB_UPLOAD_WORKERS, len(paths))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            shas = pool.map(self.create_blob, [files[p] for p in paths])
+            return dict(zip(paths, shas))
+
     def get_tree_sha_from_path(self, tree_path):
         """
         Get the sha of a tree from a path
@@ -651,7 +1054,14 @@ class GitHubWrapper(object):
         # With the Contents API, we have to get the parent directory then loop
         # through each tree in the directory to get the tree we are looking for
         # This is because the trees API does not support getting a tree by path
-        contents = self.get(f"/repos/{self.repo}/contents/{parent_path}")
+        try:
+            contents = self.get(f"/repos/{self.repo}/contents/{parent_path}"
+                                f"?ref={self.branch}")
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                # The parent directory doesn't exist in the branch yet
+                return None
+            raise
         for content in contents:
             if content["type"] == "dir" and content["name"] == dir_name:
                 return content["sha"]
@@ -690,13 +1100,23 @@ class GitHubWrapper(object):
         :param tree_sha: The sha of the tree
         :param parent_sha: The sha of the parent commit
         """
+        return self.create_commit_object(message, tree_sha, parent_sha)["sha"]
+
+    def create_commit_object(self, message, tree_sha, parent_sha):
+        """
+        Create a commit in the repo and return the full commit object, which
+        includes the html_url of the commit
+        :param message: The commit message
+        :param tree_sha: The sha of the tree
+        :param parent_sha: The sha of the parent commit
+        """
         url = f"/repos/{self.repo}/git/commits"
         data = {
             "message": message,
             "tree": tree_sha,
             "parents": [parent_sha],
         }
-        return self.post(url, data)["sha"]
+        return self.post(url, data)
 
     def get_commit(self, commit_sha):
         """
@@ -742,80 +1162,227 @@ class GitHubWrapper(object):
         :param git_comment: the comment to use for the git commit
         :return: The id for the git commit
         """
-        # Get the content from CloudBolt
-        tmp_dir = export_content_to_tmp_dir(content_type, content_id)
+        return self.create_git_commit_from_contents(content_type,
+                                                    [content_id], git_comment)
 
-        # Create the git commit
-        ref_url = self.create_commit_from_directory(tmp_dir, git_comment,
-                                                    content_type)
+    def create_git_commit_from_contents(self, content_type, content_ids,
+                                        git_comment, progress=None):
+        """
+        Create a single git commit from several pieces of CloudBolt content
+        :param content_type: the type of the content to export
+        :param content_ids: the ids of the content to export
+        :param git_comment: the comment to use for the git commit
+        :param progress: optional callable(completed, message)
+        :return: The url for the git commit
+        """
+        exports = export_contents(content_type, content_ids, progress)
+        if progress:
+            progress(len(content_ids), "Committing to Git")
+        return self.create_commit_from_exports(exports, git_comment,
+                                               content_type)
 
-        # Delete the tmp directory
-        delete_tmp_dir(tmp_dir)
+    def create_commit_from_directory(self, tmp_dir, git_comment, content_type):
+        return self.create_commit_from_directories([tmp_dir], git_comment,
+                                                   content_type)
 
-        return ref_url
+    def create_commit_from_directories(self, tmp_dirs, git_comment,
+                                       content_type):
+        exports = [read_export_directory(tmp_dir) for tmp_dir in tmp_dirs]
+        return self.create_commit_from_exports(exports, git_comment,
+                                               content_type)
 
-    def create_commit_from_directory(self, tmp_dir, git_comment, content_type):
+    def create_commit_from_exports(self, exports, git_comment, content_type):
+        """
+        Merge the changes from each ContentExport in to one tree and commit it
+        with a single update of the branch ref
+        """
         root_content_directory = get_root_content_directory(self.root_directory,
                                                             content_type)
         branch_sha = self.get_branch_sha()
-        tree_sha = self.create_tree_from_directory(tmp_dir,
-                                                   root_content_directory,
-                                                   branch_sha)
-        commit_sha = self.create_commit(git_comment, tree_sha, branch_sha)
-        ref_url = self.update_branch_ref(commit_sha)
-        html_url = self.get_commit(commit_sha)["html_url"]
-        return html_url
+        # Only the directories of the exported items are listed, so a small
+        # commit does not depend on listing the whole content type
+        item_tree_shas = self.get_item_tree_shas(root_content_directory)
+        tree = []
+        for export in exports:
+            content_dir = export.get_content_dir(root_content_directory)
+            if item_tree_shas is None:
+                remote_blobs = self.get_remote_blobs(content_dir)
+            elif content_dir in item_tree_shas:
+                remote_blobs = self.get_remote_blobs(
+                    content_dir, item_tree_shas[content_dir])
+            else:
+                # New content, nothing in the branch yet
+                remote_blobs = {}
+            tree.extend(self.get_tree_entries_for_export(
+                export, root_content_directory, remote_blobs
+            ))
+        if not tree:
+            logger.info(f"No changes found in {[e.name for e in exports]}, "
+                        f"skipping commit")
+            return "No changes to commit"
+        tree_sha = self.create_tree(branch_sha, tree)
+        commit = self.create_commit_object(git_comment, tree_sha, branch_sha)
+        ref_url = self.update_branch_ref(commit["sha"])
+        return commit["html_url"]
 
     def create_tree_from_directory(self, tmp_dir, root_content_directory,
                                    branch_sha):
-        logger.info(f"Creating tree from directory {tmp_dir}")
-        tree = []
-        content_dir = slugify(tmp_dir.split("/")[-1]).replace('-', '_')
-        content_dir = f'{root_content_directory}/{content_dir}'
-        for root, dirs, files in os.walk(tmp_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_content = open(file_path, 'rb').read()
-                git_file_path = file_path.replace(tmp_dir, content_dir)
-                blob_sha = self.create_blob(file_content)
-                tree.append({
-                    "path": git_file_path,
-                    "mode": "100644",
-                    "type": "blob",
-                    "sha": blob_sha
-                })
-        tree = self.update_tree_to_remove_deleted_files(tree, content_dir)
+        """
+        Create a tree containing only the files in tmp_dir that differ from the
+        branch.
+        :return: the sha of the new tree, or None if nothing changed
+        """
+        tree = self.get_tree_entries_for_directory(tmp_dir,
+                                                   root_content_directory)
+        if not tree:
+            return None
         return self.create_tree(branch_sha, tree)
 
-    def update_tree_to_remove_deleted_files(self, tree, content_dir):
+    def get_tree_entries_for_directory(self, tmp_dir, root_content_directory,
+                                       remote_blobs=None):
+        """
+        Build the tree entries for the files in tmp_dir that differ from the
+        branch, see get_tree_entries_for_export
+        """
+        return self.get_tree_entries_for_export(
+            read_export_directory(tmp_dir), root_content_directory,
+            remote_blobs
+        )
+
+    def get_tree_entries_for_export(self, export, root_content_directory,
+                                    remote_blobs=None):
+        """
+        Build the tree entries for the files in a ContentExport that differ
+        from the branch. Blob shas are computed locally and compared to the
+        remote tree so only new or changed files are uploaded, and files no
+        longer in the export are marked for deletion.
+        :param export: the exported content
+        :param root_content_directory: the directory for the content type
+        :param remote_blobs: the blobs already in the branch, as returned by
+            get_remote_blobs for the content directory or any parent of it.
+            Fetched if not passed.
+        :return: a list of tree entries, empty if nothing changed
+        """
+        logger.info(f"Creating tree from export {export.name}")
+        content_dir = export.get_content_dir(root_content_directory)
+        if remote_blobs is None:
+            remote_blobs = self.get_remote_blobs(content_dir)
+        else:
+            prefix = f'{content_dir}/'
+            remote_blobs = {path: item for path, item in remote_blobs.items()
+                            if path.startswith(prefix)}
+        local_paths = set()
+        changed_files = {}
+        for git_file_path, file_content in export.iter_files(content_dir):
+            local_paths.add(git_file_path)
+            remote_blob = remote_blobs.get(git_file_path)
+            if remote_blob and \
+                    remote_blob["sha"] == git_blob_sha(file_content):
+                continue
+            changed_files[git_file_path] = file_content
+        logger.info(f"{len(changed_files)} of {len(local_paths)} files "
+                    f"changed, uploading blobs")
+        tree = []
+        for git_file_path, blob_sha in self.create_blobs(changed_files).items():
+            tree.append({
+                "path": git_file_path,
+                "mode": "100644",
+                "type": "blob",
+                "sha": blob_sha
+            })
+        return self.update_tree_to_remove_deleted_files(
+            tree, content_dir, remote_blobs=remote_blobs,
+            local_paths=local_paths
+        )
+
+    def get_item_tree_shas(self, root_content_directory):
+        """
+        Get the tree sha of each item directory in the content type's
+        directory, with one non-recursive listing
+        :return: dict of full path -> tree sha, or None if the listing was
+            truncated and each item has to be looked up by path
+        """
+        root_tree_sha = self.get_tree_sha_from_path(root_content_directory)
+        if not root_tree_sha:
+            return {}
+        root_tree = self.get_tree(root_tree_sha)
+        if root_tree.get("truncated"):
+            logger.warning(f"The remote tree for {root_content_directory} "
+                           f"was truncated by GitHub, looking up each item "
+                           f"by path")
+            return None
+        return {f'{root_content_directory}/{item["path"]}': item["sha"]
+                for item in root_tree["tree"] if item["type"] == "tree"}
+
+    def get_remote_blobs(self, content_dir, tree_sha=None):
+        """
+        Get the blobs currently in the branch under the content directory
+        :param content_dir: the root directory for the content
+        :param tree_sha: the sha of the content directory's tree, looked up
+            from the path if not passed
+        :return: dict of full path -> tree item for each blob
+        """
+        if tree_sha is None:
+            tree_sha = self.get_tree_sha_from_path(content_dir)
+        if not tree_sha:
+            return {}
+        query_params = [{"recursive": "true"}]
+        current_tree = self.get_tree(tree_sha, query_params)
+        if current_tree.get("truncated"):
+            logger.info(f"The remote tree for {content_dir} was truncated by "
+                        f"GitHub, listing it one directory at a time")
+            return self.walk_remote_blobs(content_dir, tree_sha)
+        return {f'{content_dir}/{item["path"]}': item
+                for item in current_tree["tree"] if item["type"] == "blob"}
+
+    def walk_remote_blobs(self, tree_path, tree_sha):
+        """
+        Get the blobs under a tree by listing each of its directories on its
+        own, for trees too large to list recursively in one call
+        :return: dict of full path -> tree item for each blob
+        """
+        current_tree = self.get_tree(tree_sha)
+        if current_tree.get("truncated"):
+            raise Exception(f"The remote tree for {tree_path} is too large "
+                            f"to list")
+        blobs = {}
+        for item in current_tree["tree"]:
+            item_path = f'{tree_path}/{item["path"]}'
+            if item["type"] == "blob":
+                blobs[item_path] = item
+            elif item["type"] == "tree":
+                blobs.update(self.walk_remote_blobs(item_path, item["sha"]))
+        return blobs
+
+    def update_tree_to_remove_deleted_files(self, tree, content_dir,
+                                            remote_blobs=None,
+                                            local_paths=None):
         """
         Remove files from the tree that have been deleted from the CloudBolt content
         We only want to impact files that are in the content directory. We don't
         want to remove files that are in any directories outside the content dir.
         :param tree: the tree to update
         :param content_dir: the root directory for the content
-        """
-        current_tree_sha = self.get_tree_sha_from_path(content_dir)
-        if not current_tree_sha:
-            # If the dir (tree) doesn't already exist there wouldn't be any files
-            # to remove. Just return the original tree that we built.
-            return tree
-        query_params = [{"recursive": "true"}]
-        current_tree = self.get_tree(current_tree_sha, query_params)
-        new_tree_files = [f["path"] for f in tree]
-        for item in current_tree["tree"]:
-            if item["type"] == "blob":
-                tree_path = f'{content_dir}/{item["path"]}'
-                if tree_path not in new_tree_files:
-                    logger.info(
-                        f"Removing file {tree_path} from tree - it does not"
-                        f" exist in the new tree")
-                    tree.append({
-                        "path": tree_path,
-                        "mode": item["mode"],
-                        "type": item["type"],
-                        "sha": None,
-                    })
+        :param remote_blobs: the blobs already in the branch, as returned by
+            get_remote_blobs. Fetched if not passed.
+        :param local_paths: set of every path in the exported content. Defaults
+            to the paths in the tree.
+        """
+        if remote_blobs is None:
+            remote_blobs = self.get_remote_blobs(content_dir)
+        if local_paths is None:
+            local_paths = {f["path"] for f in tree}
+        for tree_path, item in remote_blobs.items():
+            if tree_path not in local_paths:
+                logger.info(
+                    f"Removing file {tree_path} from tree - it does not"
+                    f" exist in the new tree")
+                tree.append({
+                    "path": tree_path,
+                    "mode": item["mode"],
+                    "type": item["type"],
+                    "sha": None,
+                })
         return tree
 
 
@@ -865,13 +1432,43 @@ class GitLabWrapper(object):
         """
         Return the json of a Request to the GitHub API
         """
+        return self._send(url, method, data).json()
+
+    def get_all_pages(self, url, per_page=100):
+        """
+        Return the combined json lists of every page of a paginated GitLab
+        list endpoint, following the X-Next-Page header
+        :param url: the url of the list endpoint, may include query params
+        :param per_page: the page size to request, GitLab caps this at 100
+        """
+        separator = "&" if "?" in url else "?"
+        items = []
+        page = "1"
+        while page:
+            r = self._send(f"{url}{separator}per_page={per_page}&page={page}")
+            items.extend(r.json())
+            page = r.headers.get("X-Next-Page")
+        return items
+
+    def _send(self, url, method="GET", data=None, extra_headers=None):
+        """
+        Send a Request to the GitLab API and return the response
+        :param url: path under the API url, or a full url
+        :param extra_headers: headers to add to the request, for example
+            If-None-Match
+        """
         headers = {
             'PRIVATE-TOKEN': self.token,
             'Accept': 'application/json',
             'Content-Type': 'application/json'
         }
-        request_url = f"{self.base_url}{url}"
-        r = requests.request(
+        if extra_headers:
+            headers.update(extra_headers)
+        if url.startswith("https://"):
+            request_url = url
+        else:
+            request_url = f"{self.base_url}{url}"
+        r = get_transport().request(
             method,
             request_url,
             headers=headers,
@@ -889,7 +1486,7 @@ class GitLabWrapper(object):
             logger.error(f"Error: {e}")
             logger.error(f"Error Message: {err_message}")
             raise e
-        return r.json()
+        return r
 
     def get_project(self):
         """
@@ -901,12 +1498,35 @@ class GitLabWrapper(object):
 
     def get_branches_for_repository(self):
         """
-        Query the GitHub API and return a list of branches for the repo in the
-        config
+        Query the GitLab API and return a list of all branches for the repo in
+        the config, from the ETag listing cache
         :return:
         """
         url = f"/projects/{self.project_path}/repository/branches"
-        return self.get(url)
+        first_url = f"{self.base_url}{url}?per_page=100&page=1"
+        key = get_cache_key(self.base_url, self.token, url)
+        return get_listing_cache().get_listing(key, self.get_page, first_url)
+
+    def get_page(self, url, etag=None):
+        """
+        Fetch one page of a list endpoint for the listing cache, following
+        the X-Next-Page header for the next page. url must end in page=<n>.
+        :return: None if the page matches etag, otherwise the page dict
+        """
+        extra_headers = {"If-None-Match": etag} if etag else None
+        r = self._send(url, extra_headers=extra_headers)
+        if r.status_code == 304:
+            return None
+        next_page = r.headers.get("X-Next-Page")
+        next_url = None
+        if next_page:
+            next_url = f'{url.rsplit("page=", 1)[0]}page={next_page}'
+        return {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "items": r.json(),
+            "next": next_url,
+        }
 
     def create_or_update_file_contents(
             self,
@@ -984,24 +1604,52 @@ class GitLabWrapper(object):
         :param git_comment: the comment to use for the git commit
         :return: The id for the git commit
         """
-        # Get the content from CloudBolt
-        tmp_dir = export_content_to_tmp_dir(content_type, content_id)
+        return self.create_git_commit_from_contents(content_type,
+                                                    [content_id], git_comment)
 
-        # Create the git commit
-        ref_url = self.create_commit_from_directory(tmp_dir, git_comment,
-                                                    content_type)
+    def create_git_commit_from_contents(self, content_type, content_ids,
+                                        git_comment, progress=None):
+        """
+        Create a single git commit from several pieces of CloudBolt content
+        :param content_type: the type of the content to export
+        :param content_ids: the ids of the content to export
+        :param git_comment: the comment to use for the git commit
+        :param progress: optional callable(completed, message)
+        :return: The url for the git commit
+        """
+        exports = export_contents(content_type, content_ids, progress)
+        if progress:
+            progress(len(content_ids), "Committing to Git")
+        return self.create_commit_from_exports(exports, git_comment,
+                                               content_type)
 
-        # Delete the tmp directory
-        delete_tmp_dir(tmp_dir)
+    def create_commit_from_directory(self, tmp_dir, git_comment, content_type):
+        return self.create_commit_from_directories([tmp_dir], git_comment,
+                                                   content_type)
 
-        return ref_url
+    def create_commit_from_directories(self, tmp_dirs, git_comment,
+                                       content_type):
+        exports = [read_export_directory(tmp_dir) for tmp_dir in tmp_dirs]
+        return self.create_commit_from_exports(exports, git_comment,
+                                               content_type)
 
-    def create_commit_from_directory(self, tmp_dir, git_comment, content_type):
+    def create_commit_from_exports(self, exports, git_comment, content_type):
+        """
+        Combine the actions for each ContentExport in to one commit
+        """
         root_content_directory = get_root_content_directory(self.root_directory,
                                                             content_type)
-
-        actions = self.generate_actions_from_directory(tmp_dir,
-                                                       root_content_directory)
+        actions = []
+        for export in exports:
+            # Each export lists only its own directory, so a small commit does
+            # not page through the whole content type
+            actions.extend(self.generate_actions_from_export(
+                export, root_content_directory
+            ))
+        if not actions:
+            logger.info(f"No changes found in {[e.name for e in exports]}, "
+                        f"skipping commit")
+            return "No changes to commit"
         commit = self.create_commit(git_comment, actions)
 
         return commit["web_url"]
@@ -1022,39 +1670,65 @@ class GitLabWrapper(object):
         }
         return self.post(url, data)
 
-    def generate_actions_from_directory(self, tmp_dir, root_content_directory):
+    def generate_actions_from_directory(self, tmp_dir, root_content_directory,
+                                        repo_blobs=None):
         """
-        Generate a list of actions to perform in the commit
-        :param tmp_dir: The directory to generate the actions from
+        Generate a list of actions to perform in the commit for the files in
+        tmp_dir, see generate_actions_from_export
+        """
+        return self.generate_actions_from_export(
+            read_export_directory(tmp_dir), root_content_directory, repo_blobs
+        )
+
+    def generate_actions_from_export(self, export, root_content_directory,
+                                     repo_blobs=None):
+        """
+        Generate a list of actions to perform in the commit. Files are
+        compared to the repository tree by their git blob sha: unchanged
+        files are skipped, changed files are updated and new files created.
+        :param export: The ContentExport to generate the actions from
         :param root_content_directory: The root directory for the content
+        :param repo_blobs: path -> blob id map of the repository, as returned
+            by get_repository_blobs for the content directory or any parent
+            of it. Fetched if not passed.
         """
         actions = []
-        content_dir = slugify(tmp_dir.split("/")[-1]).replace('-', '_')
-        content_dir = f'{root_content_directory}/{content_dir}'
-        for root, dirs, files in os.walk(tmp_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                git_file_path = file_path.replace(tmp_dir, content_dir)
-                try:
-                    # Check if the file exists in the repo
-                    self.get_file(git_file_path)
-                    action_mode = "update"
-                except HTTPError as e:
-                    logger.debug(f"File {git_file_path} does not exist in "
-                                 f"repo. Creating.")
-                    action_mode = "create"
-                with open(file_path, "rb") as f:
-                    content_bytes = f.read()
-                    base64_bytes = base64.b64encode(content_bytes)
-                    base64_content = base64_bytes.decode("ascii")
-                    action = {
-                        "action": action_mode,
-                        "file_path": git_file_path,
-                        "content": base64_content,
-                        "encoding": "base64",
-                    }
-                    actions.append(action)
-        actions = self.set_deleted_files(actions, content_dir)
+        content_dir = export.get_content_dir(root_content_directory)
+        if repo_blobs is None:
+            repo_blobs = self.get_repository_blobs(content_dir)
+        else:
+            prefix = f'{content_dir}/'
+            repo_blobs = {path: blob_id for path, blob_id in repo_blobs.items()
+                          if path.startswith(prefix)}
+        local_paths = set()
+        for git_file_path, content_bytes in export.iter_files(content_dir):
+            local_paths.add(git_file_path)
+            blob_id = repo_blobs.get(git_file_path)
+            if blob_id == git_blob_sha(content_bytes):
+                continue
+            if blob_id:
+                action_mode = "update"
+            else:
+                logger.debug(f"File {git_file_path} does not exist in "
+                             f"repo. Creating.")
+                action_mode = "create"
+            # Text is sent as is, base64 is only needed for binary content
+            try:
+                content = content_bytes.decode("utf-8")
+                encoding = "text"
+            except UnicodeDecodeError:
+                content = base64.b64encode(content_bytes).decode("ascii")
+                encoding = "base64"
+            action = {
+                "action": action_mode,
+                "file_path": git_file_path,
+                "content": content,
+                "encoding": encoding,
+            }
+            actions.append(action)
+        actions = self.set_deleted_files(actions, content_dir,
+                                         repo_blobs=repo_blobs,
+                                         local_paths=local_paths)
         return actions
 
     def get_file(self, file_path):
@@ -1068,7 +1742,8 @@ class GitLabWrapper(object):
               f"{enc_file_path}?ref={self.branch}"
         return self.get(url)
 
-    def set_deleted_files(self, actions, content_dir):
+    def set_deleted_files(self, actions, content_dir, repo_blobs=None,
+                          local_paths=None):
         """
         Set files that have been deleted from the CloudBolt content directory to
         delete. We only want to impact files that are in the content directory.
@@ -1076,14 +1751,17 @@ class GitLabWrapper(object):
         content dir.
         :param actions: the actions list to update
         :param content_dir: the base path to the content directory
-        """
-        new_action_paths = [f["file_path"] for f in actions]
-        tree = self.get_repository_tree(content_dir)
-        for item in tree:
-            if item["type"] != "blob":
-                continue
-            action_path = item["path"]
-            if action_path not in new_action_paths:
+        :param repo_blobs: path -> blob id map of the content directory in the
+            repository. Fetched if not passed.
+        :param local_paths: set of every path in the exported content. Defaults
+            to the paths in the actions.
+        """
+        if repo_blobs is None:
+            repo_blobs = self.get_repository_blobs(content_dir)
+        if local_paths is None:
+            local_paths = {f["file_path"] for f in actions}
+        for action_path in repo_blobs:
+            if action_path not in local_paths:
                 logger.info(
                     f"Removing file {action_path} from tree - it does not"
                     f" exist in the new tree")
@@ -1095,11 +1773,27 @@ class GitLabWrapper(object):
 
     def get_repository_tree(self, content_dir):
         """
-        Get the tree for the repo recursively
+        Get the tree for the repo recursively, paging through all results
         :param content_dir: the directory to get the tree for
         :return:
         """
-        url = f"/projects/{self.project_path}/repository/tree" \
-              f"?ref={self.branch}&path={content_dir}&recursive=true"
-        return self.get(url)
+        query = urlencode({"ref": self.branch, "path": content_dir,
+                           "recursive": "true"})
+        url = f"/projects/{self.project_path}/repository/tree?{query}"
+        try:
+            return self.get_all_pages(url)
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                # The directory doesn't exist in the branch yet
+                return []
+            raise
 
+    def get_repository_blobs(self, content_dir):
+        """
+        Get a map of path -> blob id for every file under content_dir
+        :param content_dir: the directory to get the blobs for
+        :return: dict
+        """
+        tree = self.get_repository_tree(content_dir)
+        return {item["path"]: item["id"] for item in tree
+                if item["type"] == "blob"}
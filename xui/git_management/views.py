@@ -11,7 +11,7 @@ from xui.git_management.utilities import get_all_blueprints, get_documentation,\
     get_all_xuis, get_all_recurring_jobs, format_xuis_for_template, \
     format_recurring_jobs_for_template, format_orch_actions_for_template, \
     format_server_actions_for_template, format_bps_for_template, \
-    GitManagementConfigs
+    GitManagementConfigs, GitConfigConflict, get_config_hash
 from django.utils.translation import ugettext as _
 from utilities.decorators import dialog_view
 from django.http import HttpResponseRedirect
@@ -170,6 +170,9 @@ def edit_git_config(request, config_type, config_name):
     user = get_current_userprofile()
     git_configs = GitManagementConfigs(user, config_type)
     initial = git_configs.get_git_config_by_name(config_name)
+    initial["original_name"] = config_name
+    initial["config_hash"] = get_config_hash(
+        git_configs.get_cached_config_data().get(config_name))
     initial["config_type"] = config_type
     initial["user"] = user
     action_url = reverse("git_config_edit", args=[config_type, config_name])
@@ -184,7 +187,11 @@ def submit_git_commit_form(request, initial, action_url, config_type):
         else:
             form = GitTokenForm(request.POST, initial=initial)
         if form.is_valid():
-            config_name = form.save()
+            try:
+                config_name = form.save()
+            except GitConfigConflict as e:
+                messages.error(request, str(e))
+                return HttpResponseRedirect(request.META["HTTP_REFERER"])
             msg = f"Git Config Updated: {config_name}"
             messages.success(request, msg)
             return HttpResponseRedirect(request.META["HTTP_REFERER"])
@@ -253,9 +260,8 @@ def create_git_commit(request, content_type, content_id):
     if request.method == "POST":
         form = GitCommitForm(request.POST, initial=initial)
         if form.is_valid():
-            git_commit_id = form.save()
-            msg = f"New Git Commit Created: {git_commit_id}"
-            messages.success(request, msg)
+            job = form.save()
+            messages.success(request, get_export_queued_message(job))
             return HttpResponseRedirect(request.META["HTTP_REFERER"])
     else:
         form = GitCommitForm(initial=initial)
@@ -284,9 +290,8 @@ def export_multiple(request, content_type):
     if request.method == "POST":
         form = GitCommitMultipleForm(request.POST, initial=initial)
         if form.is_valid():
-            git_commit_id = form.save()
-            msg = f"New Git Commit Created: {git_commit_id}"
-            messages.success(request, msg)
+            job = form.save()
+            messages.success(request, get_export_queued_message(job))
             return HttpResponseRedirect(request.META["HTTP_REFERER"])
     else:
         form = GitCommitMultipleForm(initial=initial, request=request)
@@ -299,3 +304,10 @@ def export_multiple(request, content_type):
         "action_url": action_url,
         "submit": "Save",
     }
+
+
+def get_export_queued_message(job):
+    return format_html(
+        'Git export queued: <a href="{}">Job {}</a>',
+        job.get_absolute_url(), job.id
+    )
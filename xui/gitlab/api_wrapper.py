@@ -1,10 +1,9 @@
-import requests
-
 if __name__ == '__main__':
     import django
 
     django.setup()
 
+from shared_modules.http_transport import get_transport
 from utilities.models import ConnectionInfo
 from utilities.rest import RestConnection
 import sys
@@ -92,32 +91,9 @@ class GitLabConnector(RestConnection):
         return self
 
     def __getattr__(self, item):
-        if item == 'get':
-            return lambda path, **kwargs: requests.get(
-                self.base_url + path,
-                auth=None,
-                headers=self.headers,
-                verify=self.verify_certs,
-                **kwargs
-            )
-        elif item == 'post':
-            return lambda path, **kwargs: requests.post(
-                self.base_url + path,
-                auth=None,
-                headers=self.headers,
-                verify=self.verify_certs,
-                **kwargs
-            )
-        elif item == 'delete':
-            return lambda path, **kwargs: requests.delete(
-                self.base_url + path,
-                auth=None,
-                headers=self.headers,
-                verify=self.verify_certs,
-                **kwargs
-            )
-        elif item == 'put':
-            return lambda path, **kwargs: requests.put(
+        if item in ['get', 'post', 'delete', 'put']:
+            return lambda path, **kwargs: get_transport().request(
+                item.upper(),
                 self.base_url + path,
                 auth=None,
                 headers=self.headers,